@@ -2,19 +2,30 @@
 # -*- coding: utf-8 -*-
 
 import abc
+import collections
 import collections.abc
-from datetime import datetime
+import functools
+from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
 import hashlib
-import json
+import hmac
+import inspect
 import logging
 import re
+import select
+import signal
+import threading
+import time
 import uuid
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import BaseHTTPRequestHandler
 from optparse import OptionParser
-from weakref import WeakKeyDictionary
 
+import codec
+import logs
+import metrics
 import scoring
+import tracing
+from server import ThreadPoolHTTPServer, PreforkServer
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -46,8 +57,39 @@ STORE_CONFIG = {
     'port': 6379,
     'socket_timeout': 5,
     'socket_connect_timeout': 5,
-    'max_retry_attempt_count': 5
+    'cache_max_connections': 32,
+    'interests_max_connections': 32,
+    'pool_timeout': 2.0,
+    'socket_keepalive': True,
+    'health_check_interval': 30,
+    'replicas': [],
+    'replica_recovery_timeout': 5,
+    'shards': [],
+    'ring_vnodes': 160,
+    'max_retry_attempt_count': 5,
+    'retry_backoff': 0.1,
+    'retry_max_backoff': 1.0,
+    'retry_deadline': 3.0,
+    'breaker_failure_threshold': 5,
+    'breaker_recovery_timeout': 10,
+    'local_cache_size': 0,
+    'local_cache_bytes': 16 * 1024 * 1024,
+    'write_behind_size': 10000,
+    'write_behind_interval': 0.05,
+    'write_behind_policy': 'drop_new',
+    'negative_cache_size': 0,
+    'negative_cache_ttl': 60,
 }
+STREAM_CLIENTS_THRESHOLD = 1000
+
+REQUESTS = metrics.REGISTRY.counter('api_requests_total', 'Requests served by method and response code',
+                                    ('method', 'code'))
+REQUEST_LATENCY = metrics.REGISTRY.histogram('api_request_duration_seconds', 'Time to serve a request by method',
+                                             ('method',))
+STAGE_LATENCY = metrics.REGISTRY.histogram('api_stage_duration_seconds', 'Time spent in each request stage',
+                                           ('stage',))
+# ids taken from the X-Request-ID header are echoed in a response header and written to the logs
+REQUEST_ID_RE = re.compile(r'^[\w.:-]{1,128}$')
 
 
 class ValidationError(Exception):
@@ -58,34 +100,81 @@ class BaseField(object):
     def __init__(self, required=True, nullable=False):
         self.required = required
         self.nullable = nullable
-        self.data = WeakKeyDictionary()
+        self.storage = None
+
+    @staticmethod
+    def storage_name(name):
+        return '_' + name
 
     def __set_name__(self, owner, name):
+        # request classes reserve a slot for every field, other owners keep values in the instance dict
         self.name = name
+        self.storage = owner.__dict__.get(self.storage_name(name))
 
     def __get__(self, instance, owner):
         if instance is None:
             return self
 
-        return self.data.get(instance, None)
+        if self.storage is not None:
+            return self.storage.__get__(instance, owner)
+        return instance.__dict__.get(self.name)
 
     def __set__(self, instance, value):
         if value is not None:
-            self.check(value)
-        self.data[instance] = value
+            value = self.clean(value)
+        if self.storage is not None:
+            self.storage.__set__(instance, value)
+        else:
+            instance.__dict__[self.name] = value
+
+    def clean(self, value):
+        # validates the incoming value and returns the one to store
+        self.check(value)
+        return value
 
     def check(self, value):
         pass
 
 
 class ArgumentsField(BaseField):
+    JSON_SCALARS = (str, int, float, type(None))
+    JSON_KEYS = (str, int, float, type(None))
 
     def check(self, value):
-        try:
-            json.loads(json.dumps(value))
-        except (TypeError, ValueError):
+        if not self.is_json(value):
             raise ValidationError("{} is not a valid json".format(str(value)))
 
+    @classmethod
+    def is_json(cls, value):
+        # walks the already parsed value and accepts what json.dumps would encode, a container is rejected
+        # only when it contains itself, so shared references pass and circular ones fail as in json.dumps
+        path = set()
+        stack = [(value, False)]
+        while stack:
+            item, leaving = stack.pop()
+            if leaving:
+                path.discard(id(item))
+                continue
+
+            if isinstance(item, cls.JSON_SCALARS):
+                continue
+
+            if id(item) in path:
+                return False
+
+            if isinstance(item, dict):
+                if not all(isinstance(key, cls.JSON_KEYS) for key in item):
+                    return False
+                elements = item.values()
+            elif isinstance(item, (list, tuple)):
+                elements = item
+            else:
+                return False
+            path.add(id(item))
+            stack.append((item, True))
+            stack.extend([(element, False) for element in elements if not isinstance(element, cls.JSON_SCALARS)])
+        return True
+
 
 class CharField(BaseField):
     def check(self, value):
@@ -97,21 +186,23 @@ class CharField(BaseField):
 
 class EmailField(CharField):
     EMAIL_PATTERN = r'^[a-z][\w\-\.]*@([a-z][\w\-]+\.)+[a-z]{2,4}$'
+    EMAIL_REGEXP = re.compile(EMAIL_PATTERN)
 
     def check(self, value):
         super(EmailField, self).check(value)
 
-        if not isinstance(value, str) or (value != "" and not re.match(self.EMAIL_PATTERN, value)):
+        if not isinstance(value, str) or (value != "" and not self.EMAIL_REGEXP.match(value)):
             raise ValidationError('{} is not a valid email'.format(value))
 
 
 class PhoneField(BaseField):
     PHONE_PATTERN = r'^7\d{10}$'
+    PHONE_REGEXP = re.compile(PHONE_PATTERN)
 
     def check(self, value):
         super(PhoneField, self).check(value)
 
-        if value != '' and not re.match(self.PHONE_PATTERN, str(value)):
+        if value != '' and not self.PHONE_REGEXP.match(str(value)):
             raise ValidationError('{} is not a valid phone'.format(value))
 
     def __set__(self, instance, value):
@@ -120,38 +211,52 @@ class PhoneField(BaseField):
 
 class DateField(BaseField):
     DATE_PATTERN = r'^\d{2}\.(0[1-9]|1[0-1])\.\d{4}$'
+    DATE_REGEXP = re.compile(DATE_PATTERN)
 
     def check(self, value):
         super(DateField, self).check(value)
 
-        if not isinstance(value, str) or (value != '' and not re.match(self.DATE_PATTERN, value)):
+        if not isinstance(value, str) or (value != '' and not self.DATE_REGEXP.match(value)):
             raise ValidationError('{} is not a valid date'.format(value))
 
-    def __get__(self, instance, owner):
-        result = super(DateField, self).__get__(instance, owner)
-
-        return self.str_to_date(result) if result else None
+    def clean(self, value):
+        # the string is parsed once on assignment and the field keeps the datetime
+        self.check(value)
+        return self.str_to_date(value) if value else None
 
     @staticmethod
     def str_to_date(value):
-        return datetime.strptime(value, '%d.%m.%Y')
+        # value is already matched by DATE_PATTERN, so it is always DD.MM.YYYY
+        try:
+            return datetime(int(value[6:10]), int(value[3:5]), int(value[0:2]))
+        except ValueError:
+            raise ValidationError('{} is not a valid date'.format(value))
 
 
 class BirthDayField(DateField):
-    def check(self, value):
-        super(BirthDayField, self).check(value)
+    MAX_AGE_YEARS = 70
 
-        bdate = self.str_to_date(value)
-        if value != '' and \
-                (bdate < (datetime.now() - relativedelta(years=70)) or bdate > datetime.today()):
-            raise ValidationError('{} is more than 70 years ago'.format(value))
+    def clean(self, value):
+        bdate = super(BirthDayField, self).clean(value)
+        if bdate is not None:
+            # a birthday exactly MAX_AGE_YEARS ago is already too old
+            earliest, latest = self.bounds(date.today())
+            if bdate <= earliest or bdate > latest:
+                raise ValidationError('{} is more than {} years ago'.format(value, self.MAX_AGE_YEARS))
+        return bdate
+
+    @classmethod
+    @functools.lru_cache(maxsize=1)
+    def bounds(cls, today):
+        latest = datetime.combine(today, datetime.min.time())
+        return latest - relativedelta(years=cls.MAX_AGE_YEARS), latest
 
 
 class GenderField(BaseField):
     def check(self, value):
         super(GenderField, self).check(value)
 
-        if not (isinstance(value, int) and int(value) in [key for key in GENDERS.keys()]):
+        if not (isinstance(value, int) and value in GENDERS):
             raise ValidationError('{} is not a valid gender'.format(value))
 
 
@@ -165,16 +270,64 @@ class ClientIDsField(BaseField):
             raise ValidationError('{} should contain only integers'.format(value))
 
 
-class BaseRequest(metaclass=abc.ABCMeta):
+class ArgumentsListField(BaseField):
+    def check(self, value):
+        super(ArgumentsListField, self).check(value)
+        if not isinstance(value, list):
+            raise ValidationError('{} is not a list'.format(value))
+
+        if not all(isinstance(item, dict) for item in value):
+            raise ValidationError('{} should contain only objects'.format(value))
+
+
+class RequestMeta(abc.ABCMeta):
+    # fields of a request class are collected once, when the class is created,
+    # so from_dict and validate do not inspect the class on every request.
+    # Field values live in slots of the request instance
+    def __new__(mcs, name, bases, namespace):
+        namespace['__slots__'] = tuple(namespace.get('__slots__', ())) + \
+            tuple(BaseField.storage_name(key) for key, value in namespace.items() if isinstance(value, BaseField))
+        cls = super(RequestMeta, mcs).__new__(mcs, name, bases, namespace)
+
+        fields = {}
+        for base in reversed(cls.__mro__[1:]):
+            fields.update(getattr(base, 'declared_fields', {}))
+        fields.update((key, value) for key, value in namespace.items() if isinstance(value, BaseField))
+
+        cls.declared_fields = fields
+        cls.validation_plan = tuple((key, field.required, field.nullable) for key, field in fields.items())
+        cls.storage_plan = tuple(field.storage for field in fields.values())
+        return cls
+
+
+class BaseRequest(metaclass=RequestMeta):
+    __slots__ = ('admin',)
+
+    def __init__(self):
+        self.admin = False
+        for storage in self.storage_plan:
+            storage.__set__(self, None)
+
+    @property
+    def is_admin(self):
+        return self.admin
+
+    @is_admin.setter
+    def is_admin(self, value):
+        self.admin = value
+
     @classmethod
     def from_dict(cls, source_dict):
         self = cls()
 
         error_list = []
+        fields = cls.declared_fields
         for key, value in source_dict.items():
+            field = fields.get(key)
+            if field is None:
+                continue
             try:
-                if key in cls.__dict__:
-                    setattr(self, key, value)
+                field.__set__(self, value)
             except ValidationError as e:
                 error_list.append(str(e))
 
@@ -183,19 +336,24 @@ class BaseRequest(metaclass=abc.ABCMeta):
 
         return self
 
+    @staticmethod
+    def is_null(value):
+        return (value is None) or (isinstance(value, collections.abc.Sized) and (len(value) == 0))
+
     def attr_is_null(self, attr_name):
-        attr_value = getattr(self, attr_name)
-        return (attr_value is None) or \
-               (isinstance(attr_value, collections.abc.Sized) and (len(attr_value) == 0))
+        return self.is_null(getattr(self, attr_name))
+
+    def non_empty_fields(self):
+        return [key for key in self.declared_fields if not self.attr_is_null(key)]
 
     def validate(self):
         error_list = []
-        for key, value in self.__class__.__dict__.items():
-            if isinstance(value, BaseField):
-                if value.required and (getattr(self, key) is None):
-                    error_list.append('{} is required'.format(key))
-                elif not value.nullable and self.attr_is_null(key):
-                    error_list.append('{} is not nullable'.format(key))
+        for key, required, nullable in self.validation_plan:
+            value = getattr(self, key)
+            if required and value is None:
+                error_list.append('{} is required'.format(key))
+            elif not nullable and self.is_null(value):
+                error_list.append('{} is not nullable'.format(key))
 
         if error_list:
             raise ValidationError(', '.join(error_list))
@@ -214,8 +372,6 @@ class OnlineScoreRequest(BaseRequest):
     birthday = BirthDayField(required=False, nullable=True)
     gender = GenderField(required=False, nullable=True)
 
-    is_admin = False
-
     def validate(self):
         super(OnlineScoreRequest, self).validate()
 
@@ -228,6 +384,14 @@ class OnlineScoreRequest(BaseRequest):
                                   "phone-email, first name-last name, gender-birthday "
                                   "with non-empty values")
 
+    def score_arguments(self):
+        return {'phone': self.phone, 'email': self.email, 'birthday': self.birthday, 'gender': self.gender,
+                'first_name': self.first_name, 'last_name': self.last_name}
+
+
+class OnlineScoreBatchRequest(BaseRequest):
+    items = ArgumentsListField(required=True, nullable=False)
+
 
 class MethodRequest(BaseRequest):
     account = CharField(required=False, nullable=True)
@@ -241,117 +405,540 @@ class MethodRequest(BaseRequest):
         return self.login == ADMIN_LOGIN
 
 
+class AuthCache(object):
+    # expected tokens are computed once: the admin one per hour, user ones are kept in a LRU
+    # of verified (account, login) pairs so failed attempts can not push out valid entries
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.digests = collections.OrderedDict()
+        self.admin = (0, None)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_digest(value):
+        return hashlib.sha512(value.encode('UTF-8')).hexdigest().encode('ascii')
+
+    def admin_digest(self):
+        now = time.time()
+        expires, digest = self.admin
+        if now < expires:
+            with self.lock:
+                self.hits += 1
+            return digest
+
+        hour = datetime.fromtimestamp(now).replace(minute=0, second=0, microsecond=0)
+        digest = self.make_digest(hour.strftime("%Y%m%d%H") + ADMIN_SALT)
+        with self.lock:
+            self.misses += 1
+            self.admin = ((hour + timedelta(hours=1)).timestamp(), digest)
+        return digest
+
+    def check_admin(self, token):
+        return self.compare(self.admin_digest(), token)
+
+    def check_user(self, account, login, token):
+        key = (account, login)
+        with self.lock:
+            digest = self.digests.get(key)
+            if digest is not None:
+                self.digests.move_to_end(key)
+                self.hits += 1
+        if digest is not None:
+            return self.compare(digest, token)
+
+        digest = self.make_digest(account + login + SALT)
+        with self.lock:
+            self.misses += 1
+            if not self.compare(digest, token):
+                return False
+            self.digests[key] = digest
+            while len(self.digests) > self.max_entries:
+                self.digests.popitem(last=False)
+        return True
+
+    @staticmethod
+    def compare(digest, token):
+        if not isinstance(token, str):
+            return False
+        return hmac.compare_digest(digest, token.encode('UTF-8'))
+
+    def clear(self):
+        with self.lock:
+            self.digests.clear()
+            self.admin = (0, None)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.digests),
+            }
+
+
+AUTH_CACHE = AuthCache()
+
+
+def auth_cache_samples():
+    # the hit rate is hits over all lookups, the metrics backend computes it from the counter
+    stats = AUTH_CACHE.stats()
+    return [(('hit',), stats['hits']), (('miss',), stats['misses'])]
+
+
+metrics.REGISTRY.collector('api_auth_cache_lookups_total', 'Expected token lookups by result', auth_cache_samples,
+                           ('result',), 'counter')
+metrics.REGISTRY.collector('api_auth_cache_entries', 'Verified user tokens kept by the auth cache',
+                           lambda: [((), AUTH_CACHE.stats()['entries'])])
+
+
 def check_auth(request):
-    sha512 = hashlib.sha512()
     if request.is_admin:
-        sha512.update((datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).encode('UTF-8'))
-    else:
-        sha512.update((request.account + request.login + SALT).encode('UTF-8'))
+        return AUTH_CACHE.check_admin(request.token)
+    return AUTH_CACHE.check_user(request.account, request.login, request.token)
 
-    digest = sha512.hexdigest()
-    if digest == request.token:
-        return True
-    return False
+
+def stage(name):
+    return tracing.Span(name, STAGE_LATENCY, (name,))
+
+
+def make_request_id(header):
+    if header and REQUEST_ID_RE.match(header):
+        return header
+    return uuid.uuid4().hex
 
 
-def method_handler(request, ctx, store):
-    request_dict = json.loads(json.dumps(request['body']))
+def method_handler(request, ctx, store, handlers=None):
+    handlers = HANDLERS if handlers is None else handlers
     try:
-        method_request = MethodRequest().from_dict(request_dict)
-        method_request.validate()
+        with stage('validate'):
+            method_request = MethodRequest.from_dict(request['body'])
+            method_request.validate()
     except ValidationError as e:
         return str(e), INVALID_REQUEST
 
-    if not check_auth(method_request):
+    with stage('auth'):
+        authorized = check_auth(method_request)
+    if not authorized:
         return '', FORBIDDEN
 
     try:
-        if method_request.method.upper() == 'ONLINE_SCORE':
-            request = OnlineScoreRequest().from_dict(method_request.arguments)
+        if method_request.method.upper() not in handlers:
+            return '', INVALID_REQUEST
+
+        ctx['method'] = method_request.method.upper()
+        request_class, handler = handlers[ctx['method']]
+        with stage('arguments'):
+            request = request_class.from_dict(method_request.arguments)
             request.is_admin = method_request.is_admin
             request.validate()
-            return online_score_request_handler(request, ctx, store)
-        elif method_request.method.upper() == 'CLIENTS_INTERESTS':
-            request = ClientsInterestsRequest().from_dict(method_request.arguments)
-            request.validate()
-            return client_ids_request_handler(request, ctx, store)
-        else:
-            return '', INVALID_REQUEST
+        if inspect.iscoroutinefunction(handler):
+            # the async server times the handler when it awaits it
+            return handler(request, ctx, store)
+        with stage('handler'):
+            return handler(request, ctx, store)
 
     except ValidationError as e:
         return str(e), INVALID_REQUEST
 
 
 def online_score_request_handler(request, ctx, store):
-    ctx['has'] = [key for key, value in request.__class__.__dict__.items()
-                  if isinstance(value, BaseField) and not request.attr_is_null(key)]
+    ctx['has'] = request.non_empty_fields()
 
-    score = 42 if request.is_admin else scoring.get_score(store, request.phone, request.email, request.birthday,
-                                                          request.gender,
-                                                          request.first_name, request.last_name)
+    score = 42 if request.is_admin else scoring.get_score(store, **request.score_arguments())
     return {"score": score}, OK
 
 
+def online_score_batch_request_handler(request, ctx, store):
+    results, applicants = validate_score_batch(request, ctx)
+    if request.is_admin:
+        scores = [42] * len(applicants)
+    else:
+        scores = scoring.get_scores(store, list(applicants.values()))
+    return score_batch_response(results, applicants, scores), OK
+
+
+def validate_score_batch(request, ctx):
+    # every item is validated on its own, invalid items get an error in their result slot
+    results, applicants = [], {}
+    has = collections.Counter()
+    for index, arguments in enumerate(request.items):
+        try:
+            item = OnlineScoreRequest.from_dict(arguments)
+            item.validate()
+        except ValidationError as e:
+            results.append({"error": str(e), "code": INVALID_REQUEST})
+            continue
+
+        has.update(item.non_empty_fields())
+        results.append(None)
+        applicants[index] = item.score_arguments()
+
+    ctx['has'] = dict(has)
+    ctx['nitems'] = len(results)
+    return results, applicants
+
+
+def score_batch_response(results, applicants, scores):
+    for index, score in zip(applicants, scores):
+        results[index] = {"score": score}
+    return {"results": results}
+
+
 def client_ids_request_handler(request, ctx, store):
     ctx['nclients'] = 0 if request.client_ids is None else len(request.client_ids)
-    return {str(cid): scoring.get_interests(store, cid) for cid in request.client_ids}, OK
+    if ctx['nclients'] > STREAM_CLIENTS_THRESHOLD:
+        return stream_interests_response(scoring.iter_interests_batch(store, request.client_ids), ctx), OK
+
+    interests, failed = scoring.get_interests_batch(store, request.client_ids)
+    return interests_response(interests, failed, ctx), OK
+
+
+def interests_response(interests, failed, ctx):
+    if failed:
+        ctx['failed_clients'] = list(failed)
+        if len(failed) == len(interests):
+            raise next(iter(failed.values()))
+    return {str(cid): value for cid, value in interests.items()}
+
+
+def stream_interests_response(batches, ctx):
+    # batches are fetched while the response is written, the ones before the first batch with
+    # any interests are held back so a request with every id failed still gets an error response
+    held, failed = [], {}
+    for interests, batch_failed in batches:
+        held.append(interests)
+        failed.update(batch_failed)
+        if len(batch_failed) < len(interests):
+            break
+    else:
+        raise next(iter(failed.values()))
+
+    if failed:
+        ctx['failed_clients'] = list(failed)
+
+    def items():
+        for interests in held:
+            yield from ((str(cid), value) for cid, value in interests.items())
+        held.clear()
+        for interests, batch_failed in batches:
+            if batch_failed:
+                ctx.setdefault('failed_clients', []).extend(batch_failed)
+            yield from ((str(cid), value) for cid, value in interests.items())
+
+    return codec.StreamedObject(items())
+
+
+HANDLERS = {
+    'ONLINE_SCORE': (OnlineScoreRequest, online_score_request_handler),
+    'ONLINE_SCORE_BATCH': (OnlineScoreBatchRequest, online_score_batch_request_handler),
+    'CLIENTS_INTERESTS': (ClientsInterestsRequest, client_ids_request_handler),
+}
+
+
+def build_response(response, code):
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
 
 
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
         "method": method_handler
     }
+    # redis client keeps a connection pool and is safe to share between server worker threads
     store = scoring.ScoreStore(**STORE_CONFIG)
+    stream_threshold = STREAM_CLIENTS_THRESHOLD
+    # metrics are kept per process, with prefork every worker reports only the requests it served
+    metrics_path = "metrics"
+    protocol_version = "HTTP/1.1"
+    # an idle keep-alive connection is closed after timeout seconds, or after idle_poll_interval seconds
+    # when other connections wait for a worker, and a connection serves at most max_keepalive_requests
+    # requests, so a worker thread is not held by one client for too long
+    timeout = 5
+    idle_poll_interval = 0.05
+    max_keepalive_requests = 100
+    # headers and body go out in separate writes, they must not wait for the ack of the previous response
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super(MainHTTPHandler, self).setup()
+        self.requests_served = 0
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    def wait_for_request(self):
+        # pipelined requests are already buffered, otherwise the socket is polled until the next request
+        # arrives, the idle timeout passes or connections queued for a worker need this one
+        if self.has_buffered_request():
+            return True
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([self.connection], [], [], min(remaining, self.idle_poll_interval))
+            if readable:
+                return True
+            waiting = getattr(self.server, 'requests', None)
+            if waiting is not None and not waiting.empty():
+                return False
+
+    def has_buffered_request(self):
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        finally:
+            self.connection.settimeout(self.timeout)
 
     def get_request_id(self, headers):
-        return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
+        return make_request_id(headers.get('X-Request-ID'))
+
+    def do_GET(self):
+        if self.path.strip("/") != self.metrics_path:
+            self.send_response(NOT_FOUND)
+            self.send_header("Content-Type", "application/json")
+            self.write_json(build_response('', NOT_FOUND), '')
+            return
+
+        data = metrics.REGISTRY.render().encode('UTF-8')
+        self.send_response(OK)
+        self.send_header("Content-Type", metrics.CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_connection_header()
+        self.end_headers()
+        self.wfile.write(data)
 
     def do_POST(self):
         response, code = {}, OK
         context = {"request_id": self.get_request_id(self.headers)}
+        trace = tracing.start(context["request_id"])
+        deadline = scoring.start_deadline(self.store.retry_policy.deadline)
         request = None
         try:
             data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
-        except Exception:
+        except (TypeError, ValueError):
+            # without a valid length the next request on the connection can not be found
+            self.close_connection = True
             code = BAD_REQUEST
+        else:
+            try:
+                with stage('parse'):
+                    request = codec.loads(data_string)
+            except Exception:
+                code = BAD_REQUEST
 
         if request:
             path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
+            logging.info("%s: %s %s", self.path, data_string, context["request_id"])
             if path in self.router:
                 try:
                     response, code = self.router[path]({"body": request, "headers": self.headers}, context, self.store)
                 except Exception as e:
-                    logging.exception("Unexpected error: %s" % e)
+                    logging.exception("Unexpected error: %s", e)
                     code = INTERNAL_ERROR
             else:
                 code = NOT_FOUND
 
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
-        else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+        r = build_response(response, code)
+        self.write_json(r, response, trace)
+        if isinstance(response, codec.StreamedObject):
+            r["response"] = "<streamed>"
         context.update(r)
+        scoring.finish_deadline(deadline)
+        tracing.finish(trace)
+        context["timings"] = trace.timings()
         logging.info(context)
-        self.wfile.write(json.dumps(r))
+        method = context.get("method", "unknown")
+        REQUESTS.inc((method, str(code)))
+        REQUEST_LATENCY.observe(trace.duration, (method,))
         return
 
+    def write_json(self, r, response, trace=None):
+        # large responses are encoded straight to the socket without building the whole body
+        if isinstance(response, codec.StreamedObject) or \
+                isinstance(response, (dict, list)) and len(response) > self.stream_threshold:
+            self.send_trace_headers(trace)
+            self.write_stream(codec.iter_encode(r))
+        else:
+            with stage('encode'):
+                data = codec.dumps(r)
+            self.send_header("Content-Length", str(len(data)))
+            self.send_trace_headers(trace)
+            self.send_connection_header()
+            self.end_headers()
+            self.wfile.write(data)
+
+    def send_trace_headers(self, trace):
+        # a streamed response gets the timings of the stages finished before its body
+        if trace is not None:
+            self.send_header("X-Request-ID", trace.request_id)
+            self.send_header("Server-Timing", trace.server_timing())
+
+    def send_connection_header(self):
+        self.requests_served += 1
+        if self.requests_served >= self.max_keepalive_requests:
+            self.close_connection = True
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        elif self.request_version != "HTTP/1.1":
+            self.send_header("Connection", "keep-alive")
+
+    def write_stream(self, chunks):
+        # http/1.0 clients read the body until the connection is closed
+        chunked = self.request_version == "HTTP/1.1"
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.close_connection = True
+        self.send_connection_header()
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                if chunked:
+                    chunk = b"%x\r\n%s\r\n" % (len(chunk), chunk)
+                self.wfile.write(chunk)
+        except Exception as e:
+            # headers are already sent, the client sees a truncated body and a closed connection
+            logging.exception("Response stream failed: %s", e)
+            self.close_connection = True
+            return
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+
+def local_cache_samples(stats, fields):
+    # the score cache and the negative interests cache, the ones that are turned on
+    for cache, section in (('score', 'local_cache'), ('negative', 'negative_cache')):
+        if stats[section] is not None:
+            for labels, field in fields:
+                yield (cache,) + labels, stats[section][field]
+
+
+def write_behind_samples(stats, fields):
+    if stats['write_behind'] is not None:
+        for labels, field in fields:
+            yield labels, stats['write_behind'][field]
+
+
+def breaker_samples(stats, field):
+    for name, shard in stats['shards'].items():
+        yield (name,), shard['circuit_breaker'][field]
+
+
+def breaker_state_samples(stats):
+    # one sample per state, the current one is 1
+    for name, shard in stats['shards'].items():
+        for state in (scoring.CircuitBreaker.CLOSED, scoring.CircuitBreaker.OPEN, scoring.CircuitBreaker.HALF_OPEN):
+            yield (name, state), int(shard['circuit_breaker']['state'] == state)
+
+
+def pool_samples(stats, fields):
+    # every pool of a shard, the primary and each replica of the score cache and the interests store
+    for name, shard in stats['shards'].items():
+        pools = shard['pools']
+        for pool in ('cache', 'interests'):
+            nodes = [('primary', pools[pool])] + [('replica-%s' % num, replica) for num, replica in
+                                                  enumerate(pools[pool + '_replicas'], 1)]
+            for node, node_stats in nodes:
+                for labels, field in fields:
+                    if node_stats[field] is not None:
+                        yield (name, pool, node) + labels, node_stats[field]
+
+
+def register_store_metrics(get_store):
+    # the stats the store of a server keeps are read when /metrics is rendered
+    def samples(read, *args):
+        def collect():
+            store = get_store()
+            return list(read(store.stats(), *args)) if store is not None else []
+        return collect
+
+    metrics.REGISTRY.collector('scoring_local_cache_lookups_total', 'In-process cache lookups by cache and result',
+                               samples(local_cache_samples, [(('hit',), 'hits'), (('miss',), 'misses')]),
+                               ('cache', 'result'), 'counter')
+    metrics.REGISTRY.collector('scoring_local_cache_removals_total', 'In-process cache entries removed by reason',
+                               samples(local_cache_samples, [(('eviction',), 'evictions'),
+                                                             (('expiration',), 'expirations')]),
+                               ('cache', 'reason'), 'counter')
+    metrics.REGISTRY.collector('scoring_local_cache_entries', 'Entries in the in-process caches',
+                               samples(local_cache_samples, [((), 'entries')]), ('cache',))
+    metrics.REGISTRY.collector('scoring_local_cache_bytes', 'Bytes of keys and values in the in-process caches',
+                               samples(local_cache_samples, [((), 'bytes')]), ('cache',))
+    metrics.REGISTRY.collector('scoring_write_behind_total', 'Score cache writes by what the write-behind queue did',
+                               samples(write_behind_samples, [((name,), name) for name in
+                                                              ('queued', 'dropped', 'coalesced', 'written', 'failed')]),
+                               ('result',), 'counter')
+    metrics.REGISTRY.collector('scoring_circuit_breaker_state', 'Circuit breaker state of every shard',
+                               samples(breaker_state_samples), ('shard', 'state'))
+    metrics.REGISTRY.collector('scoring_circuit_breaker_trips_total', 'Times the circuit breaker of a shard opened',
+                               samples(breaker_samples, 'trips'), ('shard',), 'counter')
+    metrics.REGISTRY.collector('scoring_circuit_breaker_rejected_total',
+                               'Redis calls rejected by the open circuit breaker of a shard',
+                               samples(breaker_samples, 'rejected'), ('shard',), 'counter')
+    metrics.REGISTRY.collector('scoring_redis_pool_connections', 'Connections of every redis pool by state',
+                               samples(pool_samples, [(('in_use',), 'in_use'), (('idle',), 'idle')]),
+                               ('shard', 'pool', 'node', 'state'))
+    metrics.REGISTRY.collector('scoring_redis_pool_max_connections', 'Connections a redis pool may open',
+                               samples(pool_samples, [((), 'max_connections')]), ('shard', 'pool', 'node'))
+    metrics.REGISTRY.collector('scoring_write_behind_pending', 'Score cache writes waiting in the write-behind queue',
+                               samples(write_behind_samples, [((), 'pending')]))
+
+
+register_store_metrics(lambda: MainHTTPHandler.store)
+
+
+def init_worker():
+    # every forked worker opens its own connections instead of sharing the ones created at import
+    MainHTTPHandler.store = scoring.ScoreStore(**STORE_CONFIG)
+
+
+def close_worker():
+    # cache writes and log records still queued are flushed before the worker exits
+    MainHTTPHandler.store.close()
+    logging.shutdown()
+
+
+def serve_threaded(server):
+    # SIGTERM stops the server the same way as Ctrl-C, so queued writes are flushed either way
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    close_worker()
+
 
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-w", "--workers", action="store", type=int, default=8)
+    op.add_option("-b", "--backlog", action="store", type=int, default=1024)
+    op.add_option("--processes", action="store", type=int, default=0)
+    logs.add_options(op)
+    tracing.add_options(op)
     (opts, args) = op.parse_args()
-    logging.basicConfig(filename=opts.log, level=logging.INFO,
-                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
-    try:
+    logs.setup_from_options(opts)
+    tracing.setup_from_options(opts)
+    if opts.processes:
+        server = PreforkServer(("localhost", opts.port), MainHTTPHandler, processes=opts.processes,
+                               workers=opts.workers, backlog=opts.backlog, worker_init=init_worker,
+                               worker_exit=close_worker)
+        logging.info("Starting server at %s with %s processes", opts.port, opts.processes)
         server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    server.server_close()
+    else:
+        server = ThreadPoolHTTPServer(("localhost", opts.port), MainHTTPHandler,
+                                      workers=opts.workers, backlog=opts.backlog)
+        logging.info("Starting server at %s with %s workers", opts.port, opts.workers)
+        serve_threaded(server)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import inspect
+import logging
+from http import HTTPStatus
+from optparse import OptionParser
+
+import api
+import codec
+import logs
+import metrics
+import scoring
+import tracing
+
+
+async def online_score_request_handler(request, ctx, store):
+    ctx['has'] = request.non_empty_fields()
+
+    score = 42 if request.is_admin else await scoring.get_score_async(store, **request.score_arguments())
+    return {"score": score}, api.OK
+
+
+async def online_score_batch_request_handler(request, ctx, store):
+    results, applicants = api.validate_score_batch(request, ctx)
+    if request.is_admin:
+        scores = [42] * len(applicants)
+    else:
+        scores = await scoring.get_scores_async(store, list(applicants.values()))
+    return api.score_batch_response(results, applicants, scores), api.OK
+
+
+async def client_ids_request_handler(request, ctx, store):
+    ctx['nclients'] = 0 if request.client_ids is None else len(request.client_ids)
+    interests, failed = await scoring.get_interests_batch_async(store, request.client_ids)
+    return api.interests_response(interests, failed, ctx), api.OK
+
+
+HANDLERS = {
+    'ONLINE_SCORE': (api.OnlineScoreRequest, online_score_request_handler),
+    'ONLINE_SCORE_BATCH': (api.OnlineScoreBatchRequest, online_score_batch_request_handler),
+    'CLIENTS_INTERESTS': (api.ClientsInterestsRequest, client_ids_request_handler),
+}
+
+
+async def method_handler(request, ctx, store):
+    # validation, auth and routing are shared with the sync api, only the handlers are awaited
+    result = api.method_handler(request, ctx, store, HANDLERS)
+    if inspect.isawaitable(result):
+        with api.stage('handler'):
+            result = await result
+    return result
+
+
+class AsyncHTTPServer:
+    router = {
+        "method": method_handler
+    }
+    metrics_path = "metrics"
+
+    def __init__(self, store, host='localhost', port=8080, backlog=1024, idle_timeout=75):
+        self.store = store
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.idle_timeout = idle_timeout
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port,
+                                                 backlog=self.backlog)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line.strip():
+                    break
+
+                method, path, version = request_line.decode('latin-1').split()
+                headers = await self.read_headers(reader)
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                content_type, extra_headers = 'application/json', ()
+                if method == 'POST':
+                    code, data, extra_headers = await self.process_request(path, headers, body)
+                elif method == 'GET' and path.strip('/') == self.metrics_path:
+                    code, data = api.OK, metrics.REGISTRY.render().encode('UTF-8')
+                    content_type = metrics.CONTENT_TYPE
+                else:
+                    code, data = HTTPStatus.NOT_IMPLEMENTED, b''
+
+                keep_alive = self.is_keep_alive(version, headers)
+                self.write_response(writer, code, data, keep_alive, content_type, extra_headers)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def read_headers(reader):
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return headers
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+    @staticmethod
+    def is_keep_alive(version, headers):
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+    @staticmethod
+    def write_response(writer, code, data, keep_alive, content_type='application/json', extra_headers=()):
+        status = HTTPStatus(code)
+        headers = [('Content-Type', content_type), ('Content-Length', len(data))] + list(extra_headers) + \
+            [('Connection', 'keep-alive' if keep_alive else 'close')]
+        writer.write('HTTP/1.1 {} {}\r\n{}\r\n'.format(
+            status.value, status.phrase, ''.join('{}: {}\r\n'.format(*header) for header in headers)).encode('latin-1'))
+        writer.write(data)
+
+    async def process_request(self, path, headers, body):
+        response, code = {}, api.OK
+        context = {"request_id": api.make_request_id(headers.get('x-request-id'))}
+        trace = tracing.start(context["request_id"])
+        deadline = scoring.start_deadline(self.store.retry_policy.deadline)
+        request = None
+        try:
+            with api.stage('parse'):
+                request = codec.loads(body)
+        except Exception:
+            code = api.BAD_REQUEST
+
+        if request:
+            path = path.strip("/")
+            logging.info("%s: %s %s", path, body, context["request_id"])
+            if path in self.router:
+                try:
+                    response, code = await self.router[path]({"body": request, "headers": headers}, context,
+                                                             self.store)
+                except Exception as e:
+                    logging.exception("Unexpected error: %s", e)
+                    code = api.INTERNAL_ERROR
+            else:
+                code = api.NOT_FOUND
+
+        r = api.build_response(response, code)
+        with api.stage('encode'):
+            data = codec.dumps(r)
+        context.update(r)
+        scoring.finish_deadline(deadline)
+        tracing.finish(trace)
+        context["timings"] = trace.timings()
+        logging.info(context)
+        method = context.get("method", "unknown")
+        api.REQUESTS.inc((method, str(code)))
+        api.REQUEST_LATENCY.observe(trace.duration, (method,))
+        return code, data, [("X-Request-ID", trace.request_id), ("Server-Timing", trace.server_timing())]
+
+
+async def serve(opts):
+    store = scoring.AsyncScoreStore(**api.STORE_CONFIG)
+    server = AsyncHTTPServer(store, "localhost", opts.port, backlog=opts.backlog)
+    api.register_store_metrics(lambda: server.store)
+    logging.info("Starting asyncio server at %s", opts.port)
+    try:
+        await server.serve_forever()
+    finally:
+        await store.close()
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-b", "--backlog", action="store", type=int, default=1024)
+    logs.add_options(op)
+    tracing.add_options(op)
+    (opts, args) = op.parse_args()
+    logs.setup_from_options(opts)
+    tracing.setup_from_options(opts)
+    try:
+        asyncio.run(serve(opts))
+    except KeyboardInterrupt:
+        pass
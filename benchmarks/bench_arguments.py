@@ -0,0 +1,46 @@
+import hashlib
+import json
+
+import api
+from benchmarks.utils import measure_time, report
+
+SIZES = [10, 100, 1000, 10000, 100000]
+
+
+def make_request(size):
+    request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+               "arguments": {"client_ids": list(range(size)), "date": "20.07.2017"}}
+    request["token"] = hashlib.sha512((request["account"] + request["login"] + api.SALT).encode('UTF-8')).hexdigest()
+    return request
+
+
+def json_round_trip(request):
+    # validation used before: encode and decode the whole payload
+    return lambda: json.loads(json.dumps(request))
+
+
+def structural_walk(request):
+    return lambda: api.ArgumentsField.is_json(request["arguments"])
+
+
+def parse_method_request(request):
+    def run():
+        method_request = api.MethodRequest.from_dict(request)
+        method_request.validate()
+        arguments = api.ClientsInterestsRequest.from_dict(method_request.arguments)
+        arguments.validate()
+    return run
+
+
+def main():
+    for size in SIZES:
+        request = make_request(size)
+        number = max(1, 100000 // size)
+        report('clients_interests size={}'.format(size),
+               round_trip_us=measure_time(json_round_trip(request), number),
+               walk_us=measure_time(structural_walk(request), number),
+               method_request_us=measure_time(parse_method_request(request), number))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+
+import fakeredis
+from mock import patch
+
+import api
+import scoring
+from benchmarks.utils import report
+from server import ThreadPoolHTTPServer
+
+REQUESTS = 2000
+CLIENTS = [1, 8]
+
+
+def make_body():
+    request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+               "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+    request["token"] = hashlib.sha512((request["account"] + request["login"] + api.SALT).encode('UTF-8')).hexdigest()
+    return json.dumps(request)
+
+
+def post(connection, body):
+    connection.request('POST', '/method', body=body)
+    response = connection.getresponse()
+    response.read()
+    return response
+
+
+def new_connection_per_request(address, body, number):
+    for _ in range(number):
+        connection = HTTPConnection(*address)
+        post(connection, body)
+        connection.close()
+
+
+def keep_alive(address, body, number):
+    connection = HTTPConnection(*address)
+    for _ in range(number):
+        if post(connection, body).getheader('Connection') == 'close':
+            connection.close()
+    connection.close()
+
+
+def requests_per_second(client, address, body, clients):
+    number = REQUESTS // clients
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(lambda _: client(address, body, number), range(clients)))
+    return number * clients / (time.perf_counter() - started)
+
+
+def main():
+    with patch('scoring.ScoreStore.create_store', return_value=fakeredis.FakeStrictRedis()):
+        store = scoring.ScoreStore()
+    with patch.object(api.MainHTTPHandler, 'store', store), \
+            patch.object(api.MainHTTPHandler, 'log_message', lambda *args: None), \
+            patch('api.logging.info'):
+        server = ThreadPoolHTTPServer(('localhost', 0), api.MainHTTPHandler, workers=8)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        body = make_body()
+        for clients in CLIENTS:
+            report('online_score clients={}'.format(clients),
+                   new_connection_rps=requests_per_second(new_connection_per_request, server.server_address, body,
+                                                          clients),
+                   keep_alive_rps=requests_per_second(keep_alive, server.server_address, body, clients))
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
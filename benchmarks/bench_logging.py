@@ -0,0 +1,34 @@
+import logging
+import os
+import tempfile
+
+import logs
+from benchmarks.utils import measure_time, report
+
+BODY = b'{"account": "horns&hoofs", "login": "h&f", "method": "clients_interests", "arguments": {}}'
+CONTEXT = {"request_id": "0" * 32, "nclients": 1000, "code": 200,
+           "response": {str(cid): ["cars", "pets"] for cid in range(1000)}}
+SETUPS = [
+    ('text', {}),
+    ('json', {'json_format': True}),
+    ('text_queue', {'queue_size': 100000}),
+    ('json_queue', {'json_format': True, 'queue_size': 100000}),
+]
+
+
+def log_request():
+    logging.info("%s: %s %s", "/method", BODY, CONTEXT["request_id"])
+    logging.info(CONTEXT)
+
+
+def main():
+    # time spent in the request thread per request, the background writer is not counted
+    with tempfile.TemporaryDirectory() as directory:
+        for name, options in SETUPS:
+            handler = logs.setup(os.path.join(directory, name + '.log'), **options)
+            report(name, us=measure_time(log_request, number=2000))
+            handler.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import contextlib
+import json
+import threading
+from http.client import HTTPConnection
+
+from mock import patch
+
+import api
+import metrics
+from benchmarks.bench_micro import METHOD_REQUEST, make_store
+from benchmarks.utils import measure_time, report
+from server import ThreadPoolHTTPServer
+
+ROUNDS = 10
+
+
+def method_handler(store):
+    return lambda: api.method_handler({"body": METHOD_REQUEST, "headers": {}}, {}, store)
+
+
+def http_request(connection):
+    body = json.dumps(METHOD_REQUEST)
+
+    def run():
+        connection.request('POST', '/method', body=body)
+        connection.getresponse().read()
+    return run
+
+
+def without_metrics():
+    stack = contextlib.ExitStack()
+    stack.enter_context(patch.object(metrics.Counter, 'inc', lambda *args: None))
+    stack.enter_context(patch.object(metrics.Histogram, 'observe', lambda *args: None))
+    return stack
+
+
+def compare(name, func, number):
+    # instrumented call against the same call with every observation patched out,
+    # the two are measured in turns so drift of the machine affects both alike
+    func()
+    instrumented, bare = [], []
+    for _ in range(ROUNDS):
+        instrumented.append(measure_time(func, number=number, repeat=1))
+        with without_metrics():
+            bare.append(measure_time(func, number=number, repeat=1))
+    instrumented, bare = min(instrumented), min(bare)
+    report(name, instrumented_us=instrumented, bare_us=bare, overhead_us=instrumented - bare,
+           overhead_percent=(instrumented - bare) / bare * 100)
+
+
+def main():
+    registry = metrics.Registry()
+    counter = registry.counter('calls_total', 'Calls', ('method', 'code'))
+    histogram = registry.histogram('call_seconds', 'Calls', ('stage',))
+    report('counter_inc', us=measure_time(lambda: counter.inc(('ONLINE_SCORE', '200'))))
+    report('histogram_observe', us=measure_time(lambda: histogram.observe(0.003, ('handler',))))
+
+    def timer():
+        with histogram.time(('handler',)):
+            pass
+    report('histogram_timer', us=measure_time(timer))
+
+    compare('method_handler', method_handler(make_store()), 2000)
+
+    # a whole request over a keep-alive connection, as a client of the threaded server sees it
+    with patch.object(api.MainHTTPHandler, 'store', make_store()), \
+            patch.object(api.MainHTTPHandler, 'log_message', lambda *args: None), \
+            patch('api.logging.info'):
+        server = ThreadPoolHTTPServer(('localhost', 0), api.MainHTTPHandler, workers=1)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        connection = HTTPConnection(*server.server_address)
+        with patch.object(api.MainHTTPHandler, 'max_keepalive_requests', 10 ** 9):
+            compare('http_request', http_request(connection), 500)
+        connection.close()
+        server.shutdown()
+        server.server_close()
+    report('render', us=measure_time(metrics.REGISTRY.render, number=1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import fakeredis
+from mock import patch
+
+import api
+import scoring
+from benchmarks.utils import measure_latencies, measure_peak_memory, summarize, report
+
+INTEREST_SIZES = [1, 10, 100, 1000]
+SCORE_ARGUMENTS = {"phone": "79175002040", "email": "stupnikov@otus.ru", "first_name": "Stanislav",
+                   "last_name": "Stupnikov", "birthday": "01.01.1990", "gender": 1}
+METHOD_REQUEST = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": SCORE_ARGUMENTS,
+                  "token": hashlib.sha512(("horns&hoofs" + "h&f" + api.SALT).encode('UTF-8')).hexdigest()}
+
+
+class Fields:
+    phone = api.PhoneField()
+    email = api.EmailField()
+    birthday = api.BirthDayField()
+    client_ids = api.ClientIDsField()
+
+
+def make_store():
+    with patch('scoring.ScoreStore.create_store', return_value=fakeredis.FakeStrictRedis()):
+        return scoring.ScoreStore()
+
+
+def field_validation():
+    fields = Fields()
+
+    def run():
+        fields.phone = "79175002040"
+        fields.email = "stupnikov@otus.ru"
+        fields.birthday = "01.01.1990"
+        fields.client_ids = [1, 2, 3, 4]
+    return run
+
+
+def method_request_from_dict():
+    return lambda: api.MethodRequest.from_dict(METHOD_REQUEST).validate()
+
+
+def check_auth(cached):
+    request = api.MethodRequest.from_dict(METHOD_REQUEST)
+
+    def run():
+        if not cached:
+            api.AUTH_CACHE.clear()
+        api.check_auth(request)
+    return run
+
+
+def get_score(store, hit):
+    counter = iter(range(10 ** 9))
+    if hit:
+        scoring.get_score(store, "79175002040", "stupnikov@otus.ru")
+        return lambda: scoring.get_score(store, "79175002040", "stupnikov@otus.ru")
+    # every call uses a phone that was not scored before
+    return lambda: scoring.get_score(store, str(next(counter)), "stupnikov@otus.ru")
+
+
+def get_interests(store, size):
+    cids = list(range(size))
+    for cid in cids[::2]:
+        store.redis_store.set("i:%s" % cid, json.dumps(["cars", "pets"]))
+    return lambda: scoring.get_interests_batch(store, cids)
+
+
+def benchmarks(store):
+    yield 'field_validation', field_validation(), 20000
+    yield 'method_request_from_dict', method_request_from_dict(), 20000
+    yield 'check_auth_cached', check_auth(True), 20000
+    yield 'check_auth_uncached', check_auth(False), 20000
+    yield 'get_score_hit', get_score(store, True), 5000
+    yield 'get_score_miss', get_score(store, False), 5000
+    for size in INTEREST_SIZES:
+        yield 'get_interests_batch_{}'.format(size), get_interests(store, size), max(50, 5000 // size)
+
+
+def run(scale=1.0, names=None):
+    results = {}
+    store = make_store()
+    for name, func, number in benchmarks(store):
+        if names and not any(part in name for part in names):
+            continue
+        func()
+        samples = measure_latencies(func, max(1, int(number * scale)))
+        results[name] = dict(summarize(samples), peak_memory_bytes=measure_peak_memory(func, 10))
+    return results
+
+
+def main():
+    for name, result in run().items():
+        report(name, ops_per_sec=result['ops_per_sec'], p50_us=result['p50_us'], p99_us=result['p99_us'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+import hashlib
+
+import api
+from benchmarks.utils import measure_time, measure_memory, report
+
+SCORE_ARGUMENTS = {"phone": "79175002040", "email": "stupnikov@otus.ru", "first_name": "Stanislav",
+                   "last_name": "Stupnikov", "birthday": "01.01.1990", "gender": 1}
+INTERESTS_ARGUMENTS = {"client_ids": [1, 2, 3, 4], "date": "20.07.2017"}
+METHOD_REQUEST = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": SCORE_ARGUMENTS,
+                  "token": hashlib.sha512(("horns&hoofs" + "h&f" + api.SALT).encode('UTF-8')).hexdigest()}
+
+
+def parse(request_class, arguments):
+    def run():
+        request = request_class.from_dict(arguments)
+        request.validate()
+        return request
+    return run
+
+
+def main():
+    for name, request_class, arguments in [
+        ('OnlineScoreRequest', api.OnlineScoreRequest, SCORE_ARGUMENTS),
+        ('ClientsInterestsRequest', api.ClientsInterestsRequest, INTERESTS_ARGUMENTS),
+        ('MethodRequest', api.MethodRequest, METHOD_REQUEST),
+    ]:
+        report(name,
+               us_per_request=measure_time(parse(request_class, arguments)),
+               bytes_per_request=measure_memory(parse(request_class, arguments)))
+
+
+if __name__ == '__main__':
+    main()
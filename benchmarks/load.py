@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from http.client import HTTPConnection
+from optparse import OptionParser
+
+import api
+from benchmarks.utils import summarize, report
+
+REQUESTS_FILE = os.path.join(os.path.dirname(__file__), 'requests.jsonl')
+
+
+def make_token(request):
+    if request.get("login") == api.ADMIN_LOGIN:
+        value = datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT
+    else:
+        value = request.get("account", "") + request.get("login", "") + api.SALT
+    return hashlib.sha512(value.encode('UTF-8')).hexdigest()
+
+
+def load_requests(path):
+    # one api request per line, requests without a token get a valid one, "path" defaults to /method
+    requests = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            path = request.pop("path", "/method")
+            request.setdefault("token", make_token(request))
+            requests.append((path, json.dumps(request).encode('UTF-8')))
+    return requests
+
+
+def client(address, requests, number, offset, samples, statuses):
+    connection = HTTPConnection(*address, timeout=30)
+    for num in range(number):
+        path, body = requests[(offset + num) % len(requests)]
+        started = time.perf_counter()
+        try:
+            connection.request('POST', path, body=body, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+            if response.getheader('Connection') == 'close':
+                connection.close()
+        except (OSError, ValueError):
+            connection.close()
+            status = 'error'
+        samples.append((time.perf_counter() - started) * 1e6)
+        statuses[status] = statuses.get(status, 0) + 1
+    connection.close()
+
+
+def run_load(address, requests, clients=8, total=5000):
+    # every client thread records into its own list and dict, they are merged after the threads finish
+    per_client = max(1, total // clients)
+    results = [([], {}) for _ in range(clients)]
+    threads = [threading.Thread(target=client, args=(address, requests, per_client, num * per_client) + results[num])
+               for num in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    samples, statuses = [], {}
+    for client_samples, client_statuses in results:
+        samples.extend(client_samples)
+        for status, count in client_statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+    result = summarize(samples, elapsed)
+    result['statuses'] = {str(status): count for status, count in sorted(statuses.items(), key=str)}
+    result['errors'] = statuses.get('error', 0)
+    return result
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def peak_rss(pid):
+    # linux only, the high water mark of the resident set of the server process
+    try:
+        with open('/proc/%s/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+def wait_for_port(address, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(address, timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('server at %s:%s did not start' % address)
+
+
+def serve(port, workers):
+    # api server backed by an in-process fakeredis with interests for every fifth client id
+    import fakeredis
+    from mock import patch
+
+    import scoring
+    from server import ThreadPoolHTTPServer
+
+    with patch('scoring.ScoreStore.create_store', return_value=fakeredis.FakeStrictRedis()):
+        store = scoring.ScoreStore()
+    for cid in range(0, 1000, 5):
+        store.redis_store.set("i:%s" % cid, json.dumps(["cars", "pets"]))
+    api.MainHTTPHandler.store = store
+    api.MainHTTPHandler.log_message = lambda *args: None
+    server = ThreadPoolHTTPServer(('localhost', port), api.MainHTTPHandler, workers=workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+def run(requests_file=REQUESTS_FILE, address=None, clients=8, total=5000, workers=8):
+    requests = load_requests(requests_file)
+    process = None
+    if address is None:
+        address = ('localhost', free_port())
+        process = subprocess.Popen([sys.executable, '-m', 'benchmarks.load', '--serve', '--port', str(address[1]),
+                                    '--workers', str(workers)], stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(address)
+        result = run_load(address, requests, clients, total)
+        if process is not None:
+            result['server_peak_rss_bytes'] = peak_rss(process.pid)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    return {'load_' + os.path.splitext(os.path.basename(requests_file))[0]: result}
+
+
+def main():
+    op = OptionParser()
+    op.add_option("--serve", action="store_true", default=False)
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-w", "--workers", action="store", type=int, default=8)
+    op.add_option("--url", action="store", default=None, help="host:port of a running server")
+    op.add_option("-r", "--requests", action="store", default=REQUESTS_FILE)
+    op.add_option("-c", "--clients", action="store", type=int, default=8)
+    op.add_option("-n", "--total", action="store", type=int, default=5000)
+    (opts, args) = op.parse_args()
+    if opts.serve:
+        serve(opts.port, opts.workers)
+        return
+
+    address = None
+    if opts.url:
+        host, port = opts.url.rsplit(':', 1)
+        address = (host, int(port))
+    for name, result in run(opts.requests, address, opts.clients, opts.total, opts.workers).items():
+        report(name, rps=result['ops_per_sec'], p50_us=result['p50_us'], p95_us=result['p95_us'],
+               p99_us=result['p99_us'], errors=result['errors'])
+        print(json.dumps(result['statuses']))
+
+
+if __name__ == '__main__':
+    main()
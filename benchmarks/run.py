@@ -0,0 +1,55 @@
+import json
+import platform
+import sys
+import time
+from optparse import OptionParser
+
+from benchmarks import bench_micro, load
+from benchmarks.utils import compare, report
+
+
+def main():
+    op = OptionParser(usage="%prog [options]")
+    op.add_option("-o", "--output", action="store", default=None, help="write results as json to this file")
+    op.add_option("-b", "--baseline", action="store", default=None, help="compare with results of an earlier run")
+    op.add_option("-t", "--tolerance", action="store", type=float, default=0.1)
+    op.add_option("-s", "--scale", action="store", type=float, default=1.0, help="multiplier of iteration counts")
+    op.add_option("-f", "--filter", action="append", default=None, help="run micro-benchmarks with this in name")
+    op.add_option("--load", action="store_true", default=False, help="also run the end-to-end load test")
+    op.add_option("--url", action="store", default=None, help="host:port of a running server for the load test")
+    op.add_option("-r", "--requests", action="store", default=load.REQUESTS_FILE)
+    op.add_option("-c", "--clients", action="store", type=int, default=8)
+    op.add_option("-n", "--total", action="store", type=int, default=5000)
+    (opts, args) = op.parse_args()
+
+    results = bench_micro.run(opts.scale, opts.filter)
+    if opts.load:
+        address = None
+        if opts.url:
+            host, port = opts.url.rsplit(':', 1)
+            address = (host, int(port))
+        results.update(load.run(opts.requests, address, opts.clients, opts.total))
+
+    for name, result in results.items():
+        report(name, ops_per_sec=result['ops_per_sec'], p50_us=result['p50_us'], p95_us=result['p95_us'],
+               p99_us=result['p99_us'])
+
+    output = {
+        'meta': {'python': platform.python_version(), 'platform': platform.platform(), 'time': time.time()},
+        'results': results,
+    }
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, opts.tolerance)
+        if regressions:
+            print('Regressions: %s' % ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import gc
+import time
+import tracemalloc
+
+
+def measure_time(func, number=10000, repeat=5):
+    # best of several runs, in microseconds per call
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - started) / number * 1e6)
+    return min(timings)
+
+
+def measure_memory(factory, number=10000):
+    # bytes allocated per object that is still alive after creation
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objects = [factory() for _ in range(number)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del objects
+    return allocated / number
+
+
+def report(name, **values):
+    print('{:<40} {}'.format(name, '  '.join('{}={:.2f}'.format(key, value) for key, value in values.items())))
+
+
+def measure_latencies(func, number=10000):
+    # wall time of every call, in microseconds
+    samples = []
+    for _ in range(number):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1e6)
+    return samples
+
+
+def measure_peak_memory(func, number=100):
+    # peak of memory traced while the calls run, tracing slows them down so it is a separate run
+    gc.collect()
+    tracemalloc.start()
+    for _ in range(number):
+        func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(samples, elapsed=None):
+    ordered = sorted(samples)
+    elapsed = elapsed if elapsed is not None else sum(samples) / 1e6
+    return {
+        'count': len(samples),
+        'ops_per_sec': len(samples) / elapsed if elapsed else 0.0,
+        'mean_us': sum(samples) / len(samples),
+        'p50_us': percentile(ordered, 0.50),
+        'p95_us': percentile(ordered, 0.95),
+        'p99_us': percentile(ordered, 0.99),
+        'max_us': ordered[-1],
+    }
+
+
+def compare(results, baseline, tolerance=0.1):
+    # names whose p50 latency grew or throughput dropped by more than tolerance against the baseline
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        slower = result['p50_us'] / base['p50_us'] if base['p50_us'] else 1.0
+        throughput = result['ops_per_sec'] / base['ops_per_sec'] if base['ops_per_sec'] else 1.0
+        report(name, p50_ratio=slower, throughput_ratio=throughput)
+        if slower > 1 + tolerance or throughput < 1 - tolerance:
+            regressions.append(name)
+    return regressions
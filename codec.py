@@ -0,0 +1,158 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class StreamedObject:
+    # json object whose (key, value) pairs are produced while it is being encoded
+    def __init__(self, items):
+        self.items = items
+
+
+class Codec:
+    # every codec produces compact utf-8 json and parses documents to the same values,
+    # only the spelling of floats in exponent notation and of nan and infinity differs
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def dumps_key(self, key):
+        if isinstance(key, str):
+            return self.dumps(key)
+        return self.dumps({key: None})[1:-len(b':null}')]
+
+    def iter_encode(self, obj, chunk_size=64 * 1024, depth=2):
+        # yields the encoding of obj in chunks of about chunk_size bytes,
+        # containers up to depth levels are encoded item by item instead of as one string
+        buffer, size = [], 0
+        for part in self.encode_parts(obj, depth):
+            buffer.append(part)
+            size += len(part)
+            if size >= chunk_size:
+                yield b''.join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield b''.join(buffer)
+
+    def encode_parts(self, obj, depth):
+        if isinstance(obj, StreamedObject):
+            yield from self.encode_items(obj.items, depth)
+        elif depth and isinstance(obj, dict):
+            yield from self.encode_items(obj.items(), depth)
+        elif depth and isinstance(obj, (list, tuple)):
+            yield b'['
+            for num, value in enumerate(obj):
+                if num:
+                    yield b','
+                yield from self.encode_parts(value, depth - 1)
+            yield b']'
+        else:
+            yield self.dumps(obj)
+
+    def encode_items(self, items, depth):
+        yield b'{'
+        for num, (key, value) in enumerate(items):
+            if num:
+                yield b','
+            yield self.dumps_key(key) + b':'
+            yield from self.encode_parts(value, max(depth - 1, 0))
+        yield b'}'
+
+
+STDLIB_ENCODER = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+DIGITS = bytes.maketrans(b'123456789', b'000000000')
+LONG_NUMBER = b'0' * 19
+
+
+def stdlib_dumps(obj):
+    return STDLIB_ENCODER.encode(obj).encode('UTF-8')
+
+
+def exact_loads(fast_loads):
+    # the fast parsers turn integers beyond 64 bits into floats and reject nan or lone surrogates,
+    # such documents are left to the standard library
+    def loads(data):
+        raw = data.encode('UTF-8', 'surrogatepass') if isinstance(data, str) else bytes(data)
+        if LONG_NUMBER not in raw.translate(DIGITS):
+            try:
+                return fast_loads(data)
+            except ValueError:
+                pass
+        return json.loads(data)
+
+    return loads
+
+
+def exact_dumps(fast_dumps):
+    # integers beyond 64 bits can only be encoded by the standard library
+    def dumps(obj):
+        try:
+            return fast_dumps(obj)
+        except (TypeError, OverflowError):
+            return stdlib_dumps(obj)
+
+    return dumps
+
+
+def stdlib_codec():
+    return Codec('json', json.loads, stdlib_dumps)
+
+
+def orjson_codec():
+    return Codec('orjson', exact_loads(orjson.loads),
+                 exact_dumps(lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)))
+
+
+def ujson_codec():
+    return Codec('ujson', exact_loads(ujson.loads),
+                 exact_dumps(lambda obj: ujson.dumps(obj, ensure_ascii=False,
+                                                     escape_forward_slashes=False).encode('UTF-8')))
+
+
+CODECS = {
+    'orjson': (lambda: orjson is not None, orjson_codec),
+    'ujson': (lambda: ujson is not None, ujson_codec),
+    'json': (lambda: True, stdlib_codec),
+}
+
+
+def select_codec(name=None):
+    if name is not None:
+        available, factory = CODECS[name]
+        if not available():
+            raise ValueError('{} is not installed'.format(name))
+        return factory()
+
+    for available, factory in CODECS.values():
+        if available():
+            return factory()
+
+
+default_codec = select_codec()
+
+
+def use(name=None):
+    global default_codec
+    default_codec = select_codec(name)
+    return default_codec
+
+
+def loads(data):
+    return default_codec.loads(data)
+
+
+def dumps(obj):
+    return default_codec.dumps(obj)
+
+
+def iter_encode(obj, chunk_size=64 * 1024):
+    return default_codec.iter_encode(obj, chunk_size)
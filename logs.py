@@ -0,0 +1,218 @@
+import logging
+import os
+import queue
+import threading
+import weakref
+
+import codec
+import metrics
+
+TEXT_FORMAT = '[%(asctime)s] %(levelname).1s %(message)s'
+DATE_FORMAT = '%Y.%m.%d %H:%M:%S'
+
+DROPPED = metrics.REGISTRY.counter('logs_dropped_total', 'Log records dropped because the log queue was full')
+
+
+def reset_after_fork(obj):
+    # a forked child starts with only the forking thread, so queues and locks the object shares with
+    # threads of the parent are replaced before anything runs in the child
+    ref = weakref.ref(obj)
+
+    def after_in_child():
+        alive = ref()
+        if alive is not None:
+            alive.after_fork()
+
+    os.register_at_fork(after_in_child=after_in_child)
+
+
+class BackgroundQueue:
+    # bounded queue drained by a background thread that runs target until it takes the None put by close.
+    # The thread is started by the first item, so a forked worker gets its own. When the queue is full,
+    # policy decides whether the new item or the oldest queued one is dropped
+    DROP_NEW = 'drop_new'
+    DROP_OLDEST = 'drop_oldest'
+
+    def __init__(self, target, name, max_size=10000, policy=DROP_NEW):
+        self.target = target
+        self.name = name
+        self.queue = queue.Queue(max_size)
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.queued = 0
+        self.dropped = 0
+        reset_after_fork(self)
+
+    def after_fork(self):
+        # items queued by the parent are handled by the parent
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.target, name=self.name, daemon=True)
+                self.thread.start()
+
+    def put(self, item):
+        # returns the number of items dropped, the new one or the oldest ones that made room for it
+        if self.thread is None or self.pid != os.getpid():
+            self.start()
+        dropped = 0
+        while True:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                if self.policy != self.DROP_OLDEST:
+                    return self.count(dropped + 1, queued=False)
+                try:
+                    oldest = self.queue.get_nowait()
+                except queue.Empty:
+                    continue
+                if oldest is None:
+                    # a stop marker is never dropped, the new item is dropped instead
+                    self.queue.put(oldest)
+                    return self.count(dropped + 1, queued=False)
+                # another producer may take the freed slot first, then the next oldest item is dropped too
+                dropped += 1
+                continue
+            return self.count(dropped, queued=True)
+
+    def count(self, dropped, queued):
+        with self.lock:
+            self.dropped += dropped
+            self.queued += queued
+        return dropped
+
+    def close(self, timeout=5):
+        # items queued before close are handled, a later item starts a new thread
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is None or self.pid != os.getpid():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+
+def truncate(value, max_length):
+    if max_length is None or len(value) <= max_length:
+        return value
+    return '%s...<%d more>' % (value[:max_length], len(value) - max_length)
+
+
+class TextFormatter(logging.Formatter):
+    # messages longer than max_length are cut, the number of cut characters is kept
+    def __init__(self, fmt=TEXT_FORMAT, datefmt=DATE_FORMAT, max_length=4096):
+        super(TextFormatter, self).__init__(fmt, datefmt)
+        self.max_length = max_length
+
+    def formatMessage(self, record):
+        record.message = truncate(record.message, self.max_length)
+        return super(TextFormatter, self).formatMessage(record)
+
+
+class JsonFormatter(logging.Formatter):
+    # one json object per line, a dict logged without arguments becomes fields of the object,
+    # any other message is put in the message field
+    def __init__(self, datefmt=DATE_FORMAT, max_length=4096):
+        super(JsonFormatter, self).__init__(datefmt=datefmt)
+        self.max_length = max_length
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record, self.datefmt), "level": record.levelname}
+        if isinstance(record.msg, dict) and not record.args:
+            fields = record.msg
+        else:
+            fields = {"message": record.getMessage()}
+        for name, value in fields.items():
+            entry[str(name)] = self.format_field(value)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return codec.dumps(entry).decode('UTF-8')
+
+    def format_field(self, value):
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        if isinstance(value, (bytes, bytearray)):
+            value = value.decode('UTF-8', 'replace')
+        if isinstance(value, str):
+            return truncate(value, self.max_length)
+        try:
+            data = codec.dumps(value)
+        except Exception:
+            return truncate(repr(value), self.max_length)
+        if len(data) <= self.max_length:
+            return value
+        return truncate(data.decode('UTF-8', 'replace'), self.max_length)
+
+
+class AsyncLogHandler(logging.Handler):
+    # records are put in a bounded queue and formatted and written by a background thread,
+    # so requests never wait for the log file. Messages are formatted only there, the objects
+    # passed as message and arguments must not be changed after they are logged
+    DROP_NEW = BackgroundQueue.DROP_NEW
+    DROP_OLDEST = BackgroundQueue.DROP_OLDEST
+
+    def __init__(self, target, max_size=10000, policy=DROP_NEW):
+        super(AsyncLogHandler, self).__init__()
+        self.target = target
+        self.background = BackgroundQueue(self.run, 'log-writer', max_size, policy)
+
+    @property
+    def dropped(self):
+        return self.background.dropped
+
+    def emit(self, record):
+        dropped = self.background.put(record)
+        if dropped:
+            DROPPED.inc(amount=dropped)
+
+    def run(self):
+        while True:
+            record = self.background.queue.get()
+            if record is None:
+                break
+            self.target.handle(record)
+
+    def close(self, timeout=5):
+        self.background.close(timeout)
+        self.target.close()
+        super(AsyncLogHandler, self).close()
+
+
+def add_options(op):
+    op.add_option("--log-format", action="store", choices=["text", "json"], default="text")
+    op.add_option("--log-queue", action="store", type=int, default=0,
+                  help="write log records from a background thread through a queue of this size")
+    op.add_option("--log-overflow", action="store", choices=[AsyncLogHandler.DROP_NEW, AsyncLogHandler.DROP_OLDEST],
+                  default=AsyncLogHandler.DROP_NEW, help="record to drop when the log queue is full")
+    op.add_option("--log-max-length", action="store", type=int, default=4096,
+                  help="longer messages and json fields are truncated")
+
+
+def setup_from_options(opts):
+    return setup(opts.log, json_format=opts.log_format == "json", queue_size=opts.log_queue,
+                 policy=opts.log_overflow, max_length=opts.log_max_length)
+
+
+def setup(filename=None, level=logging.INFO, json_format=False, queue_size=0, policy=AsyncLogHandler.DROP_NEW,
+          max_length=4096):
+    handler = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    handler.setFormatter(JsonFormatter(max_length=max_length) if json_format else TextFormatter(max_length=max_length))
+    if queue_size:
+        handler = AsyncLogHandler(handler, queue_size, policy)
+
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+        old_handler.close()
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
@@ -0,0 +1,163 @@
+import bisect
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in pairs)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+    def collect(self):
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in sorted(values):
+            yield '%s%s %s' % (self.name, format_labels(self.labelnames, labels), format_value(value))
+
+
+class Histogram:
+    # counts are kept per bucket and made cumulative only when the metrics are rendered
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def get(self, labels=()):
+        series = self.values.get(labels)
+        return (0, 0.0) if series is None else (series[2], series[1])
+
+    def time(self, labels=()):
+        return Timer(self, labels)
+
+    def collect(self):
+        with self.lock:
+            values = [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self.values.items()]
+        for labels, (counts, total, count) in sorted(values):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield '%s_bucket%s %s' % (self.name, format_labels(self.labelnames, labels,
+                                                                   [('le', format_value(bound))]), cumulative)
+            yield '%s_sum%s %s' % (self.name, format_labels(self.labelnames, labels), repr(total))
+            yield '%s_count%s %s' % (self.name, format_labels(self.labelnames, labels), count)
+
+
+class Collector:
+    # samples of values kept elsewhere, callback returns (label values, value) pairs when the metrics are rendered
+    def __init__(self, name, documentation, callback, labelnames=(), kind='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def collect(self):
+        for labels, value in sorted(self.callback()):
+            yield '%s%s %s' % (self.name, format_labels(self.labelnames, labels), format_value(value))
+
+
+class Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.started, self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        # registering a name twice returns the metric created first, so modules can be reloaded
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if existing.kind != metric.kind:
+                    raise ValueError('%s is already registered as %s' % (metric.name, existing.kind))
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def collector(self, name, documentation, callback, labelnames=(), kind='gauge'):
+        # a collector registered again reads its samples from the new callback
+        collector = self.register(Collector(name, documentation, callback, labelnames, kind))
+        collector.callback = callback
+        return collector
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            samples = list(metric.collect())
+            if not samples:
+                continue
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
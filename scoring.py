@@ -1,25 +1,691 @@
+import asyncio
+import bisect
+import collections
+import contextvars
 import hashlib
-import json
+import itertools
+import queue
+import random
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import redis
+import redis.asyncio
 
+import codec
+import logs
+import metrics
+import tracing
 
-class ScoreStore:
-    @classmethod
-    def create_store(cls, host='localhost', port=6379,
-                     socket_timeout=5,
-                     socket_connect_timeout=5):
-        return redis.Redis(host=host, port=port, socket_timeout=socket_timeout,
-                           socket_connect_timeout=socket_connect_timeout)
 
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def queue_with_ttl(pipeline, keys):
+    # values and their remaining ttls in milliseconds are read in one round trip
+    pipeline.mget(keys)
+    for key in keys:
+        pipeline.pttl(key)
+    return pipeline
+
+
+def pair_with_ttl(results):
+    values, *ttls = results
+    return list(zip(values, ttls))
+
+
+class LocalCache:
+    # in-process LRU of cache values bounded by number of entries and their size in bytes,
+    # values are kept encoded the same way redis returns them
+    def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def encode(value):
+        if isinstance(value, bytes):
+            return value
+        if isinstance(value, str):
+            return value.encode('UTF-8')
+        return repr(value).encode('UTF-8')
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                self.remove(key)
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def get_many(self, keys):
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set(self, key, value, cache_time):
+        value = self.encode(value)
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            # a value too large to keep still replaces the older one, which must not be read after it
+            if len(key) + len(value) > self.max_bytes:
+                return
+
+            self.entries[key] = (value, time.monotonic() + cache_time)
+            self.size += len(key) + len(value)
+
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        value, _ = self.entries.pop(key)
+        self.size -= len(key) + len(value)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'entries': len(self.entries),
+                'bytes': self.size,
+            }
+
+
+class CircuitOpenError(redis.ConnectionError):
+    pass
+
+
+def is_pool_exhausted(error):
+    # blocking pools raise a plain connection error when no connection frees up within pool_timeout
+    return str(error) == 'No connection available.'
+
+
+REDIS_LATENCY = metrics.REGISTRY.histogram('scoring_redis_call_seconds', 'Latency of redis calls by outcome',
+                                           ('operation', 'result'))
+REDIS_RETRIES = metrics.REGISTRY.counter('scoring_redis_retries_total', 'Redis calls retried after a connection error',
+                                         ('operation',))
+SCORE_CACHE = metrics.REGISTRY.counter('scoring_score_cache_total', 'Score cache lookups by result', ('result',))
+SINGLE_FLIGHT_COALESCED = metrics.REGISTRY.counter('scoring_single_flight_coalesced_total',
+                                                   'Lookups that waited for the same lookup already in flight')
+
+
+class RedisCallTimer:
+    # one attempt of a redis call, rejected calls are the ones the open circuit breaker did not let through,
+    # the attempt is also a span of the current request trace
+    __slots__ = ('operation', 'started')
+
+    def __init__(self, operation):
+        self.operation = operation
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            result = 'ok'
+        elif issubclass(exc_type, CircuitOpenError):
+            result = 'rejected'
+        else:
+            result = 'error'
+        duration = time.perf_counter() - self.started
+        REDIS_LATENCY.observe(duration, (self.operation, result))
+        trace = tracing.current()
+        if trace is not None:
+            trace.add('redis.' + self.operation, self.started, duration)
+
+
+# the end of the request being served, all redis calls of the request share it including their retries
+REQUEST_DEADLINE = contextvars.ContextVar('request_deadline', default=None)
+
+
+def start_deadline(timeout):
+    return REQUEST_DEADLINE.set(time.monotonic() + timeout)
+
+
+def finish_deadline(token):
+    REQUEST_DEADLINE.reset(token)
+
+
+def time_left(deadline):
+    # no attempt is started once the deadline has passed
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise redis.TimeoutError('Deadline exceeded')
+    return remaining
+
+
+class RetryPolicy:
+    # exponential backoff with full jitter, limited both by attempts and by the total time of a call
+    def __init__(self, max_attempts=5, backoff=0.1, max_backoff=1.0, deadline=3.0):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        # a call made while serving a request can not outlive the request
+        deadline = time.monotonic() + self.deadline
+        request_deadline = REQUEST_DEADLINE.get()
+        return deadline if request_deadline is None else min(deadline, request_deadline)
+
+    def next_delay(self, attempt_num, deadline):
+        if attempt_num + 1 >= self.max_attempts:
+            return None
+
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt_num))
+        if time.monotonic() + delay > deadline:
+            return None
+
+        with self.lock:
+            self.retries += 1
+        return delay
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, recovery_timeout=10, half_open_probes=1):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_probes = half_open_probes
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probes = 0
+        self.trips = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # open breaker rejects calls until recovery timeout passes,
+        # then a limited number of probes decides whether it closes again
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.recovery_timeout:
+                    self.rejected += 1
+                    raise CircuitOpenError('Circuit breaker is open')
+                self.state = self.HALF_OPEN
+                self.probes = 0
+
+            if self.state == self.HALF_OPEN:
+                if self.probes >= self.half_open_probes:
+                    self.rejected += 1
+                    raise CircuitOpenError('Circuit breaker is half open')
+                self.probes += 1
+                return True
+            return False
+
+    def call(self, func, *args, **kwargs):
+        probe = self.acquire()
+        succeeded = None
+        try:
+            result = func(*args, **kwargs)
+            succeeded = True
+            return result
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            # an exhausted local pool says nothing about redis itself
+            succeeded = None if is_pool_exhausted(e) else False
+            raise
+        except Exception:
+            # redis has answered, only connection failures count against the breaker
+            succeeded = True
+            raise
+        finally:
+            self.record(succeeded, probe)
+
+    async def call_async(self, func, *args, **kwargs):
+        probe = self.acquire()
+        succeeded = None
+        try:
+            result = await func(*args, **kwargs)
+            succeeded = True
+            return result
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            succeeded = None if is_pool_exhausted(e) else False
+            raise
+        except Exception:
+            succeeded = True
+            raise
+        finally:
+            self.record(succeeded, probe)
+
+    def record(self, succeeded, probe):
+        # a call without an outcome, cancelled or never sent, gives its half open probe back
+        if succeeded:
+            self.record_success()
+        elif succeeded is not None:
+            self.record_failure()
+        elif probe:
+            self.release()
+
+    def release(self):
+        with self.lock:
+            if self.state == self.HALF_OPEN and self.probes > 0:
+                self.probes -= 1
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.trips += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'trips': self.trips,
+                'rejected': self.rejected,
+            }
+
+
+# the connection state attribute get_connection_count reports every count with
+CONNECTION_STATE = 'db.client.connection.state'
+CONNECTION_IDLE = 'idle'
+CONNECTION_USED = 'used'
+
+
+def pool_stats(pool):
+    # redis reports idle and in use connections of a pool through get_connection_count, versions
+    # without it are read from the pool internals when they are there
+    if hasattr(pool, 'get_connection_count'):
+        counts = collections.Counter()
+        for count, attributes in pool.get_connection_count():
+            counts[attributes.get(CONNECTION_STATE)] += count
+        idle, in_use = counts[CONNECTION_IDLE], counts[CONNECTION_USED]
+    elif hasattr(pool, '_connections'):
+        idle = sum(1 for connection in list(getattr(pool.pool, 'queue', ())) if connection is not None)
+        in_use = len(pool._connections) - idle
+    else:
+        idle = len(getattr(pool, '_available_connections', ()))
+        in_use = len(getattr(pool, '_in_use_connections', ()))
+    return {
+        'max_connections': getattr(pool, 'max_connections', None),
+        'created': idle + in_use,
+        'in_use': in_use,
+        'idle': idle,
+    }
+
+
+class ReplicaSet:
+    # writes go to the primary, reads are spread over the replicas in turn, a replica that fails
+    # is skipped for recovery_timeout seconds and its reads fail over to the next replica or the primary.
+    # Calls to the shard go through its own circuit breaker, so a shard that is down does not fail the others
+    def __init__(self, primary, replicas=(), recovery_timeout=5, circuit_breaker=None):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.recovery_timeout = recovery_timeout
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.down_until = [0.0] * len(self.replicas)
+        self.counter = itertools.count()
+        self.failovers = 0
+
+    def read_candidates(self):
+        now = time.monotonic()
+        start = next(self.counter)
+        candidates = []
+        for offset in range(len(self.replicas)):
+            index = (start + offset) % len(self.replicas)
+            if self.down_until[index] <= now:
+                candidates.append(index)
+        return candidates
+
+    def mark_down(self, index):
+        self.down_until[index] = time.monotonic() + self.recovery_timeout
+        self.failovers += 1
+
+    def read(self, operation):
+        for index in self.read_candidates():
+            try:
+                return operation(self.replicas[index])
+            except (redis.ConnectionError, redis.TimeoutError):
+                self.mark_down(index)
+        return operation(self.primary)
+
+    async def read_async(self, operation):
+        for index in self.read_candidates():
+            try:
+                return await operation(self.replicas[index])
+            except (redis.ConnectionError, redis.TimeoutError):
+                self.mark_down(index)
+        return await operation(self.primary)
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'replicas': len(self.replicas),
+            'down': [index for index, until in enumerate(self.down_until) if until > now],
+            'failovers': self.failovers,
+        }
+
+
+class HashRing:
+    # consistent hashing of keys to shards, every shard owns vnodes points on the ring,
+    # so adding a shard moves only the keys between its points and their predecessors
+    def __init__(self, shards, vnodes=160):
+        self.shards = shards
+        points = sorted((self.position('%s#%s' % (name, num)), name) for name in shards for num in range(vnodes))
+        self.positions = [position for position, _ in points]
+        self.names = [name for _, name in points]
+
+    @staticmethod
+    def position(key):
+        return int.from_bytes(hashlib.md5(key.encode('UTF-8')).digest()[:8], 'big')
+
+    def get_name(self, key):
+        if len(self.shards) == 1:
+            return next(iter(self.shards))
+        return self.names[bisect.bisect(self.positions, self.position(key)) % len(self.names)]
+
+    def get_shard(self, key):
+        return self.shards[self.get_name(key)]
+
+    def group(self, keys):
+        if len(self.shards) == 1:
+            return {next(iter(self.shards.values())): list(keys)}
+
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.get_shard(key), []).append(key)
+        return groups
+
+
+class WriteBehindQueue:
+    # cache writes are queued and sent in pipelines by a background thread, so requests never wait for them,
+    # several writes of a key that meet in one batch are coalesced into the last one
+    DROP_NEW = logs.BackgroundQueue.DROP_NEW
+    DROP_OLDEST = logs.BackgroundQueue.DROP_OLDEST
+
+    def __init__(self, write, max_size=10000, batch_size=500, flush_interval=0.05, policy=DROP_NEW):
+        self.write = write
+        self.background = logs.BackgroundQueue(self.run, 'write-behind', max_size, policy)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.coalesced = 0
+        self.written = 0
+        self.failed = 0
+
+    def put(self, key, value, time_ms):
+        self.background.put((key, value, time_ms))
+
+    def count(self, name, value=1):
+        with self.background.lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            item = self.background.queue.get()
+            if item is None:
+                break
+
+            batch = {item[0]: item[1:]}
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.background.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopped = True
+                    break
+                if item[0] in batch:
+                    self.count('coalesced')
+                batch[item[0]] = item[1:]
+            self.flush(batch)
+
+    def flush(self, batch):
+        by_time = collections.defaultdict(dict)
+        for key, (value, time_ms) in batch.items():
+            by_time[time_ms][key] = value
+        for time_ms, values in by_time.items():
+            try:
+                self.write(values, time_ms)
+                self.count('written', len(values))
+            except Exception:
+                self.count('failed', len(values))
+
+    def close(self, timeout=5):
+        # writes queued before close are flushed, a later write starts a new flusher
+        self.background.close(timeout)
+
+    def stats(self):
+        background = self.background
+        with background.lock:
+            return {
+                'queued': background.queued,
+                'dropped': background.dropped,
+                'coalesced': self.coalesced,
+                'written': self.written,
+                'failed': self.failed,
+                'pending': background.queue.qsize(),
+            }
+
+
+class SingleFlight:
+    # concurrent calls with the same key wait for the first one and share its result or error,
+    # threads and asyncio tasks are tracked separately
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.tasks = {}
+        self.coalesced = 0
+
+    def do(self, key, func, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            SINGLE_FLIGHT_COALESCED.inc()
+            return call.result()
+
+        try:
+            result = func(*args)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    async def do_async(self, key, func, *args):
+        task = self.tasks.get(key)
+        if task is None:
+            task = self.tasks[key] = asyncio.ensure_future(func(*args))
+            task.add_done_callback(lambda _: self.tasks.pop(key, None) if self.tasks.get(key) is task else None)
+        else:
+            with self.lock:
+                self.coalesced += 1
+            SINGLE_FLIGHT_COALESCED.inc()
+        # a cancelled caller does not cancel the lookup the others are waiting for
+        return await asyncio.shield(task)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'coalesced': self.coalesced,
+                'in_flight': len(self.calls) + len(self.tasks),
+            }
+
+
+class BaseScoreStore:
     def __init__(self, host='localhost', port=6379,
                  socket_timeout=5,
-                 socket_connect_timeout=5, max_retry_attempt_count=5):
-        self.redis_store = self.create_store(host, port, socket_timeout, socket_connect_timeout)
-        self.max_retry_attempt_count = max_retry_attempt_count
+                 socket_connect_timeout=5, cache_max_connections=50, interests_max_connections=50,
+                 pool_timeout=2.0, socket_keepalive=True, health_check_interval=30, replicas=(),
+                 replica_recovery_timeout=5, shards=(), ring_vnodes=160, max_retry_attempt_count=5,
+                 retry_backoff=0.1, retry_max_backoff=1.0, retry_deadline=3.0, breaker_failure_threshold=5,
+                 breaker_recovery_timeout=10, batch_size=500, local_cache_size=0,
+                 local_cache_bytes=16 * 1024 * 1024, write_behind_size=0, write_behind_interval=0.05,
+                 write_behind_policy=WriteBehindQueue.DROP_NEW, negative_cache_size=0, negative_cache_ttl=60):
+        self.retry_policy = RetryPolicy(max_retry_attempt_count, retry_backoff, retry_max_backoff, retry_deadline)
+        self.batch_size = batch_size
+        self.local_cache = LocalCache(local_cache_size, local_cache_bytes) if local_cache_size else None
+        self.single_flight = SingleFlight()
+        # interests keys found missing are remembered for negative_cache_ttl seconds, so an id that
+        # gets interests meanwhile is seen without them until the entry expires
+        self.negative_cache = None
+        if negative_cache_size:
+            # entries hold only the short interests key
+            self.negative_cache = LocalCache(negative_cache_size, negative_cache_size * 64)
+        self.negative_cache_ttl = negative_cache_ttl
+
+        options = dict(socket_timeout=socket_timeout, socket_connect_timeout=socket_connect_timeout,
+                       pool_timeout=pool_timeout, socket_keepalive=socket_keepalive,
+                       health_check_interval=health_check_interval)
+        # without shards configured the single node from host, port and replicas holds every key
+        shards = shards or [{'host': host, 'port': port, 'replicas': replicas}]
+        cache_shards, interests_shards = {}, {}
+        for shard in shards:
+            name = '%s:%s' % (shard['host'], shard['port'])
+            # score cache and interests have their own pools, so a burst of one does not starve the other,
+            # but share the circuit breaker of their node
+            circuit_breaker = CircuitBreaker(breaker_failure_threshold, breaker_recovery_timeout)
+            cache_shards[name] = self.create_nodes(shard['host'], shard['port'], shard.get('replicas', ()),
+                                                   replica_recovery_timeout, circuit_breaker,
+                                                   max_connections=cache_max_connections, **options)
+            interests_shards[name] = self.create_nodes(shard['host'], shard['port'], shard.get('replicas', ()),
+                                                       replica_recovery_timeout, circuit_breaker,
+                                                       max_connections=interests_max_connections, **options)
+        self.cache_ring = HashRing(cache_shards, ring_vnodes)
+        self.interests_ring = HashRing(interests_shards, ring_vnodes)
+        # primaries and circuit breaker of the first shard, the only one unless sharding is configured
+        self.cache_store = next(iter(cache_shards.values())).primary
+        self.redis_store = next(iter(interests_shards.values())).primary
+        self.circuit_breaker = next(iter(interests_shards.values())).circuit_breaker
+        self.write_behind = None
+        if write_behind_size:
+            self.write_behind = self.create_write_behind(write_behind_size, write_behind_interval,
+                                                         write_behind_policy)
+
+    def is_known_absent(self, key):
+        return self.negative_cache is not None and self.negative_cache.get(key) is not None
+
+    def split_known_absent(self, keys):
+        if self.negative_cache is None:
+            return keys, {}
+        absent = self.negative_cache.get_many(keys)
+        return [key for key in keys if key not in absent], dict.fromkeys(absent)
+
+    def backfill(self, values):
+        # values read from redis are kept locally until their redis ttl runs out
+        result = {}
+        for key, (value, ttl_ms) in values.items():
+            if value is not None and ttl_ms > 0:
+                self.local_cache.set(key, value, ttl_ms / 1000.0)
+            result[key] = value
+        return result
+
+    def remember_absent(self, values):
+        if self.negative_cache is not None:
+            for key, value in values.items():
+                if value is None:
+                    self.negative_cache.set(key, b'', self.negative_cache_ttl)
+
+    def create_write_behind(self, max_size, flush_interval, policy):
+        # the asyncio store writes from the event loop and has no background writer
+        return None
+
+    def create_nodes(self, host, port, replicas, recovery_timeout, circuit_breaker, **options):
+        primary = self.create_store(host, port, **options)
+        return ReplicaSet(primary, [self.create_store(replica_host, replica_port, **options)
+                                    for replica_host, replica_port in replicas], recovery_timeout, circuit_breaker)
+
+    def stats(self):
+        return {
+            'retries': self.retry_policy.retries,
+            'local_cache': self.local_cache.stats() if self.local_cache is not None else None,
+            'write_behind': self.write_behind.stats() if self.write_behind is not None else None,
+            'single_flight': self.single_flight.stats(),
+            'negative_cache': self.negative_cache.stats() if self.negative_cache is not None else None,
+            'shards': {
+                name: {
+                    'pools': {
+                        'cache': pool_stats(self.cache_ring.shards[name].primary.connection_pool),
+                        'interests': pool_stats(nodes.primary.connection_pool),
+                        'cache_replicas': [pool_stats(replica.connection_pool)
+                                           for replica in self.cache_ring.shards[name].replicas],
+                        'interests_replicas': [pool_stats(replica.connection_pool) for replica in nodes.replicas],
+                    },
+                    'replicas': nodes.stats(),
+                    'circuit_breaker': nodes.circuit_breaker.stats(),
+                } for name, nodes in self.interests_ring.shards.items()
+            },
+        }
+
+
+class ScoreStore(BaseScoreStore):
+    def __init__(self, *args, **kwargs):
+        super(ScoreStore, self).__init__(*args, **kwargs)
+        shards = len(self.interests_ring.shards)
+        self.executor = ThreadPoolExecutor(max_workers=shards * 4, thread_name_prefix='shard') if shards > 1 else None
+
+    @classmethod
+    def create_store(cls, host='localhost', port=6379,
+                     socket_timeout=5,
+                     socket_connect_timeout=5, max_connections=50, pool_timeout=2.0, socket_keepalive=True,
+                     health_check_interval=30):
+        # callers wait up to pool_timeout for a free connection instead of opening new ones without limit
+        pool = redis.BlockingConnectionPool(host=host, port=port, max_connections=max_connections,
+                                            timeout=pool_timeout, socket_timeout=socket_timeout,
+                                            socket_connect_timeout=socket_connect_timeout,
+                                            socket_keepalive=socket_keepalive,
+                                            health_check_interval=health_check_interval)
+        return redis.Redis(connection_pool=pool)
 
     class RetryConnectionDecorator:
+        # decorated calls go to one shard and take its replica set as their last argument
+        @staticmethod
+        def break_circuit(decorated):
+            def wrapper(*args, **kwargs):
+                with RedisCallTimer(decorated.__name__):
+                    return args[-1].circuit_breaker.call(decorated, *args, **kwargs)
+
+            return wrapper
+
         @staticmethod
         def retry_connect(decorated):
             def wrapper(*args, **kwargs):
@@ -28,49 +694,311 @@ class ScoreStore:
                 if not isinstance(obj, ScoreStore):
                     return decorated(*args, **kwargs)
 
-                for attempt_num in range(obj.max_retry_attempt_count):
+                deadline = obj.retry_policy.start()
+                for attempt_num in itertools.count():
+                    time_left(deadline)
                     try:
-                        return decorated(*args, **kwargs)
-                    except (redis.ConnectionError, redis.TimeoutError):
-                        if attempt_num == obj.max_retry_attempt_count - 1:
+                        with RedisCallTimer(decorated.__name__):
+                            return args[-1].circuit_breaker.call(decorated, *args, **kwargs)
+                    except CircuitOpenError:
+                        raise
+                    except (redis.ConnectionError, redis.TimeoutError) as e:
+                        # the call has already waited pool_timeout for a connection, it is not retried
+                        delay = None if is_pool_exhausted(e) else obj.retry_policy.next_delay(attempt_num, deadline)
+                        if delay is None:
                             raise
-                        else:
-                            time.sleep(1)
+                        REDIS_RETRIES.inc((decorated.__name__,))
+                        time.sleep(delay)
 
             return wrapper
 
-    @RetryConnectionDecorator.retry_connect
+        @staticmethod
+        def break_circuit_async(decorated):
+            async def wrapper(*args, **kwargs):
+                with RedisCallTimer(decorated.__name__):
+                    return await args[-1].circuit_breaker.call_async(decorated, *args, **kwargs)
+
+            return wrapper
+
+        @staticmethod
+        def retry_connect_async(decorated):
+            async def wrapper(*args, **kwargs):
+                obj = args[0]
+
+                if not isinstance(obj, AsyncScoreStore):
+                    return await decorated(*args, **kwargs)
+
+                deadline = obj.retry_policy.start()
+                for attempt_num in itertools.count():
+                    remaining = time_left(deadline)
+                    try:
+                        with RedisCallTimer(decorated.__name__):
+                            call = args[-1].circuit_breaker.call_async(decorated, *args, **kwargs)
+                            return await asyncio.wait_for(call, remaining)
+                    except CircuitOpenError:
+                        raise
+                    except asyncio.TimeoutError:
+                        # the attempt is cancelled at the deadline, leaving no time for another one
+                        raise redis.TimeoutError('Deadline exceeded') from None
+                    except (redis.ConnectionError, redis.TimeoutError) as e:
+                        delay = None if is_pool_exhausted(e) else obj.retry_policy.next_delay(attempt_num, deadline)
+                        if delay is None:
+                            raise
+                        REDIS_RETRIES.inc((decorated.__name__,))
+                        await asyncio.sleep(delay)
+
+            return wrapper
+
+    def create_write_behind(self, max_size, flush_interval, policy):
+        return WriteBehindQueue(self.write_cache, max_size, self.batch_size, flush_interval, policy)
+
     def cache_set(self, key, value, cache_time):
+        if self.local_cache is not None:
+            self.local_cache.set(key, value, cache_time)
+        if self.write_behind is not None:
+            self.write_behind.put(key, value, cache_time * 1000)
+            return
         try:
-            self.redis_store.psetex(key, cache_time * 1000, value)
+            self.psetex(key, cache_time * 1000, value, self.cache_ring.get_shard(key))
         except Exception:
             pass
 
-    @RetryConnectionDecorator.retry_connect
+    def cache_set_many(self, values, cache_time):
+        if self.local_cache is not None:
+            for key, value in values.items():
+                self.local_cache.set(key, value, cache_time)
+        if self.write_behind is not None:
+            for key, value in values.items():
+                self.write_behind.put(key, value, cache_time * 1000)
+            return
+        try:
+            self.write_cache(values, cache_time * 1000)
+        except Exception:
+            pass
+
+    def write_cache(self, values, time_ms):
+        self.map_shards(lambda nodes, keys: self.psetex_shard(nodes, [(key, values[key]) for key in keys], time_ms),
+                        self.cache_ring.group(values))
+
+    def close(self):
+        if self.write_behind is not None:
+            self.write_behind.close()
+
     def cache_get(self, key):
+        if self.local_cache is not None:
+            return self.cache_get_many([key]).get(key)
         try:
-            return self.get(key)
+            return self.get(key, self.cache_ring)
         except Exception:
             return None
 
+    def cache_get_many(self, keys):
+        values = {}
+        if self.local_cache is not None:
+            values = self.local_cache.get_many(keys)
+            keys = [key for key in keys if key not in values]
+        if keys:
+            try:
+                if self.local_cache is None:
+                    remote_values, _ = self.get_many(keys, self.cache_ring)
+                else:
+                    remote_values, _ = self.get_many(keys, self.cache_ring, self.mget_with_ttl)
+                    remote_values = self.backfill(remote_values)
+                values.update(remote_values)
+            except Exception:
+                pass
+        return values
+
+    # cache writes are best effort, they are not retried but still go through the circuit breaker
+    @RetryConnectionDecorator.break_circuit
+    def psetex(self, key, time_ms, value, nodes):
+        nodes.primary.psetex(key, time_ms, value)
+
+    @RetryConnectionDecorator.break_circuit
+    def psetex_many(self, items, time_ms, nodes):
+        pipeline = nodes.primary.pipeline(transaction=False)
+        for key, value in items:
+            pipeline.psetex(key, time_ms, value)
+        pipeline.execute()
+
+    def psetex_shard(self, nodes, items, time_ms):
+        for chunk in chunks(items, self.batch_size):
+            self.psetex_many(chunk, time_ms, nodes)
+
+    # reads go to the interests shards unless the score cache ring is passed
+    def get(self, key, ring=None):
+        return self.get_one(key, (ring or self.interests_ring).get_shard(key))
+
     @RetryConnectionDecorator.retry_connect
-    def get(self, key):
-        return self.redis_store.get(key)
+    def get_one(self, key, nodes):
+        return nodes.read(lambda client: client.get(key))
 
+    @RetryConnectionDecorator.retry_connect
+    def mget(self, keys, nodes):
+        return nodes.read(lambda client: client.mget(keys))
 
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    @RetryConnectionDecorator.retry_connect
+    def mget_with_ttl(self, keys, nodes):
+        return nodes.read(lambda client: pair_with_ttl(queue_with_ttl(client.pipeline(transaction=False),
+                                                                      keys).execute()))
+
+    def get_many(self, keys, ring=None, mget=None):
+        values, errors = {}, {}
+        for shard_values, shard_errors in self.map_shards(lambda nodes, keys: self.get_shard(nodes, keys, mget),
+                                                          (ring or self.interests_ring).group(keys)):
+            values.update(shard_values)
+            errors.update(shard_errors)
+        return values, errors
+
+    def get_shard(self, nodes, keys, mget=None):
+        # one MGET per chunk of keys, a failed chunk is reported for each of its keys
+        values, errors = {}, {}
+        for chunk in chunks(keys, self.batch_size):
+            try:
+                values.update(zip(chunk, (mget or self.mget)(chunk, nodes)))
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                errors.update(dict.fromkeys(chunk, e))
+        return values, errors
+
+    def map_shards(self, func, groups):
+        # a batch spanning several shards is sent to all of them in parallel
+        if self.executor is None or len(groups) < 2:
+            return [func(nodes, keys) for nodes, keys in groups.items()]
+        # the shard threads record their calls in the trace of the request
+        context = contextvars.copy_context()
+        return list(self.executor.map(lambda group: context.copy().run(func, *group), groups.items()))
+
+
+class AsyncScoreStore(BaseScoreStore):
+    @classmethod
+    def create_store(cls, host='localhost', port=6379,
+                     socket_timeout=5,
+                     socket_connect_timeout=5, max_connections=50, pool_timeout=2.0, socket_keepalive=True,
+                     health_check_interval=30):
+        pool = redis.asyncio.BlockingConnectionPool(host=host, port=port, max_connections=max_connections,
+                                                    timeout=pool_timeout, socket_timeout=socket_timeout,
+                                                    socket_connect_timeout=socket_connect_timeout,
+                                                    socket_keepalive=socket_keepalive,
+                                                    health_check_interval=health_check_interval)
+        return redis.asyncio.Redis(connection_pool=pool)
+
+    async def cache_set(self, key, value, cache_time):
+        if self.local_cache is not None:
+            self.local_cache.set(key, value, cache_time)
+        try:
+            await self.psetex(key, cache_time * 1000, value, self.cache_ring.get_shard(key))
+        except Exception:
+            pass
+
+    async def cache_set_many(self, values, cache_time):
+        if self.local_cache is not None:
+            for key, value in values.items():
+                self.local_cache.set(key, value, cache_time)
+        try:
+            await self.map_shards(lambda nodes, keys: self.psetex_shard(nodes, [(key, values[key]) for key in keys],
+                                                                        cache_time * 1000),
+                                  self.cache_ring.group(values))
+        except Exception:
+            pass
+
+    async def cache_get(self, key):
+        if self.local_cache is not None:
+            return (await self.cache_get_many([key])).get(key)
+        try:
+            return await self.get(key, self.cache_ring)
+        except Exception:
+            return None
+
+    async def cache_get_many(self, keys):
+        values = {}
+        if self.local_cache is not None:
+            values = self.local_cache.get_many(keys)
+            keys = [key for key in keys if key not in values]
+        if keys:
+            try:
+                if self.local_cache is None:
+                    remote_values, _ = await self.get_many(keys, self.cache_ring)
+                else:
+                    remote_values, _ = await self.get_many(keys, self.cache_ring, self.mget_with_ttl)
+                    remote_values = self.backfill(remote_values)
+                values.update(remote_values)
+            except Exception:
+                pass
+        return values
+
+    @ScoreStore.RetryConnectionDecorator.break_circuit_async
+    async def psetex(self, key, time_ms, value, nodes):
+        await nodes.primary.psetex(key, time_ms, value)
+
+    @ScoreStore.RetryConnectionDecorator.break_circuit_async
+    async def psetex_many(self, items, time_ms, nodes):
+        pipeline = nodes.primary.pipeline(transaction=False)
+        for key, value in items:
+            pipeline.psetex(key, time_ms, value)
+        await pipeline.execute()
+
+    async def psetex_shard(self, nodes, items, time_ms):
+        for chunk in chunks(items, self.batch_size):
+            await self.psetex_many(chunk, time_ms, nodes)
+
+    async def get(self, key, ring=None):
+        return await self.get_one(key, (ring or self.interests_ring).get_shard(key))
+
+    @ScoreStore.RetryConnectionDecorator.retry_connect_async
+    async def get_one(self, key, nodes):
+        return await nodes.read_async(lambda client: client.get(key))
+
+    @ScoreStore.RetryConnectionDecorator.retry_connect_async
+    async def mget(self, keys, nodes):
+        return await nodes.read_async(lambda client: client.mget(keys))
+
+    @ScoreStore.RetryConnectionDecorator.retry_connect_async
+    async def mget_with_ttl(self, keys, nodes):
+        async def read(client):
+            return pair_with_ttl(await queue_with_ttl(client.pipeline(transaction=False), keys).execute())
+
+        return await nodes.read_async(read)
+
+    async def get_many(self, keys, ring=None, mget=None):
+        values, errors = {}, {}
+        for shard_values, shard_errors in await self.map_shards(lambda nodes, keys: self.get_shard(nodes, keys, mget),
+                                                                (ring or self.interests_ring).group(keys)):
+            values.update(shard_values)
+            errors.update(shard_errors)
+        return values, errors
+
+    async def get_shard(self, nodes, keys, mget=None):
+        values, errors = {}, {}
+        for chunk in chunks(keys, self.batch_size):
+            try:
+                values.update(zip(chunk, await (mget or self.mget)(chunk, nodes)))
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                errors.update(dict.fromkeys(chunk, e))
+        return values, errors
+
+    @staticmethod
+    async def map_shards(func, groups):
+        return await asyncio.gather(*(func(nodes, keys) for nodes, keys in groups.items()))
+
+    async def close(self):
+        clients = [client for ring in (self.cache_ring, self.interests_ring) for nodes in ring.shards.values()
+                   for client in [nodes.primary] + nodes.replicas]
+        for client in {id(client): client for client in clients}.values():
+            await client.aclose()
+
+
+def get_score_key(phone, birthday=None, first_name=None, last_name=None):
     key_parts = [
         first_name or "",
         last_name or "",
         phone or "",
         birthday.strftime("%Y%m%d") if birthday is not None else "",
     ]
-    key = "uid:" + hashlib.md5("".join(key_parts).encode('UTF-8')).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
-    if score:
-        return float(score)
+    return "uid:" + hashlib.md5("".join(key_parts).encode('UTF-8')).hexdigest()
+
+
+def calculate_score(phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -79,11 +1007,150 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
+    return score
+
+
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = get_score_key(phone, birthday, first_name, last_name)
+    # concurrent lookups of one key share a single cache read and calculation
+    return store.single_flight.do(key, lookup_score, store, key, phone, email, birthday, gender, first_name,
+                                  last_name)
+
+
+def lookup_score(store, key, phone, email, birthday, gender, first_name, last_name):
+    # try get from cache,
+    # fallback to heavy calculation in case of cache miss
+    score = store.cache_get(key) or 0
+    if score:
+        SCORE_CACHE.inc(('hit',))
+        return float(score)
+    SCORE_CACHE.inc(('miss',))
+    score = calculate_score(phone, email, birthday, gender, first_name, last_name)
     # cache for 60 minutes
     store.cache_set(key, score, 60 * 60)
     return score
 
 
+async def get_score_async(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = get_score_key(phone, birthday, first_name, last_name)
+    return await store.single_flight.do_async(key, lookup_score_async, store, key, phone, email, birthday, gender,
+                                              first_name, last_name)
+
+
+async def lookup_score_async(store, key, phone, email, birthday, gender, first_name, last_name):
+    score = await store.cache_get(key) or 0
+    if score:
+        SCORE_CACHE.inc(('hit',))
+        return float(score)
+    SCORE_CACHE.inc(('miss',))
+    score = calculate_score(phone, email, birthday, gender, first_name, last_name)
+    await store.cache_set(key, score, 60 * 60)
+    return score
+
+
+def get_scores(store, applicants):
+    # applicants are dicts of get_score arguments, cached scores are fetched with one MGET
+    # and the calculated ones are written back with one pipeline
+    keys = [get_score_key(applicant.get('phone'), applicant.get('birthday'),
+                          applicant.get('first_name'), applicant.get('last_name')) for applicant in applicants]
+    cached = store.cache_get_many(list(dict.fromkeys(keys)))
+    scores, missed = merge_cached_scores(applicants, keys, cached)
+    if missed:
+        store.cache_set_many(missed, 60 * 60)
+    return scores
+
+
+async def get_scores_async(store, applicants):
+    keys = [get_score_key(applicant.get('phone'), applicant.get('birthday'),
+                          applicant.get('first_name'), applicant.get('last_name')) for applicant in applicants]
+    cached = await store.cache_get_many(list(dict.fromkeys(keys)))
+    scores, missed = merge_cached_scores(applicants, keys, cached)
+    if missed:
+        await store.cache_set_many(missed, 60 * 60)
+    return scores
+
+
+def merge_cached_scores(applicants, keys, cached):
+    scores, missed, hits = [], {}, 0
+    for applicant, key in zip(applicants, keys):
+        if cached.get(key):
+            scores.append(float(cached[key]))
+            hits += 1
+        else:
+            missed[key] = calculate_score(**applicant)
+            scores.append(missed[key])
+    SCORE_CACHE.inc(('hit',), hits)
+    SCORE_CACHE.inc(('miss',), len(scores) - hits)
+    return scores, missed
+
+
 def get_interests(store, cid):
-    r = store.get("i:%s" % cid)
-    return json.loads(r) if r else []
+    key = "i:%s" % cid
+    if store.is_known_absent(key):
+        return []
+    r = store.get(key)
+    store.remember_absent({key: r})
+    return codec.loads(r) if r else []
+
+
+async def get_interests_async(store, cid):
+    key = "i:%s" % cid
+    if store.is_known_absent(key):
+        return []
+    r = await store.get(key)
+    store.remember_absent({key: r})
+    return codec.loads(r) if r else []
+
+
+def interests_keys(cids):
+    # repeated ids are fetched once, the order of the first occurrence is kept
+    return {cid: "i:%s" % cid for cid in dict.fromkeys(cids)}
+
+
+def decode_interests(keys, values, errors):
+    # ids that could not be fetched get None and are reported with their error
+    interests, failed = {}, {}
+    for cid, key in keys.items():
+        if key in errors:
+            interests[cid] = None
+            failed[cid] = errors[key]
+        else:
+            interests[cid] = codec.loads(values[key]) if values[key] else []
+    return interests, failed
+
+
+def fetch_interests(store, keys):
+    keys, absent = store.split_known_absent(keys)
+    values, errors = store.get_many(keys) if keys else ({}, {})
+    store.remember_absent(values)
+    values.update(absent)
+    return values, errors
+
+
+async def fetch_interests_async(store, keys):
+    keys, absent = store.split_known_absent(keys)
+    values, errors = await store.get_many(keys) if keys else ({}, {})
+    store.remember_absent(values)
+    values.update(absent)
+    return values, errors
+
+
+def get_interests_batch(store, cids):
+    keys = interests_keys(cids)
+    values, errors = fetch_interests(store, list(keys.values()))
+    return decode_interests(keys, values, errors)
+
+
+def iter_interests_batch(store, cids):
+    # yields the interests of one store batch at a time, so only a batch of results is kept in memory
+    keys = interests_keys(cids)
+    for chunk in chunks(list(keys.items()), store.batch_size):
+        chunk = dict(chunk)
+        values, errors = fetch_interests(store, list(chunk.values()))
+        yield decode_interests(chunk, values, errors)
+
+
+async def get_interests_batch_async(store, cids):
+    keys = interests_keys(cids)
+    values, errors = await fetch_interests_async(store, list(keys.values()))
+    return decode_interests(keys, values, errors)
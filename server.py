@@ -0,0 +1,198 @@
+import logging
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+from http.server import HTTPServer
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    # connections accepted but not yet picked up by a worker wait in a bounded queue,
+    # when it is full the accept loop blocks and new connections wait in the listen backlog
+    def __init__(self, server_address, handler_class, workers=8, backlog=1024, queue_size=None,
+                 bind_and_activate=True):
+        self.request_queue_size = backlog
+        self.workers = workers
+        self.requests = queue.Queue(maxsize=queue_size or workers * 2)
+        self.threads = []
+        super(ThreadPoolHTTPServer, self).__init__(server_address, handler_class, bind_and_activate)
+
+        for worker_num in range(workers):
+            thread = threading.Thread(target=self.process_request_worker,
+                                      name='worker-{}'.format(worker_num), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def process_request_worker(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        logging.exception("Error while processing request from %s", client_address)
+
+    def server_close(self):
+        super(ThreadPoolHTTPServer, self).server_close()
+        # workers drain the connections already queued before they see the stop marker
+        for _ in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class PreforkServer:
+    # master process owns the listening socket and a set of forked workers,
+    # each worker accepts from the shared socket and serves it with its own thread pool
+    def __init__(self, server_address, handler_class, processes=4, workers=8, backlog=1024,
+                 worker_init=None, worker_exit=None, graceful_timeout=30, poll_interval=0.5):
+        self.server_address = server_address
+        self.handler_class = handler_class
+        self.processes = processes
+        self.workers = workers
+        self.backlog = backlog
+        self.worker_init = worker_init
+        self.worker_exit = worker_exit
+        self.graceful_timeout = graceful_timeout
+        self.poll_interval = poll_interval
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(backlog)
+        self.server_address = self.socket.getsockname()
+
+        self.children = {}
+        self.generation = 0
+        self.running = False
+        self.reload_requested = False
+
+    def serve_forever(self):
+        self.running = True
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+        try:
+            while self.running:
+                self.reap_workers()
+                if self.reload_requested:
+                    self.reload_workers()
+                self.spawn_workers()
+                time.sleep(self.poll_interval)
+        finally:
+            self.stop_workers(list(self.children))
+            self.socket.close()
+
+    def handle_stop(self, signum, frame):
+        logging.info("Master received signal %s, stopping workers", signum)
+        self.running = False
+
+    def handle_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def spawn_workers(self):
+        alive = [pid for pid, generation in self.children.items() if generation == self.generation]
+        for _ in range(self.processes - len(alive)):
+            pid = os.fork()
+            if pid == 0:
+                self.run_worker()
+            self.children[pid] = self.generation
+            logging.info("Started worker %s", pid)
+
+    def reap_workers(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+
+            generation = self.children.pop(pid, None)
+            if self.running and generation == self.generation:
+                logging.error("Worker %s exited with status %s, restarting", pid, status)
+
+    def reload_workers(self):
+        # new workers are started first, old ones finish the requests they hold and exit
+        self.reload_requested = False
+        old_workers = list(self.children)
+        self.generation += 1
+        logging.info("Reloading workers")
+        self.spawn_workers()
+        self.signal_workers(old_workers, signal.SIGTERM)
+
+    def signal_workers(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop_workers(self, pids):
+        self.signal_workers(pids, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self.children and time.time() < deadline:
+            self.reap_workers()
+            time.sleep(0.05)
+
+        if self.children:
+            logging.error("Workers %s did not stop in time, killing", list(self.children))
+            self.signal_workers(list(self.children), signal.SIGKILL)
+            for pid in list(self.children):
+                os.waitpid(pid, 0)
+                self.children.pop(pid)
+
+    def run_worker(self):
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            if self.worker_init is not None:
+                self.worker_init()
+
+            server = WorkerHTTPServer(self.socket, self.handler_class, workers=self.workers)
+            signal.signal(signal.SIGTERM,
+                          lambda signum, frame: threading.Thread(target=server.shutdown).start())
+            server.serve_forever(poll_interval=self.poll_interval)
+            server.server_close()
+            if self.worker_exit is not None:
+                self.worker_exit()
+        except Exception:
+            logging.exception("Worker %s failed", os.getpid())
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+
+class WorkerHTTPServer(ThreadPoolHTTPServer):
+    # several processes wait on the same listening socket, so it is switched to non-blocking
+    # mode and a worker that lost the race for a connection just returns to its select loop
+    def __init__(self, listen_socket, handler_class, workers=8):
+        super(WorkerHTTPServer, self).__init__(listen_socket.getsockname(), handler_class, workers=workers,
+                                               bind_and_activate=False)
+        self.socket.close()
+        self.socket = listen_socket
+        self.socket.setblocking(False)
+        host, port = self.socket.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+
+    def get_request(self):
+        request, client_address = self.socket.accept()
+        request.setblocking(True)
+        return request, client_address
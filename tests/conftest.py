@@ -0,0 +1 @@
+from tests.fixtures import unavailable_store, store, async_store, unavailable_async_store, birth_date, fields_set
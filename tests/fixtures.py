@@ -3,7 +3,7 @@ from mock import Mock, patch
 import fakeredis
 from datetime import datetime
 
-from scoring import ScoreStore
+from scoring import ScoreStore, AsyncScoreStore
 import api
 
 
@@ -24,6 +24,34 @@ def store():
         yield ScoreStore()
 
 
+@pytest.fixture(scope="module")
+def async_store():
+    server = fakeredis.FakeServer()
+    mocked_redis = fakeredis.FakeAsyncRedis(server=server)
+    with patch('scoring.AsyncScoreStore.create_store', return_value=mocked_redis):
+        yield AsyncScoreStore()
+
+
+@pytest.fixture(scope="module")
+def unavailable_async_store():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    mocked_redis = fakeredis.FakeAsyncRedis(server=server)
+    with patch('scoring.AsyncScoreStore.create_store', return_value=mocked_redis):
+        yield AsyncScoreStore(max_retry_attempt_count=2)
+
+
+def make_nodes(nodes, redis_class):
+    servers = {node: fakeredis.FakeServer() for node in nodes}
+    clients = {node: redis_class(server=server) for node, server in servers.items()}
+    return servers, clients
+
+
+def patch_create_store(store_class, clients):
+    # every node of a replicated or sharded store gets the fake client of its host and port
+    return patch.object(store_class, 'create_store', side_effect=lambda host, port, **options: clients[(host, port)])
+
+
 @pytest.fixture(scope="module")
 def birth_date():
     yield datetime.strptime("01.01.2000", "%d.%m.%Y")
@@ -0,0 +1,99 @@
+import asyncio
+import hashlib
+import json
+
+import api
+import async_api
+from tests.fixtures import async_store
+
+
+def make_request(arguments, method="online_score"):
+    request = {"account": "horns&hoofs", "login": "h&f", "method": method, "arguments": arguments}
+    request["token"] = hashlib.sha512((request["account"] + request["login"] + api.SALT).encode('UTF-8')).hexdigest()
+    body = json.dumps(request).encode('UTF-8')
+    return (b"POST /method HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n" % len(body)) + body
+
+
+async def read_response(reader):
+    status = await reader.readline()
+    headers = await async_api.AsyncHTTPServer.read_headers(reader)
+    body = await reader.readexactly(int(headers['content-length']))
+    return int(status.split()[1]), headers, json.loads(body)
+
+
+async def run_with_server(store, client):
+    server = async_api.AsyncHTTPServer(store, port=0, idle_timeout=1)
+    await server.start()
+    try:
+        return await client(server)
+    finally:
+        await server.close()
+
+
+def test_keep_alive_pipelined_requests(async_store):
+    async def client(server):
+        reader, writer = await asyncio.open_connection('localhost', server.port)
+        writer.write(make_request({"phone": "79175002040", "email": "stupnikov@otus.ru"}) +
+                     make_request({"client_ids": [1, 2]}, method="clients_interests"))
+        await writer.drain()
+        responses = [await read_response(reader), await read_response(reader)]
+        writer.close()
+        return responses
+
+    (code1, headers1, score), (code2, _, interests) = asyncio.run(run_with_server(async_store, client))
+    assert code1 == code2 == api.OK
+    assert headers1['connection'] == 'keep-alive'
+    assert score == {"response": {"score": 3.0}, "code": api.OK}
+    assert interests == {"response": {"1": [], "2": []}, "code": api.OK}
+
+
+def test_bad_request(async_store):
+    async def client(server):
+        reader, writer = await asyncio.open_connection('localhost', server.port)
+        writer.write(b"POST /method HTTP/1.0\r\nContent-Length: 3\r\n\r\n{{{")
+        await writer.drain()
+        response = await read_response(reader)
+        writer.close()
+        return response
+
+    code, headers, body = asyncio.run(run_with_server(async_store, client))
+    assert code == api.BAD_REQUEST
+    assert headers['connection'] == 'close'
+    assert body == {"error": "Bad Request", "code": api.BAD_REQUEST}
+
+
+def test_metrics_endpoint(async_store):
+    async def client(server):
+        reader, writer = await asyncio.open_connection('localhost', server.port)
+        writer.write(make_request({"phone": "79175002040", "email": "stupnikov@otus.ru"}) +
+                     b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        await writer.drain()
+        await read_response(reader)
+        status = await reader.readline()
+        headers = await async_api.AsyncHTTPServer.read_headers(reader)
+        body = await reader.readexactly(int(headers['content-length']))
+        writer.close()
+        return int(status.split()[1]), headers, body.decode('UTF-8')
+
+    code, headers, body = asyncio.run(run_with_server(async_store, client))
+    assert code == api.OK
+    assert headers['content-type'].startswith('text/plain')
+    assert 'api_requests_total{method="ONLINE_SCORE",code="200"}' in body
+    assert 'api_stage_duration_seconds_count{stage="handler"}' in body
+
+
+def test_request_id_and_server_timing(async_store):
+    async def client(server):
+        reader, writer = await asyncio.open_connection('localhost', server.port)
+        request = make_request({"phone": "79175002040", "email": "stupnikov@otus.ru"})
+        writer.write(request.replace(b"Host: localhost\r\n", b"Host: localhost\r\nX-Request-ID: req-42\r\n"))
+        await writer.drain()
+        response = await read_response(reader)
+        writer.close()
+        return response
+
+    code, headers, _ = asyncio.run(run_with_server(async_store, client))
+    assert code == api.OK
+    assert headers['x-request-id'] == 'req-42'
+    timings = [item.split(';')[0] for item in headers['server-timing'].split(', ')]
+    assert timings[0] == 'parse' and timings[-2:] == ['encode', 'total'] and 'handler' in timings
@@ -0,0 +1,376 @@
+import pytest
+import contextlib
+import hashlib
+import json
+import socket
+import threading
+import time
+import fakeredis
+from http.client import HTTPConnection
+from mock import patch
+
+import api
+import codec
+import scoring
+from server import ThreadPoolHTTPServer
+from tests.fixtures import store, unavailable_store, make_nodes, patch_create_store
+
+
+@contextlib.contextmanager
+def serve(store):
+    with patch.object(api.MainHTTPHandler, 'store', store), \
+            patch.object(api.MainHTTPHandler, 'log_message', lambda *args: None):
+        server = ThreadPoolHTTPServer(('localhost', 0), api.MainHTTPHandler, workers=2)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            yield server
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+@pytest.fixture
+def http_server(store):
+    with serve(store) as server:
+        yield server
+
+
+def make_request(arguments, method="online_score"):
+    request = {"account": "horns&hoofs", "login": "h&f", "method": method, "arguments": arguments}
+    request["token"] = hashlib.sha512((request["account"] + request["login"] + api.SALT).encode('UTF-8')).hexdigest()
+    return request
+
+
+def post(server, body, path='/method', http_version=None):
+    connection = HTTPConnection(*server.server_address, timeout=5)
+    if http_version is not None:
+        connection._http_vsn, connection._http_vsn_str = http_version
+    connection.request('POST', path, body=body, headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+    data = response.read()
+    connection.close()
+    return response, data
+
+
+def test_online_score(http_server):
+    response, data = post(http_server, json.dumps(make_request({"phone": "79175002040",
+                                                                "email": "stupnikov@otus.ru"})))
+    assert response.status == api.OK
+    assert int(response.getheader('Content-Length')) == len(data)
+    assert json.loads(data) == {"response": {"score": 3.0}, "code": api.OK}
+
+
+@pytest.mark.parametrize('body, path, code', [
+    ('{not json', '/method', api.BAD_REQUEST),
+    (json.dumps(make_request({})), '/unknown', api.NOT_FOUND),
+    (json.dumps(make_request({"phone": "1"})), '/method', api.INVALID_REQUEST),
+])
+def test_errors(http_server, body, path, code):
+    response, data = post(http_server, body, path)
+    assert response.status == code
+    assert json.loads(data)["code"] == code
+
+
+@pytest.mark.parametrize('codec_name', [name for name, (available, _) in codec.CODECS.items() if available()])
+def test_client_ids_beyond_64_bits(http_server, store, codec_name):
+    client_id = 1180591620717411303424
+    store.redis_store.set("i:%s" % client_id, '["cars"]')
+    with patch.object(codec, 'default_codec', codec.select_codec(codec_name)):
+        response, data = post(http_server, json.dumps(make_request({"client_ids": [client_id]},
+                                                                   method="clients_interests")))
+    assert response.status == api.OK
+    assert json.loads(data)["response"] == {str(client_id): ["cars"]}
+
+
+def test_large_interests_response_is_streamed(http_server, store):
+    client_ids = list(range(api.STREAM_CLIENTS_THRESHOLD * 3))
+    store.redis_store.set("i:7", '["cars", "pets"]')
+    response, data = post(http_server, json.dumps(make_request({"client_ids": client_ids},
+                                                               method="clients_interests")))
+    assert response.status == api.OK
+    body = json.loads(data)
+    assert len(body["response"]) == len(client_ids)
+    assert body["response"]["7"] == ["cars", "pets"]
+
+
+@pytest.mark.parametrize('http_version, transfer_encoding', [(None, 'chunked'), ((10, 'HTTP/1.0'), None)])
+def test_streamed_interests_match_buffered_response(http_server, store, http_version, transfer_encoding):
+    client_ids = list(range(api.STREAM_CLIENTS_THRESHOLD * 2)) + [5, 5]
+    for cid in range(0, len(client_ids), 3):
+        store.redis_store.set("i:%s" % cid, codec.dumps(["cars", "книги", str(cid)]))
+    response, data = post(http_server, json.dumps(make_request({"client_ids": client_ids},
+                                                               method="clients_interests")),
+                          http_version=http_version)
+
+    interests, failed = scoring.get_interests_batch(store, client_ids)
+    expected = codec.dumps(api.build_response(api.interests_response(interests, failed, {}), api.OK))
+    assert response.status == api.OK
+    assert response.getheader('Transfer-Encoding') == transfer_encoding
+    assert response.getheader('Content-Length') is None
+    assert data == expected
+
+
+def test_streamed_interests_fetch_batches_lazily(store):
+    client_ids = list(range(store.batch_size * 4))
+    ctx = {}
+    with patch.object(store, 'get_many', wraps=store.get_many) as get_many:
+        request = api.ClientsInterestsRequest.from_dict({"client_ids": client_ids})
+        response, code = api.client_ids_request_handler(request, ctx, store)
+        assert get_many.call_count == 1
+        parts = codec.default_codec.encode_parts(response, 1)
+        next(parts)
+        assert get_many.call_count == 1
+        b''.join(parts)
+        assert get_many.call_count == 4
+    assert ctx['nclients'] == len(client_ids)
+
+
+def test_streamed_interests_with_unavailable_store(unavailable_store):
+    client_ids = list(range(api.STREAM_CLIENTS_THRESHOLD + 1))
+    with serve(unavailable_store) as server:
+        response, data = post(server, json.dumps(make_request({"client_ids": client_ids},
+                                                              method="clients_interests")))
+    assert response.status == api.INTERNAL_ERROR
+    assert json.loads(data)["code"] == api.INTERNAL_ERROR
+
+
+def score_body(phone="79175002040"):
+    return json.dumps(make_request({"phone": phone, "email": "stupnikov@otus.ru"}))
+
+
+def raw_request(body, extra_headers=b"", version=b"HTTP/1.1"):
+    body = body.encode('UTF-8')
+    return (b"POST /method " + version + b"\r\nHost: localhost\r\nContent-Length: " + str(len(body)).encode() +
+            b"\r\n" + extra_headers + b"\r\n" + body)
+
+
+def read_until_closed(sock):
+    data = b""
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def read_response(sock):
+    # one response with a content length, the headers and the body may arrive in separate packets
+    data = b""
+    while b"\r\n\r\n" not in data:
+        data += sock.recv(65536)
+    headers, body = data.split(b"\r\n\r\n", 1)
+    length = int(headers.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+    while len(body) < length:
+        body += sock.recv(65536)
+    return headers, body
+
+
+def test_keep_alive_reuses_connection(http_server):
+    connection = HTTPConnection(*http_server.server_address, timeout=5)
+    sockets = set()
+    for _ in range(5):
+        connection.request('POST', '/method', body=score_body())
+        response = connection.getresponse()
+        assert json.loads(response.read())["response"] == {"score": 3.0}
+        assert response.getheader('Connection') is None
+        sockets.add(id(connection.sock))
+    connection.close()
+    assert len(sockets) == 1
+
+
+def test_keep_alive_request_limit(http_server):
+    connection = HTTPConnection(*http_server.server_address, timeout=5)
+    with patch.object(api.MainHTTPHandler, 'max_keepalive_requests', 2):
+        connection.request('POST', '/method', body=score_body())
+        assert connection.getresponse().read()
+        connection.request('POST', '/method', body=score_body())
+        response = connection.getresponse()
+        assert response.getheader('Connection') == 'close'
+        assert response.read()
+    assert connection.sock is None
+    connection.close()
+
+
+def test_pipelined_requests(http_server):
+    bodies = [score_body(), json.dumps(make_request({"phone": "1"})), '{not json', score_body("79175002041")]
+    with socket.create_connection(http_server.server_address, timeout=5) as sock:
+        sock.sendall(b"".join(raw_request(body) for body in bodies[:-1]) +
+                     raw_request(bodies[-1], b"Connection: close\r\n"))
+        data = read_until_closed(sock)
+    responses = data.split(b"HTTP/1.1 ")[1:]
+    assert [int(response[:3]) for response in responses] == [api.OK, api.INVALID_REQUEST, api.BAD_REQUEST, api.OK]
+    for response in responses:
+        headers, body = response.split(b"\r\n\r\n", 1)
+        assert b"Content-Length: %d" % len(body) in headers
+        assert json.loads(body)["code"] == int(response[:3])
+
+
+def test_http_1_0_keep_alive(http_server):
+    with socket.create_connection(http_server.server_address, timeout=5) as sock:
+        sock.sendall(raw_request(score_body(), b"Connection: keep-alive\r\n", b"HTTP/1.0"))
+        headers, _ = read_response(sock)
+        assert b"Connection: keep-alive" in headers
+        sock.sendall(raw_request(score_body(), version=b"HTTP/1.0"))
+        assert read_until_closed(sock).startswith(b"HTTP/1.1 200")
+
+
+def test_idle_connections_give_way_to_waiting_ones(http_server):
+    # the server has two workers, two idle keep-alive connections would hold them for the whole timeout
+    sockets = [socket.create_connection(http_server.server_address, timeout=5) for _ in range(4)]
+    started = time.monotonic()
+    try:
+        for sock in sockets:
+            sock.sendall(raw_request(score_body()))
+            assert read_response(sock)[0].startswith(b"HTTP/1.1 200")
+        assert time.monotonic() - started < 2
+        assert sockets[0].recv(65536) == b""
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
+def test_idle_connection_is_closed(http_server):
+    with patch.object(api.MainHTTPHandler, 'timeout', 0.2), \
+            socket.create_connection(http_server.server_address, timeout=5) as sock:
+        sock.sendall(raw_request(score_body()))
+        assert read_response(sock)[0].startswith(b"HTTP/1.1 200")
+        started = time.monotonic()
+        assert sock.recv(65536) == b""
+        assert time.monotonic() - started < 2
+
+
+def test_missing_content_length_closes_connection(http_server):
+    with socket.create_connection(http_server.server_address, timeout=5) as sock:
+        sock.sendall(b"POST /method HTTP/1.1\r\nHost: localhost\r\n\r\n" + raw_request(score_body()))
+        data = read_until_closed(sock)
+    assert data.startswith(b"HTTP/1.1 400") and b"Connection: close" in data
+    assert data.count(b"HTTP/1.1 ") == 1
+
+
+def test_metrics_endpoint(http_server):
+    post(http_server, score_body())
+    post(http_server, '{not json')
+    connection = HTTPConnection(*http_server.server_address, timeout=5)
+    connection.request('GET', '/metrics')
+    response = connection.getresponse()
+    data = response.read().decode('UTF-8')
+    connection.request('GET', '/unknown')
+    not_found = connection.getresponse()
+    assert json.loads(not_found.read())["code"] == api.NOT_FOUND
+    connection.close()
+
+    assert response.status == api.OK
+    assert response.getheader('Content-Type').startswith('text/plain; version=0.0.4')
+    assert '# TYPE api_requests_total counter' in data
+    assert 'api_requests_total{method="ONLINE_SCORE",code="200"}' in data
+    assert 'api_requests_total{method="unknown",code="400"}' in data
+    for stage in ('parse', 'validate', 'auth', 'arguments', 'handler', 'encode'):
+        assert 'api_stage_duration_seconds_count{stage="%s"}' % stage in data
+    stats = api.AUTH_CACHE.stats()
+    assert stats['hits'] + stats['misses'] > 0
+    assert '# TYPE api_auth_cache_lookups_total counter' in data
+    assert 'api_auth_cache_lookups_total{result="hit"} %s' % stats['hits'] in data
+    assert 'api_auth_cache_lookups_total{result="miss"} %s' % stats['misses'] in data
+    assert 'api_auth_cache_entries %s' % stats['entries'] in data
+    assert 'api_request_duration_seconds_bucket{method="ONLINE_SCORE",le="+Inf"}' in data
+
+
+def get_metrics(server):
+    connection = HTTPConnection(*server.server_address, timeout=5)
+    connection.request('GET', '/metrics')
+    data = connection.getresponse().read().decode('UTF-8')
+    connection.close()
+    return data
+
+
+def test_metrics_read_store_stats():
+    with patch('scoring.ScoreStore.create_store', return_value=fakeredis.FakeStrictRedis()):
+        cached_store = scoring.ScoreStore(local_cache_size=100, negative_cache_size=100, write_behind_size=100)
+    try:
+        with serve(cached_store) as server:
+            for _ in range(2):
+                post(server, score_body())
+            post(server, json.dumps(make_request({"client_ids": [1, 2]}, method="clients_interests")))
+            cached_store.write_behind.close()
+            data = get_metrics(server)
+    finally:
+        cached_store.close()
+
+    assert '# TYPE scoring_local_cache_lookups_total counter' in data
+    assert 'scoring_local_cache_lookups_total{cache="score",result="hit"} 1' in data
+    assert 'scoring_local_cache_lookups_total{cache="score",result="miss"} 1' in data
+    assert 'scoring_local_cache_lookups_total{cache="negative",result="miss"} 2' in data
+    assert 'scoring_local_cache_removals_total{cache="negative",reason="eviction"} 0' in data
+    assert 'scoring_local_cache_entries{cache="score"} 1' in data
+    assert 'scoring_write_behind_total{result="written"} 1' in data
+    assert 'scoring_write_behind_total{result="dropped"} 0' in data
+    assert 'scoring_write_behind_pending 0' in data
+
+
+def test_metrics_report_pools():
+    _, clients = make_nodes([('primary', 6379), ('replica', 6379)], fakeredis.FakeStrictRedis)
+    with patch_create_store(scoring.ScoreStore, clients):
+        replicated_store = scoring.ScoreStore(host='primary', port=6379, replicas=[('replica', 6379)])
+    with serve(replicated_store) as server:
+        data = get_metrics(server)
+
+    assert '# TYPE scoring_redis_pool_connections gauge' in data
+    for pool in ('cache', 'interests'):
+        for node in ('primary', 'replica-1'):
+            assert 'scoring_redis_pool_connections{shard="primary:6379",pool="%s",node="%s",state="idle"}' % (
+                pool, node) in data
+            assert 'scoring_redis_pool_max_connections{shard="primary:6379",pool="%s",node="%s"}' % (
+                pool, node) in data
+
+
+def test_metrics_report_circuit_breakers():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    with patch('scoring.ScoreStore.create_store', return_value=fakeredis.FakeStrictRedis(server=server)):
+        down_store = scoring.ScoreStore(max_retry_attempt_count=1, breaker_failure_threshold=1)
+    with serve(down_store) as server:
+        for _ in range(2):
+            post(server, json.dumps(make_request({"client_ids": [1]}, method="clients_interests")))
+        data = get_metrics(server)
+
+    assert '# TYPE scoring_circuit_breaker_state gauge' in data
+    assert 'scoring_circuit_breaker_state{shard="localhost:6379",state="open"} 1' in data
+    assert 'scoring_circuit_breaker_state{shard="localhost:6379",state="closed"} 0' in data
+    assert 'scoring_circuit_breaker_trips_total{shard="localhost:6379"} 1' in data
+    assert 'scoring_circuit_breaker_rejected_total{shard="localhost:6379"} 1' in data
+
+
+def server_timing_names(response):
+    return [item.split(';')[0] for item in response.getheader('Server-Timing').split(', ')]
+
+
+def test_request_id_and_server_timing(http_server):
+    connection = HTTPConnection(*http_server.server_address, timeout=5)
+    with patch('api.logging.info') as log:
+        connection.request('POST', '/method', body=score_body("79175002042"), headers={"X-Request-ID": "req-42"})
+        response = connection.getresponse()
+        response.read()
+        connection.request('POST', '/method', body=score_body(), headers={"X-Request-ID": "bad id"})
+        generated = connection.getresponse()
+        generated.read()
+    connection.close()
+
+    assert response.getheader('X-Request-ID') == 'req-42'
+    assert server_timing_names(response) == ['parse', 'validate', 'auth', 'arguments', 'redis.get_one', 'redis.psetex',
+                                             'handler', 'encode', 'total']
+    assert len(generated.getheader('X-Request-ID')) == 32
+    contexts = [call.args[0] for call in log.call_args_list if isinstance(call.args[0], dict)]
+    assert contexts[0]["request_id"] == "req-42"
+    assert set(contexts[0]["timings"]) == set(server_timing_names(response))
+    assert contexts[0]["timings"]["total"] >= contexts[0]["timings"]["handler"]
+
+
+def test_streamed_response_server_timing(store):
+    client_ids = list(range(api.STREAM_CLIENTS_THRESHOLD + 1))
+    with serve(store) as server:
+        response, data = post(server, json.dumps(make_request({"client_ids": client_ids},
+                                                              method="clients_interests")))
+    assert response.getheader('Transfer-Encoding') == 'chunked'
+    assert 'handler' in server_timing_names(response)
+    assert 'encode' not in server_timing_names(response)
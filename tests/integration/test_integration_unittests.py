@@ -1,3 +1,4 @@
+import asyncio
 import hashlib
 from datetime import datetime, date
 import functools
@@ -5,6 +6,7 @@ import unittest
 import pytest
 
 import api
+import async_api
 
 
 def cases(cases):
@@ -116,6 +118,51 @@ class TestSuite(unittest.TestCase):
         score = response.get("score")
         self.assertEqual(score, 42)
 
+    @cases([
+        {},
+        {"items": []},
+        {"items": {"phone": "79175002040", "email": "stupnikov@otus.ru"}},
+        {"items": [1, 2]},
+    ])
+    def test_invalid_score_batch_request(self, arguments):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score_batch", "arguments": arguments}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code, arguments)
+        self.assertTrue(len(response))
+
+    def test_ok_score_batch_request(self):
+        items = [
+            {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+            {"phone": "79175002040"},
+            {"gender": 1, "birthday": "01.01.2000", "first_name": "a", "last_name": "b"},
+            {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+        ]
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score_batch",
+                   "arguments": {"items": items}}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(self.context["has"], {"phone": 2, "email": 2, "gender": 1, "birthday": 1,
+                                               "first_name": 1, "last_name": 1})
+        results = response["results"]
+        self.assertEqual(len(items), len(results))
+        self.assertEqual(api.INVALID_REQUEST, results[1]["code"])
+        self.assertTrue(len(results[1]["error"]))
+        for index in (0, 2, 3):
+            single = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": items[index]}
+            self.set_valid_auth(single)
+            self.assertEqual(self.get_response(single)[0]["score"], results[index]["score"])
+
+    def test_ok_score_batch_admin_request(self):
+        items = [{"phone": "79175002040", "email": "stupnikov@otus.ru"}, {"first_name": "a", "last_name": "b"}]
+        request = {"account": "horns&hoofs", "login": "admin", "method": "online_score_batch",
+                   "arguments": {"items": items}}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(response, {"results": [{"score": 42}, {"score": 42}]})
+
     @cases([
         {},
         {"date": "20.07.2017"},
@@ -147,5 +194,15 @@ class TestSuite(unittest.TestCase):
         self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
 
 
+class AsyncTestSuite(TestSuite):
+    @pytest.fixture(autouse=True)
+    def _set_store(self, async_store):
+        self.store = async_store
+
+    def get_response(self, request):
+        return asyncio.run(async_api.method_handler({"body": request, "headers": self.headers},
+                                                    self.context, self.store))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,10 +1,16 @@
 import pytest
+import asyncio
+import fakeredis
 import redis
+import time
+from mock import patch
 from sys import float_info
 from datetime import datetime
 
-from scoring import get_score, get_interests
-from tests.fixtures import unavailable_store, store, birth_date
+from scoring import get_score, get_interests, get_score_async, get_interests_async, get_interests_batch, \
+    get_interests_batch_async, get_scores, get_scores_async, calculate_score, iter_interests_batch, ScoreStore, \
+    AsyncScoreStore
+from tests.fixtures import unavailable_store, store, async_store, unavailable_async_store, birth_date
 
 
 def test_get_score_from_unavailable_store(unavailable_store, birth_date):
@@ -15,24 +21,66 @@ def bdate():
     return datetime.strptime("01.01.2000", "%d.%m.%Y")
 
 
-@pytest.mark.parametrize("args, score", [
+SCORE_CASES = [
     (("79175002040", "", None), 1.5),
     (("", "test@otus.ru", None), 1.5),
-    (("79175002040", "test@otus.ru", bdate), 3),
-    (("79175002040", "test@otus.ru", bdate, 1), 4.5),
-    (("79175002040", "test@otus.ru", bdate, 1, "John"), 4.5),
-    (("79175002040", "test@otus.ru", bdate, 1, "John", "Smith"), 5)
-])
+    (("79175002040", "test@otus.ru", bdate()), 3),
+    (("79175002040", "test@otus.ru", bdate(), 1), 4.5),
+    (("79175002040", "test@otus.ru", bdate(), 1, "John"), 4.5),
+    (("79175002040", "test@otus.ru", bdate(), 1, "John", "Smith"), 5)
+]
+
+
+@pytest.mark.parametrize("args, score", SCORE_CASES)
 def test_get_score_from_store(store, args, score):
     assert get_score(store, *args) - score < float_info.epsilon
 
 
+@pytest.mark.parametrize("args, score", SCORE_CASES)
+def test_get_score_async_equals_sync(store, async_store, args, score):
+    assert asyncio.run(get_score_async(async_store, *args)) == get_score(store, *args)
+
+
+def test_get_score_from_unavailable_async_store(unavailable_async_store, birth_date):
+    score = asyncio.run(get_score_async(unavailable_async_store, "79175002040", "test@otus.ru", birth_date))
+    assert score - 3.0 < float_info.epsilon
+
+
 def test_get_score_equals(store, birth_date):
     v1 = get_score(store, "79175002040", "test@otus.ru", birth_date)
     v2 = get_score(store, "79175002040", "test@otus.ru", birth_date)
     assert v1 - v2 < float_info.epsilon
 
 
+@pytest.mark.parametrize("get_scores_func", [
+    get_scores,
+    lambda store, applicants: asyncio.run(get_scores_async(store, applicants)),
+])
+def test_get_scores_equals_get_score(store, async_store, get_scores_func):
+    applicants = [{"phone": "7000000000%s" % num, "email": "test@otus.ru", "birthday": bdate(), "gender": num % 3,
+                   "first_name": "John", "last_name": "Smith" if num % 2 else None} for num in range(4)]
+    target_store = store if get_scores_func is get_scores else async_store
+    expected = [calculate_score(**applicant) for applicant in applicants]
+    assert get_scores_func(target_store, applicants) == expected
+    assert get_scores_func(target_store, applicants) == expected
+
+
+def test_get_scores_single_round_trips(store):
+    applicants = [{"phone": "7917500%04d" % num, "email": "test@otus.ru"} for num in range(10)]
+    applicants.append(applicants[0])
+    with patch.object(store.redis_store, 'mget', wraps=store.redis_store.mget) as mget, \
+            patch.object(store.redis_store, 'pipeline', wraps=store.redis_store.pipeline) as pipeline:
+        assert get_scores(store, applicants) == [3.0] * 11
+    assert mget.call_count == 1
+    assert len(mget.call_args[0][0]) == 10
+    assert pipeline.call_count == 1
+    assert get_scores(store, applicants) == [3.0] * 11
+
+
+def test_get_scores_from_unavailable_store(unavailable_store):
+    assert get_scores(unavailable_store, [{"phone": "79175002040", "email": "test@otus.ru"}]) == [3.0]
+
+
 def test_get_interests_from_unavailable_store(unavailable_store):
     with pytest.raises(redis.exceptions.ConnectionError):
         get_interests(unavailable_store, 1)
@@ -40,3 +88,103 @@ def test_get_interests_from_unavailable_store(unavailable_store):
 
 def test_get_interests_from_store(store):
     assert get_interests(store, 1) == []
+
+
+def test_get_interests_async_equals_sync(store, async_store):
+    store.redis_store.set("i:2", '["cars", "pets"]')
+    asyncio.run(async_store.redis_store.set("i:2", '["cars", "pets"]'))
+    assert asyncio.run(get_interests_async(async_store, 2)) == get_interests(store, 2) == ["cars", "pets"]
+    assert asyncio.run(get_interests_async(async_store, 1)) == get_interests(store, 1) == []
+
+
+def test_get_interests_from_unavailable_async_store(unavailable_async_store):
+    with pytest.raises(redis.exceptions.ConnectionError):
+        asyncio.run(get_interests_async(unavailable_async_store, 1))
+
+
+def test_get_interests_batch_deduplicates_ids(store):
+    store.redis_store.set("i:3", '["books"]')
+    store.redis_store.set("i:4", '["music", "travel"]')
+    with patch.object(store, 'batch_size', 2), patch.object(store.redis_store, 'mget',
+                                                           wraps=store.redis_store.mget) as mget:
+        interests, failed = get_interests_batch(store, [3, 4, 3, 5, 4])
+    assert list(interests.items()) == [(3, ["books"]), (4, ["music", "travel"]), (5, [])]
+    assert failed == {}
+    assert mget.call_count == 2
+
+
+def test_get_interests_batch_reports_failed_chunks(store):
+    store.redis_store.set("i:6", '["cars"]')
+    error = redis.exceptions.ConnectionError()
+    with patch.object(store, 'batch_size', 2), \
+            patch.object(store, 'mget', side_effect=[[b'["cars"]', None], error]):
+        interests, failed = get_interests_batch(store, [6, 7, 8])
+    assert interests == {6: ["cars"], 7: [], 8: None}
+    assert failed == {8: error}
+
+
+def test_get_interests_batch_async_equals_sync(store, async_store):
+    asyncio.run(async_store.redis_store.set("i:3", '["books"]'))
+    assert asyncio.run(get_interests_batch_async(async_store, [3, 5, 3])) == \
+        get_interests_batch(store, [3, 5, 3]) == ({3: ["books"], 5: []}, {})
+
+
+@pytest.fixture
+def negative_cache_store():
+    mocked_redis = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+    with patch('scoring.ScoreStore.create_store', return_value=mocked_redis):
+        yield ScoreStore(negative_cache_size=100, negative_cache_ttl=0.2)
+
+
+def test_get_interests_skips_store_for_known_absent(negative_cache_store):
+    negative_cache_store.redis_store.set("i:1", '["cars"]')
+    with patch.object(negative_cache_store.redis_store, 'get', wraps=negative_cache_store.redis_store.get) as get:
+        assert [get_interests(negative_cache_store, cid) for cid in (1, 2, 1, 2, 2)] == \
+            [["cars"], [], ["cars"], [], []]
+    assert get.call_count == 3
+    assert negative_cache_store.stats()['negative_cache']['hits'] == 2
+
+
+def test_negative_cache_expires(negative_cache_store):
+    assert get_interests(negative_cache_store, 3) == []
+    negative_cache_store.redis_store.set("i:3", '["books"]')
+    assert get_interests(negative_cache_store, 3) == []
+    time.sleep(0.25)
+    assert get_interests(negative_cache_store, 3) == ["books"]
+
+
+def test_get_interests_batch_skips_known_absent(negative_cache_store):
+    negative_cache_store.redis_store.set("i:1", '["cars"]')
+    expected = {1: ["cars"], 2: [], 3: []}
+    assert get_interests_batch(negative_cache_store, [1, 2, 3]) == (expected, {})
+    with patch.object(negative_cache_store.redis_store, 'mget', wraps=negative_cache_store.redis_store.mget) as mget:
+        assert get_interests_batch(negative_cache_store, [1, 2, 3]) == (expected, {})
+        assert list(iter_interests_batch(negative_cache_store, [2, 3])) == [({2: [], 3: []}, {})]
+    assert [call.args[0] for call in mget.call_args_list] == [["i:1"]]
+
+
+def test_negative_cache_ignores_failed_lookups():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    with patch('scoring.ScoreStore.create_store', return_value=fakeredis.FakeStrictRedis(server=server)):
+        failing_store = ScoreStore(negative_cache_size=100, max_retry_attempt_count=1)
+    with pytest.raises(redis.ConnectionError):
+        get_interests(failing_store, 1)
+    assert get_interests_batch(failing_store, [1])[0] == {1: None}
+    assert failing_store.stats()['negative_cache']['entries'] == 0
+
+
+def test_get_interests_async_skips_known_absent():
+    async def run():
+        mocked_redis = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+        with patch('scoring.AsyncScoreStore.create_store', return_value=mocked_redis):
+            negative_store = AsyncScoreStore(negative_cache_size=100)
+        with patch.object(mocked_redis, 'mget', wraps=mocked_redis.mget) as mget:
+            results = [await get_interests_async(negative_store, 1),
+                       await get_interests_batch_async(negative_store, [1, 2]),
+                       await get_interests_batch_async(negative_store, [1, 2])]
+        return results, mget.call_count
+
+    results, mget_calls = asyncio.run(run())
+    assert results == [[], ({1: [], 2: []}, {}), ({1: [], 2: []}, {})]
+    assert mget_calls == 1
@@ -0,0 +1,71 @@
+import pytest
+import hashlib
+from datetime import datetime
+from mock import patch
+
+import api
+
+
+def user_token(account, login):
+    return hashlib.sha512((account + login + api.SALT).encode('UTF-8')).hexdigest()
+
+
+def admin_token(moment):
+    return hashlib.sha512((moment.strftime("%Y%m%d%H") + api.ADMIN_SALT).encode('UTF-8')).hexdigest()
+
+
+@pytest.fixture
+def auth_cache():
+    return api.AuthCache(max_entries=2)
+
+
+def test_user_digest_is_cached(auth_cache):
+    token = user_token("horns&hoofs", "h&f")
+    with patch.object(auth_cache, 'make_digest', wraps=auth_cache.make_digest) as make_digest:
+        assert all(auth_cache.check_user("horns&hoofs", "h&f", token) for _ in range(5))
+        assert make_digest.call_count == 1
+    assert auth_cache.stats() == {'hits': 4, 'misses': 1, 'hit_rate': 0.8, 'entries': 1}
+
+
+def test_cached_user_rejects_wrong_token(auth_cache):
+    assert auth_cache.check_user("horns&hoofs", "h&f", user_token("horns&hoofs", "h&f"))
+    assert not auth_cache.check_user("horns&hoofs", "h&f", user_token("horns&hoofs", "other"))
+    assert not auth_cache.check_user("horns&hoofs", "h&f", "")
+
+
+@pytest.mark.parametrize('token', [None, "", "bad", "неверный", user_token("a", "b")])
+def test_invalid_user_token_is_not_cached(auth_cache, token):
+    assert not auth_cache.check_user("horns&hoofs", "h&f", token)
+    assert auth_cache.stats()['entries'] == 0
+
+
+def test_user_digests_are_evicted_lru(auth_cache):
+    for login in ("a", "b", "a", "c"):
+        assert auth_cache.check_user("acc", login, user_token("acc", login))
+    assert list(auth_cache.digests) == [("acc", "a"), ("acc", "c")]
+
+
+def test_admin_digest_computed_once_per_hour(auth_cache):
+    moment = datetime(2017, 7, 20, 10, 59, 58)
+    with patch('api.time.time', return_value=moment.timestamp()):
+        assert auth_cache.check_admin(admin_token(moment))
+        assert auth_cache.check_admin(admin_token(moment))
+        assert not auth_cache.check_admin(admin_token(datetime(2017, 7, 20, 9)))
+    assert auth_cache.stats()['misses'] == 1
+
+    next_hour = datetime(2017, 7, 20, 11, 0, 1)
+    with patch('api.time.time', return_value=next_hour.timestamp()):
+        assert not auth_cache.check_admin(admin_token(moment))
+        assert auth_cache.check_admin(admin_token(next_hour))
+    assert auth_cache.stats()['misses'] == 2
+
+
+def test_check_auth_uses_cache():
+    api.AUTH_CACHE.clear()
+    request = api.MethodRequest.from_dict({"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                                           "token": user_token("horns&hoofs", "h&f"), "arguments": {}})
+    assert api.check_auth(request)
+    assert api.check_auth(request)
+    assert api.AUTH_CACHE.stats()['hits'] >= 1
+    request.token = admin_token(datetime.now())
+    assert not api.check_auth(request)
@@ -0,0 +1,88 @@
+import pytest
+import json
+from mock import patch
+
+import codec
+
+AVAILABLE_CODECS = [name for name, (available, _) in codec.CODECS.items() if available()]
+
+RESPONSES = [
+    {"response": {"score": 3.0}, "code": 200},
+    {"error": "Invalid Request", "code": 422},
+    {"response": {str(cid): ["cars", "pets", "путешествия", "a/b"] for cid in range(5000)}, "code": 200},
+    {"response": {"1": [], "2": None}, "code": 200},
+    [1, [2, [3, {"4": 5}]], {}, []],
+    {},
+    "string",
+]
+
+
+@pytest.fixture(params=AVAILABLE_CODECS)
+def json_codec(request):
+    return codec.select_codec(request.param)
+
+
+@pytest.mark.parametrize('obj', RESPONSES)
+def test_dumps_returns_bytes(json_codec, obj):
+    data = json_codec.dumps(obj)
+    assert isinstance(data, bytes)
+    assert json.loads(data) == obj
+    assert json_codec.loads(data) == obj
+
+
+@pytest.mark.parametrize('obj', RESPONSES)
+def test_iter_encode_equals_dumps(json_codec, obj):
+    chunks = list(json_codec.iter_encode(obj, chunk_size=1024))
+    assert b''.join(chunks) == json_codec.dumps(obj)
+    assert all(len(chunk) < 2048 for chunk in chunks)
+
+
+@pytest.mark.parametrize('obj', RESPONSES)
+def test_codecs_encode_identically(obj):
+    assert len({codec.select_codec(name).dumps(obj) for name in AVAILABLE_CODECS}) == 1
+
+
+REQUESTS = [
+    b'{"client_ids": [1180591620717411303424, 18446744073709551615, -9223372036854775809], "date": "20.07.2017"}',
+    b'{"client_ids": [1, 2, 9223372036854775807, -9223372036854775808]}',
+    b'{"score": NaN, "big": 1e400, "small": 1e-7, "name": "\\ud800"}',
+    b'{"phone": "79175002040", "token": "' + b'1' * 128 + b'", "price": 0.30000000000000004}',
+    '{"name": "путешествия", "id": 12345678901234567890123}',
+]
+
+
+@pytest.mark.parametrize('data', REQUESTS)
+def test_codecs_parse_like_stdlib(json_codec, data):
+    parsed = json_codec.loads(data)
+    assert repr(parsed) == repr(json.loads(data))
+
+
+@pytest.mark.parametrize('data', [b'{"a": ', b'[1, 2', b'', b'{"a": 1} x', b'[12345678901234567890123'])
+def test_codecs_reject_invalid_json(json_codec, data):
+    with pytest.raises(ValueError):
+        json_codec.loads(data)
+
+
+@pytest.mark.parametrize('obj', [{"ids": [2 ** 70, -2 ** 70]}, {2 ** 70: [1, 2]}, [1, 0.5, -0.0, 1e15, True, None]])
+def test_codecs_encode_like_stdlib(json_codec, obj):
+    assert json_codec.dumps(obj) == codec.stdlib_dumps(obj)
+    assert b''.join(json_codec.iter_encode(obj)) == codec.stdlib_dumps(obj)
+
+
+def test_non_str_keys(json_codec):
+    assert json_codec.dumps({1: 2}) == b'{"1":2}'
+    assert b''.join(json_codec.iter_encode({1: [1], None: 2})) == json_codec.dumps({1: [1], None: 2})
+
+
+def test_select_codec_falls_back_to_stdlib():
+    with patch('codec.orjson', None), patch('codec.ujson', None):
+        assert codec.select_codec().name == 'json'
+        with pytest.raises(ValueError):
+            codec.select_codec('orjson')
+
+
+def test_streamed_object_encodes_like_dict(json_codec):
+    obj = {"response": {str(num): [num, "x"] for num in range(3000)}, "code": 200}
+    streamed = {"response": codec.StreamedObject(iter(obj["response"].items())), "code": 200}
+    assert b''.join(json_codec.iter_encode(streamed, chunk_size=1024)) == json_codec.dumps(obj)
+    assert b''.join(json_codec.iter_encode(codec.StreamedObject(iter([])))) == b'{}'
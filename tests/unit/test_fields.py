@@ -1,7 +1,8 @@
 import pytest
 from datetime import datetime, date
 from dateutil.relativedelta import relativedelta
-from api import ValidationError, GENDERS
+from mock import patch
+from api import ValidationError, GENDERS, DateField, BirthDayField, ArgumentsField
 
 from tests.fixtures import fields_set
 
@@ -15,6 +16,34 @@ def test_set_invalid_arguments_field(fields_set, value):
         fields_set.arguments_field = value
 
 
+@pytest.mark.parametrize('value', [
+    {'key': {'nested': [1, {'test'}]}},
+    {('tuple', 'key'): 1},
+    [1, 2, object()],
+])
+def test_set_invalid_nested_arguments_field(fields_set, value):
+    with pytest.raises(ValidationError):
+        fields_set.arguments_field = value
+
+
+@pytest.mark.parametrize('value', [
+    {'client_ids': list(range(1000)), 'date': None, 'nested': {'list': [1.5, True, None, 'str', (1, 2)]}},
+    {1: 'int key', None: 'null key'},
+])
+def test_set_correct_nested_arguments_field(fields_set, value):
+    fields_set.arguments_field = value
+    assert value is fields_set.arguments_field
+
+
+def test_arguments_field_shared_references():
+    shared = [1, 2]
+    circular = {'key': shared}
+    circular['self'] = circular
+    assert ArgumentsField.is_json({'first': shared, 'second': shared, 'nested': [shared, {'third': shared}]})
+    assert not ArgumentsField.is_json(circular)
+    assert not ArgumentsField.is_json({'nested': circular})
+
+
 @pytest.mark.parametrize('value', [
     '',
     {"phone": "79175002040", "email": "stupnikov@otus.ru", "first_name": "Стансилав", "last_name": "Ступников", ' \
@@ -181,3 +210,53 @@ def test_set_correct_gender_field(fields_set, value):
 def test_set_invalid_client_ids_field(fields_set, value):
     with pytest.raises(ValidationError):
         fields_set.client_ids_field = value
+
+
+@pytest.mark.parametrize('value', [
+    '32.01.2000',
+    '29.02.2001',
+    '00.01.2000',
+])
+def test_set_impossible_date_field(fields_set, value):
+    with pytest.raises(ValidationError):
+        fields_set.date_field = value
+
+
+@pytest.mark.parametrize('value', [
+    '01.01.2000',
+    '29.02.2000',
+    '31.10.1999',
+])
+def test_str_to_date_equals_strptime(value):
+    assert DateField.str_to_date(value) == datetime.strptime(value, '%d.%m.%Y')
+
+
+def test_date_field_is_parsed_once(fields_set):
+    with patch.object(DateField, 'str_to_date', wraps=DateField.str_to_date) as str_to_date:
+        fields_set.date_field = '01.01.2020'
+        for _ in range(3):
+            assert fields_set.date_field == datetime(2020, 1, 1)
+    assert str_to_date.call_count == 1
+
+
+def test_set_empty_birthdate_field(fields_set):
+    fields_set.birthday_field = ''
+    assert fields_set.birthday_field is None
+
+
+def test_set_oldest_birthdate_field(fields_set):
+    value = (datetime.today() - relativedelta(years=70, days=-1)).strftime('%d.%m.%Y')
+    fields_set.birthday_field = value
+    assert fields_set.birthday_field == datetime.strptime(value, '%d.%m.%Y')
+
+
+def test_birthdate_exactly_70_years_ago_is_invalid(fields_set):
+    with pytest.raises(ValidationError):
+        fields_set.birthday_field = (datetime.today() - relativedelta(years=70)).strftime('%d.%m.%Y')
+
+
+def test_birthday_bounds_computed_once_per_day(fields_set):
+    BirthDayField.bounds.cache_clear()
+    fields_set.birthday_field = '01.01.2000'
+    fields_set.birthday_field = '01.01.2001'
+    assert BirthDayField.bounds.cache_info().misses == 1
@@ -0,0 +1,134 @@
+import pytest
+import json
+import logging
+import os
+import threading
+
+import logs
+from logs import AsyncLogHandler, JsonFormatter, TextFormatter
+
+
+class CollectingHandler(logging.Handler):
+    def __init__(self, gate=None):
+        super(CollectingHandler, self).__init__()
+        self.gate = gate
+        self.records = []
+
+    def emit(self, record):
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.records.append((threading.current_thread().name, self.format(record)))
+
+
+def make_record(msg, *args, exc_info=None):
+    return logging.LogRecord('test', logging.INFO, __file__, 1, msg, args, exc_info)
+
+
+@pytest.fixture
+def root_logger():
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    yield root
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+
+def test_truncate():
+    assert logs.truncate('abc', 3) == 'abc'
+    assert logs.truncate('abcdef', 3) == 'abc...<3 more>'
+    assert logs.truncate('abcdef', None) == 'abcdef'
+
+
+def test_text_formatter_truncates_message():
+    formatter = TextFormatter(fmt='%(message)s', max_length=10)
+    assert formatter.format(make_record('%s: %s', '/method', 'x' * 100)) == '/method: x...<99 more>'
+
+
+def test_json_formatter_fields():
+    formatter = JsonFormatter(max_length=20)
+    entry = json.loads(formatter.format(make_record({"request_id": "42", "code": 200, "has": ["phone"],
+                                                      "response": {str(cid): ["cars"] for cid in range(10)}})))
+    assert entry["level"] == "INFO" and entry["time"]
+    assert entry["request_id"] == "42"
+    assert entry["code"] == 200
+    assert entry["has"] == ["phone"]
+    assert entry["response"].startswith('{"0":["cars"],"1":[') and entry["response"].endswith(' more>')
+
+
+def test_json_formatter_message():
+    formatter = JsonFormatter(max_length=30)
+    line = formatter.format(make_record('%s: %s %s', '/method', b'{"body": "\n' + b'x' * 100, 'id'))
+    assert '\n' not in line
+    assert json.loads(line)["message"] == '/method: b\'{"body": "\\nxxxxxxx...<97 more>'
+
+
+def test_json_formatter_exception():
+    try:
+        raise ValueError('boom')
+    except ValueError as e:
+        record = make_record('Unexpected error: %s', e, exc_info=(type(e), e, e.__traceback__))
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["message"] == 'Unexpected error: boom'
+    assert 'ValueError: boom' in entry["exception"]
+
+
+def test_async_handler_writes_in_background():
+    target = CollectingHandler()
+    handler = AsyncLogHandler(target)
+    for num in range(100):
+        handler.handle(make_record('record %s', num))
+    handler.close()
+    assert target.records == [('log-writer', 'record %s' % num) for num in range(100)]
+
+
+@pytest.mark.parametrize('policy, written', [
+    (AsyncLogHandler.DROP_NEW, ['0', '1', '2']),
+    (AsyncLogHandler.DROP_OLDEST, ['0', '3', '4']),
+])
+def test_async_handler_overflow(policy, written):
+    release = threading.Event()
+    target = CollectingHandler(release)
+    handler = AsyncLogHandler(target, max_size=2, policy=policy)
+    handler.handle(make_record('0'))
+    while not handler.background.queue.empty():
+        pass
+    for num in range(1, 5):
+        handler.handle(make_record(str(num)))
+    assert handler.dropped == 2
+    release.set()
+    handler.close()
+    assert [message for _, message in target.records] == written
+
+
+def test_async_handler_forked_child_does_not_write_parent_records():
+    gate = threading.Event()
+    target = CollectingHandler(gate)
+    handler = AsyncLogHandler(target)
+    handler.handle(make_record('parent 1'))
+    handler.handle(make_record('parent 2'))
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            gate.set()
+            handler.handle(make_record('child'))
+            handler.close()
+            code = 0 if [message for _, message in target.records] == ['child'] else 2
+        finally:
+            os._exit(code)
+    gate.set()
+    handler.close()
+    assert os.waitpid(pid, 0)[1] == 0
+    assert [message for _, message in target.records] == ['parent 1', 'parent 2']
+
+
+def test_setup_replaces_root_handlers(root_logger, tmp_path):
+    path = tmp_path / 'api.log'
+    handler = logs.setup(str(path), json_format=True, queue_size=10)
+    assert root_logger.handlers == [handler]
+    logging.info({"request_id": "42", "code": 200})
+    handler.close()
+    assert json.loads(path.read_text())["request_id"] == "42"
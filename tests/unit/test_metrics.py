@@ -0,0 +1,118 @@
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from mock import patch
+import fakeredis
+import redis
+
+import api
+import scoring
+from metrics import Registry
+from tests.fixtures import store
+
+
+def test_counter_render():
+    registry = Registry()
+    counter = registry.counter('requests_total', 'Requests', ('method', 'code'))
+    counter.inc(('ONLINE_SCORE', '200'))
+    counter.inc(('ONLINE_SCORE', '200'), 2)
+    counter.inc(('say "hi"\n', '422'))
+    assert registry.render() == ('# HELP requests_total Requests\n'
+                                 '# TYPE requests_total counter\n'
+                                 'requests_total{method="ONLINE_SCORE",code="200"} 3\n'
+                                 'requests_total{method="say \\"hi\\"\\n",code="422"} 1\n')
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value)
+    assert registry.render().splitlines()[2:] == [
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        'latency_seconds_sum 2.65',
+        'latency_seconds_count 4',
+    ]
+
+
+def test_histogram_timer():
+    histogram = Registry().histogram('stage_seconds', 'Stage', ('stage',))
+    with pytest.raises(ValueError):
+        with histogram.time(('parse',)):
+            raise ValueError()
+    count, total = histogram.get(('parse',))
+    assert count == 1 and 0 <= total < 1
+
+
+def test_registry_returns_existing_metric():
+    registry = Registry()
+    counter = registry.counter('calls_total', 'Calls')
+    assert registry.counter('calls_total', 'Calls') is counter
+    with pytest.raises(ValueError):
+        registry.histogram('calls_total', 'Calls')
+
+
+def test_empty_metrics_are_not_rendered():
+    registry = Registry()
+    registry.counter('calls_total', 'Calls')
+    assert registry.render() == '\n'
+
+
+def test_collector_reads_samples_when_rendered():
+    registry = Registry()
+    values = {'hit': 1}
+    registry.collector('lookups_total', 'Lookups', lambda: [((result,), count) for result, count in values.items()],
+                       ('result',), 'counter')
+    values['miss'] = 2.0
+    assert registry.render() == ('# HELP lookups_total Lookups\n'
+                                 '# TYPE lookups_total counter\n'
+                                 'lookups_total{result="hit"} 1\n'
+                                 'lookups_total{result="miss"} 2\n')
+    registry.collector('lookups_total', 'Lookups', lambda: [(('hit',), 5)], ('result',), 'counter')
+    assert registry.render().splitlines()[2:] == ['lookups_total{result="hit"} 5']
+    registry.collector('size', 'Size', lambda: [])
+    assert '# TYPE size' not in registry.render()
+
+
+def test_concurrent_increments():
+    counter = Registry().counter('calls_total', 'Calls')
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: [counter.inc() for _ in range(1000)], range(8)))
+    assert counter.get() == 8000
+
+
+def test_method_handler_stages(store):
+    stages = ['validate', 'auth', 'arguments', 'handler']
+    before = [api.STAGE_LATENCY.get((stage,))[0] for stage in stages]
+    request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "",
+               "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+    request["token"] = api.AUTH_CACHE.make_digest(request["account"] + request["login"] + api.SALT).decode()
+    ctx = {}
+    _, code = api.method_handler({"body": request, "headers": {}}, ctx, store)
+    assert code == api.OK
+    assert ctx['method'] == 'ONLINE_SCORE'
+    assert [api.STAGE_LATENCY.get((stage,))[0] for stage in stages] == [count + 1 for count in before]
+
+
+def test_score_cache_hits(store):
+    hits, misses = scoring.SCORE_CACHE.get(('hit',)), scoring.SCORE_CACHE.get(('miss',))
+    scoring.get_scores(store, [{"phone": "79175002049", "email": None}] * 2)
+    scoring.get_scores(store, [{"phone": "79175002049", "email": None}])
+    assert scoring.SCORE_CACHE.get(('miss',)) - misses == 2
+    assert scoring.SCORE_CACHE.get(('hit',)) - hits == 1
+
+
+def test_redis_calls_and_retries(store):
+    server = fakeredis.FakeServer()
+    server.connected = False
+    with patch('scoring.ScoreStore.create_store', return_value=fakeredis.FakeStrictRedis(server=server)):
+        unavailable_store = scoring.ScoreStore(max_retry_attempt_count=2, retry_backoff=0)
+    ok, errors = scoring.REDIS_LATENCY.get(('get_one', 'ok'))[0], scoring.REDIS_LATENCY.get(('get_one', 'error'))[0]
+    retries = scoring.REDIS_RETRIES.get(('get_one',))
+    store.get("i:1")
+    with pytest.raises(redis.ConnectionError):
+        unavailable_store.get("i:1")
+    assert scoring.REDIS_LATENCY.get(('get_one', 'ok'))[0] - ok == 1
+    assert scoring.REDIS_LATENCY.get(('get_one', 'error'))[0] - errors == 2
+    assert scoring.REDIS_RETRIES.get(('get_one',)) - retries == 1
@@ -1,7 +1,8 @@
 import pytest
+import re
 from datetime import datetime
 
-from api import ValidationError, ClientsInterestsRequest, OnlineScoreRequest
+from api import ValidationError, ClientsInterestsRequest, OnlineScoreRequest, MethodRequest
 
 
 @pytest.mark.parametrize('source_dict', [
@@ -54,3 +55,43 @@ def test_invalid_online_score_request(fields_set, source_dict):
     request = OnlineScoreRequest.from_dict(source_dict)
     with pytest.raises(ValidationError):
         assert not request.validate().success
+
+
+def test_request_validation_plan():
+    assert OnlineScoreRequest.validation_plan == (
+        ('first_name', False, True),
+        ('last_name', False, True),
+        ('email', False, True),
+        ('phone', False, True),
+        ('birthday', False, True),
+        ('gender', False, True),
+    )
+    assert list(MethodRequest.declared_fields) == ['account', 'login', 'token', 'arguments', 'method']
+
+
+def test_from_dict_sets_only_declared_fields():
+    request = OnlineScoreRequest.from_dict({"first_name": "John", "last_name": "Smith", "is_admin": True,
+                                            "validate": None})
+    request.validate()
+    assert not request.is_admin
+    assert request.first_name == "John"
+
+
+@pytest.mark.parametrize('source_dict, message', [
+    ({'date': None}, 'client_ids is required'),
+    ({'client_ids': []}, 'client_ids is not nullable'),
+    ({'client_ids': ['1']}, "['1'] should contain only integers"),
+])
+def test_client_ids_request_error_messages(source_dict, message):
+    with pytest.raises(ValidationError, match=re.escape(message)):
+        ClientsInterestsRequest.from_dict(source_dict).validate()
+
+
+def test_request_values_are_stored_in_slots():
+    first = OnlineScoreRequest.from_dict({"first_name": "John", "last_name": "Smith"})
+    second = OnlineScoreRequest.from_dict({"first_name": "Jane"})
+    assert not hasattr(first, '__dict__')
+    assert (first.first_name, first.last_name) == ("John", "Smith")
+    assert (second.first_name, second.last_name) == ("Jane", None)
+    assert OnlineScoreRequest.first_name.required is False
+    assert OnlineScoreRequest.first_name.nullable is True
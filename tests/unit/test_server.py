@@ -0,0 +1,136 @@
+import pytest
+import contextlib
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler
+
+from server import ThreadPoolHTTPServer, PreforkServer
+from tests.fixtures import store
+
+
+class SleepHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/slow':
+            time.sleep(1)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PidHandler(SleepHandler):
+    def do_GET(self):
+        body = str(os.getpid()).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def threaded_server():
+    server = ThreadPoolHTTPServer(('localhost', 0), SleepHandler, workers=4, backlog=16)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def prefork_server():
+    server = PreforkServer(('localhost', 0), PidHandler, processes=2, workers=2, poll_interval=0.1,
+                           graceful_timeout=5)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            server.serve_forever()
+        finally:
+            os._exit(0)
+    server.socket.close()
+    server.master_pid = pid
+    yield server
+    with contextlib.suppress(ProcessLookupError, ChildProcessError):
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+
+def wait_for_pids(server, count, timeout=5):
+    pids = set()
+    deadline = time.time() + timeout
+    while len(pids) < count and time.time() < deadline:
+        pids.add(int(get(server, '/')[1]))
+    return pids
+
+
+def get(server, path):
+    connection = HTTPConnection(*server.server_address, timeout=5)
+    connection.request('GET', path)
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response.status, body
+
+
+def test_slow_request_does_not_block_others(threaded_server):
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        slow = executor.submit(get, threaded_server, '/slow')
+        time.sleep(0.1)
+        started = time.time()
+        assert get(threaded_server, '/fast') == (200, b'ok')
+        assert time.time() - started < 0.5
+        assert slow.result() == (200, b'ok')
+
+
+def test_burst_is_served(threaded_server):
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        results = list(executor.map(lambda _: get(threaded_server, '/fast'), range(64)))
+    assert results == [(200, b'ok')] * 64
+
+
+def test_store_shared_between_threads(store):
+    def worker(num):
+        store.cache_set('thread:%s' % num, num, 10)
+        return int(store.cache_get('thread:%s' % num))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert list(executor.map(worker, range(32))) == list(range(32))
+
+
+def test_prefork_workers_share_socket(prefork_server):
+    pids = wait_for_pids(prefork_server, 2)
+    assert len(pids) == 2
+    assert prefork_server.master_pid not in pids
+
+
+def test_prefork_restarts_crashed_worker(prefork_server):
+    pids = wait_for_pids(prefork_server, 2)
+    killed = pids.pop()
+    os.kill(killed, signal.SIGKILL)
+    time.sleep(0.5)
+    new_pids = wait_for_pids(prefork_server, 2)
+    assert len(new_pids) == 2
+    assert killed not in new_pids
+
+
+def test_prefork_reload_replaces_workers(prefork_server):
+    pids = wait_for_pids(prefork_server, 2)
+    os.kill(prefork_server.master_pid, signal.SIGHUP)
+    time.sleep(1)
+    new_pids = wait_for_pids(prefork_server, 2)
+    assert len(new_pids) == 2
+    assert not new_pids & pids
+
+
+def test_prefork_graceful_stop(prefork_server):
+    wait_for_pids(prefork_server, 2)
+    os.kill(prefork_server.master_pid, signal.SIGTERM)
+    _, status = os.waitpid(prefork_server.master_pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
@@ -0,0 +1,150 @@
+import pytest
+import asyncio
+import collections
+import contextlib
+import json
+import threading
+import fakeredis
+from mock import patch
+
+import scoring
+import tracing
+from scoring import HashRing, ScoreStore, AsyncScoreStore
+from tests.fixtures import make_nodes, patch_create_store
+
+SHARDS = [{'host': 'shard-%s' % num, 'port': 6379} for num in range(3)]
+NODES = [(shard['host'], shard['port']) for shard in SHARDS]
+
+
+@pytest.fixture
+def sharded_store():
+    servers, clients = make_nodes(NODES, fakeredis.FakeStrictRedis)
+    with patch_create_store(ScoreStore, clients):
+        sharded_store = ScoreStore(shards=SHARDS, max_retry_attempt_count=1, batch_size=10)
+    yield sharded_store, servers, clients
+    sharded_store.executor.shutdown()
+
+
+def test_ring_spreads_keys():
+    ring = HashRing({name: name for name in 'abc'})
+    counts = collections.Counter(ring.get_shard('i:%s' % num) for num in range(10000))
+    assert set(counts) == set('abc')
+    assert all(2000 < count < 4700 for count in counts.values())
+
+
+def test_ring_moves_few_keys_when_shard_added():
+    keys = ['uid:%s' % num for num in range(10000)]
+    ring = HashRing({name: name for name in 'abc'})
+    grown = HashRing({name: name for name in 'abcd'})
+    moved = [key for key in keys if ring.get_shard(key) != grown.get_shard(key)]
+    assert len(moved) < len(keys) * 0.35
+    assert all(grown.get_shard(key) == 'd' for key in moved)
+
+
+def test_ring_group_keeps_key_order():
+    ring = HashRing({name: name for name in 'abc'})
+    keys = ['i:%s' % num for num in range(100)]
+    groups = ring.group(keys)
+    assert sorted(key for group in groups.values() for key in group) == sorted(keys)
+    for shard, group in groups.items():
+        assert group == [key for key in keys if ring.get_shard(key) == shard]
+    assert HashRing({'only': 'only'}).group(keys) == {'only': keys}
+
+
+def test_sharded_store_places_keys_on_their_shard(sharded_store):
+    sharded_store, _, clients = sharded_store
+    values = {'uid:%s' % num: num for num in range(100)}
+    sharded_store.cache_set_many(values, 60)
+    sharded_store.cache_set('single', 1, 60)
+
+    for key in list(values) + ['single']:
+        owner = sharded_store.cache_ring.get_name(key)
+        for (host, port), client in clients.items():
+            assert (client.get(key) is not None) == ('%s:%s' % (host, port) == owner)
+    assert sharded_store.cache_get_many(list(values)) == {key: str(value).encode() for key, value in values.items()}
+    assert sharded_store.cache_get('single') == b'1'
+
+
+def test_sharded_store_batches_per_shard_in_parallel(sharded_store):
+    sharded_store, _, clients = sharded_store
+    cids = list(range(60))
+    for cid in cids:
+        node = sharded_store.interests_ring.get_shard('i:%s' % cid).primary
+        node.set('i:%s' % cid, json.dumps([str(cid)]))
+
+    threads = collections.defaultdict(set)
+
+    def recording_mget(node, mget):
+        def wrapper(keys):
+            threads[node].add(threading.current_thread().name)
+            return mget(keys)
+        return wrapper
+
+    with contextlib.ExitStack() as stack:
+        for node, client in clients.items():
+            stack.enter_context(patch.object(client, 'mget', recording_mget(node, client.mget)))
+        interests, failed = scoring.get_interests_batch(sharded_store, cids)
+
+    assert failed == {}
+    assert interests == {cid: [str(cid)] for cid in cids}
+    assert set(threads) == set(clients)
+    assert all(name.startswith('shard') for names in threads.values() for name in names)
+
+
+def test_sharded_store_reports_down_shard(sharded_store):
+    sharded_store, servers, _ = sharded_store
+    down = ('shard-1', 6379)
+    servers[down].connected = False
+    cids = list(range(50))
+    interests, failed = scoring.get_interests_batch(sharded_store, cids)
+    down_cids = {cid for cid in cids if sharded_store.interests_ring.get_name('i:%s' % cid) == 'shard-1:6379'}
+    assert down_cids and set(failed) == down_cids
+    assert all(interests[cid] == [] for cid in cids if cid not in down_cids)
+
+
+def test_down_shard_trips_only_its_circuit_breaker(sharded_store):
+    sharded_store, servers, _ = sharded_store
+    keys = ['i:%s' % num for num in range(30)]
+    for key in keys:
+        sharded_store.interests_ring.get_shard(key).primary.set(key, key)
+    servers[('shard-1', 6379)].connected = False
+    down_keys = {key for key in keys if sharded_store.interests_ring.get_name(key) == 'shard-1:6379'}
+
+    for _ in range(5):
+        values, errors = sharded_store.get_many(keys)
+        assert set(errors) == down_keys
+        assert values == {key: key.encode() for key in keys if key not in down_keys}
+    states = {name: shard['circuit_breaker']['state'] for name, shard in sharded_store.stats()['shards'].items()}
+    assert states == {'shard-0:6379': 'closed', 'shard-1:6379': 'open', 'shard-2:6379': 'closed'}
+    with pytest.raises(scoring.CircuitOpenError):
+        sharded_store.get(next(iter(down_keys)))
+    assert all(sharded_store.get(key) == key.encode() for key in keys if key not in down_keys)
+
+
+def test_sharded_async_store():
+    servers, clients = make_nodes(NODES, fakeredis.FakeAsyncRedis)
+
+    async def run():
+        with patch_create_store(AsyncScoreStore, clients):
+            sharded_store = AsyncScoreStore(shards=SHARDS, batch_size=10)
+        cids = list(range(40))
+        for cid in cids:
+            await sharded_store.interests_ring.get_shard('i:%s' % cid).primary.set('i:%s' % cid, json.dumps([cid]))
+        await sharded_store.cache_set_many({'uid:%s' % cid: cid for cid in cids}, 60)
+        sizes = [await client.dbsize() for client in clients.values()]
+        interests, failed = await scoring.get_interests_batch_async(sharded_store, cids)
+        return sizes, interests == {cid: [cid] for cid in cids}, failed
+
+    sizes, interests_match, failed = asyncio.run(run())
+    assert sum(sizes) == 80 and all(sizes)
+    assert interests_match and failed == {}
+
+
+def test_shard_calls_are_traced(sharded_store):
+    sharded_store, _, _ = sharded_store
+    trace = tracing.start('shards')
+    sharded_store.get_many(['i:%s' % num for num in range(30)])
+    tracing.finish(trace)
+    calls = [span for span in trace.spans if span[0] == 'redis.mget']
+    assert len(calls) >= 3
+    assert trace.tid not in {span[3] for span in calls}
@@ -0,0 +1,103 @@
+import pytest
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from mock import patch
+
+import scoring
+from scoring import SingleFlight
+from tests.fixtures import store, async_store
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_concurrent_calls_share_result():
+    single_flight = SingleFlight()
+    release = threading.Event()
+    coalesced = scoring.SINGLE_FLIGHT_COALESCED.get()
+    calls = []
+
+    def slow(value):
+        calls.append(value)
+        release.wait(5)
+        return value * 2
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(single_flight.do, 'key', slow, 21) for _ in range(8)]
+        wait_for(lambda: single_flight.stats()['coalesced'] == 7)
+        release.set()
+        assert [future.result() for future in futures] == [42] * 8
+    assert calls == [21]
+    assert single_flight.stats() == {'coalesced': 7, 'in_flight': 0}
+    assert scoring.SINGLE_FLIGHT_COALESCED.get() - coalesced == 7
+    assert single_flight.do('key', lambda: 1) == 1
+
+
+def test_concurrent_calls_share_error():
+    single_flight = SingleFlight()
+    release = threading.Event()
+
+    def failing():
+        release.wait(5)
+        raise ValueError('lookup failed')
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(single_flight.do, 'key', failing) for _ in range(4)]
+        wait_for(lambda: single_flight.stats()['coalesced'] == 3)
+        release.set()
+        for future in futures:
+            with pytest.raises(ValueError):
+                future.result()
+    assert single_flight.stats()['in_flight'] == 0
+
+
+def test_get_score_coalesces_lookups(store):
+    release = threading.Event()
+    cache_get = store.cache_get
+
+    def slow_cache_get(key):
+        release.wait(5)
+        return cache_get(key)
+
+    coalesced = store.single_flight.stats()['coalesced']
+    with patch.object(store, 'cache_get', side_effect=slow_cache_get) as mocked_get, \
+            patch('scoring.calculate_score', wraps=scoring.calculate_score) as calculate, \
+            ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(scoring.get_score, store, "79990000019", "single@flight.ru") for _ in range(8)]
+        wait_for(lambda: store.single_flight.stats()['coalesced'] == coalesced + 7)
+        release.set()
+        assert [future.result() for future in futures] == [3.0] * 8
+    assert mocked_get.call_count == 1
+    assert calculate.call_count == 1
+
+
+def test_get_score_async_coalesces_lookups(async_store):
+    coalesced = scoring.SINGLE_FLIGHT_COALESCED.get()
+
+    async def run():
+        cache_get = async_store.cache_get
+        calls = []
+
+        async def slow_cache_get(key):
+            calls.append(key)
+            await asyncio.sleep(0.1)
+            return await cache_get(key)
+
+        with patch.object(async_store, 'cache_get', side_effect=slow_cache_get):
+            tasks = [asyncio.ensure_future(scoring.get_score_async(async_store, "79990000020", "a@b.ru"))
+                     for _ in range(8)]
+            await asyncio.sleep(0.01)
+            tasks[0].cancel()
+            results = await asyncio.gather(*tasks[1:])
+        return calls, results, async_store.single_flight.stats()
+
+    calls, results, stats = asyncio.run(run())
+    assert len(calls) == 1
+    assert results == [3.0] * 7
+    assert stats['coalesced'] >= 7 and stats['in_flight'] == 0
+    assert scoring.SINGLE_FLIGHT_COALESCED.get() - coalesced >= 7
@@ -1,9 +1,18 @@
 import pytest
+import asyncio
+import threading
 import time
 import redis
 import json
+import fakeredis
+from mock import patch
 
-from tests.fixtures import unavailable_store, store
+import scoring
+from scoring import ScoreStore, AsyncScoreStore, LocalCache, RetryPolicy, CircuitBreaker, CircuitOpenError
+from tests.fixtures import unavailable_store, store, make_nodes, patch_create_store
+
+# module scoped store fixtures patch create_store, the real one is kept for the pool tests
+CREATE_STORE = {cls: cls.__dict__['create_store'] for cls in (ScoreStore, AsyncScoreStore)}
 
 
 def test_get_raise_exception(unavailable_store):
@@ -49,3 +58,437 @@ def test_cached_store_invalid_cache(store):
     store.cache_set('key', 10, 1)
     time.sleep(2)
     assert (store.cache_get('key') is None)
+
+
+@pytest.fixture
+def local_cache_store():
+    server = fakeredis.FakeServer()
+    mocked_redis = fakeredis.FakeStrictRedis(server=server)
+    with patch('scoring.ScoreStore.create_store', return_value=mocked_redis):
+        store = ScoreStore(max_retry_attempt_count=1, local_cache_size=100)
+    store.server = server
+    yield store
+
+
+def test_local_cache_lru_eviction():
+    cache = LocalCache(max_entries=2)
+    cache.set('a', 1, 10)
+    cache.set('b', 2, 10)
+    assert cache.get('a') == b'1'
+    cache.set('c', 3, 10)
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1'
+    assert cache.get('c') == b'3'
+    assert cache.stats() == {'hits': 3, 'misses': 1, 'evictions': 1, 'expirations': 0, 'entries': 2,
+                             'bytes': 4}
+
+
+def test_local_cache_bytes_limit():
+    cache = LocalCache(max_entries=100, max_bytes=20)
+    cache.set('a', 'x' * 9, 10)
+    cache.set('b', 'y' * 9, 10)
+    cache.set('c', 'z' * 9, 10)
+    cache.set('d', 'big' * 10, 10)
+    assert cache.get('a') is None
+    assert cache.get('b') == b'y' * 9
+    assert cache.get('c') == b'z' * 9
+    assert cache.get('d') is None
+    assert cache.stats()['bytes'] == 20
+
+
+def test_local_cache_oversize_value_drops_older_entry():
+    cache = LocalCache(max_entries=100, max_bytes=20)
+    cache.set('k', 1, 10)
+    cache.set('k', 'x' * 30, 10)
+    assert cache.get('k') is None
+    assert cache.stats()['bytes'] == 0
+
+
+def test_local_cache_ttl():
+    cache = LocalCache()
+    cache.set('key', 1.5, 0.1)
+    assert cache.get('key') == b'1.5'
+    time.sleep(0.2)
+    assert cache.get('key') is None
+    assert cache.stats()['expirations'] == 1
+
+
+def test_local_cache_is_thread_safe():
+    cache = LocalCache(max_entries=50)
+
+    def worker(num):
+        for i in range(200):
+            cache.set('key:%s' % ((num + i) % 80), i, 10)
+            cache.get('key:%s' % (i % 80))
+
+    threads = [threading.Thread(target=worker, args=(num,)) for num in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    assert stats['entries'] == 50
+    assert stats['hits'] + stats['misses'] == 8 * 200
+
+
+def test_cache_set_populates_both_tiers(local_cache_store):
+    local_cache_store.cache_set('score', 3.5, 60)
+    assert local_cache_store.local_cache.get('score') == b'3.5'
+    assert local_cache_store.redis_store.get('score') == b'3.5'
+
+
+def test_cache_get_falls_through_to_redis(local_cache_store):
+    local_cache_store.redis_store.set('remote', 2)
+    assert local_cache_store.cache_get('remote') == b'2'
+    assert local_cache_store.local_cache.stats()['misses'] == 1
+
+
+def test_cache_get_backfills_local_cache_with_redis_ttl(local_cache_store):
+    local_cache_store.redis_store.psetex('warm', 60000, 1)
+    local_cache_store.redis_store.set('persistent', 2)
+    assert local_cache_store.cache_get('warm') == b'1'
+    assert local_cache_store.cache_get_many(['persistent']) == {'persistent': b'2'}
+    assert 59 < local_cache_store.local_cache.entries['warm'][1] - time.monotonic() <= 60
+    # keys without a ttl are never evicted by redis, they are not kept locally
+    assert 'persistent' not in local_cache_store.local_cache.entries
+    local_cache_store.server.connected = False
+    assert local_cache_store.cache_get('warm') == b'1'
+
+
+def test_async_cache_get_backfills_local_cache_with_redis_ttl():
+    server = fakeredis.FakeServer()
+    with patch('scoring.AsyncScoreStore.create_store', return_value=fakeredis.FakeAsyncRedis(server=server)):
+        store = AsyncScoreStore(max_retry_attempt_count=1, local_cache_size=100)
+
+    async def run():
+        await store.redis_store.psetex('warm', 60000, 1)
+        return await store.cache_get_many(['warm', 'missing'])
+
+    assert asyncio.run(run()) == {'warm': b'1', 'missing': None}
+    assert 59 < store.local_cache.entries['warm'][1] - time.monotonic() <= 60
+    assert 'missing' not in store.local_cache.entries
+
+
+def test_local_cache_serves_while_redis_down(local_cache_store):
+    local_cache_store.cache_set_many({'first': 1, 'second': 2}, 60)
+    local_cache_store.server.connected = False
+    assert local_cache_store.cache_get('first') == b'1'
+    assert local_cache_store.cache_get_many(['first', 'second', 'third']) == {'first': b'1', 'second': b'2'}
+    assert local_cache_store.cache_get('third') is None
+
+
+@pytest.fixture
+def breaker_store():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    mocked_redis = fakeredis.FakeStrictRedis(server=server)
+    with patch('scoring.ScoreStore.create_store', return_value=mocked_redis):
+        store = ScoreStore(max_retry_attempt_count=3, retry_backoff=0.01, breaker_failure_threshold=4,
+                           breaker_recovery_timeout=0.2)
+    store.server = server
+    yield store
+
+
+def test_retry_policy_backoff():
+    policy = RetryPolicy(max_attempts=4, backoff=0.1, max_backoff=0.3, deadline=10)
+    deadline = time.monotonic() + 10
+    for attempt_num, limit in enumerate([0.1, 0.2, 0.3]):
+        assert 0 <= policy.next_delay(attempt_num, deadline) <= limit
+    assert policy.next_delay(3, deadline) is None
+    assert policy.retries == 3
+
+
+def test_retry_policy_deadline():
+    policy = RetryPolicy(max_attempts=10, backoff=1, max_backoff=1)
+    assert policy.next_delay(0, time.monotonic() - 1) is None
+
+
+def test_retry_deadline_limits_call_time():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    with patch('scoring.ScoreStore.create_store', return_value=fakeredis.FakeStrictRedis(server=server)):
+        store = ScoreStore(max_retry_attempt_count=100, retry_backoff=0.05, retry_max_backoff=0.05,
+                           retry_deadline=0.3, breaker_failure_threshold=1000)
+    started = time.monotonic()
+    with pytest.raises(redis.exceptions.ConnectionError):
+        store.get('key')
+    assert time.monotonic() - started < 0.5
+
+
+@pytest.fixture
+def down_batch_store():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    with patch('scoring.ScoreStore.create_store', return_value=fakeredis.FakeStrictRedis(server=server)):
+        store = ScoreStore(max_retry_attempt_count=100, retry_backoff=0.05, retry_max_backoff=0.05,
+                           retry_deadline=0.3, breaker_failure_threshold=1000, batch_size=10)
+    yield store
+    store.close()
+
+
+def test_request_deadline_limits_multi_chunk_batch(down_batch_store):
+    keys = ['i:%s' % num for num in range(50)]
+    token = scoring.start_deadline(0.3)
+    started = time.monotonic()
+    try:
+        values, errors = down_batch_store.get_many(keys)
+    finally:
+        scoring.finish_deadline(token)
+    # every chunk used to get a budget of its own, five of them took five times the deadline
+    assert time.monotonic() - started < 0.5
+    assert values == {} and set(errors) == set(keys)
+
+
+def test_no_attempt_is_started_past_request_deadline(down_batch_store):
+    token = scoring.start_deadline(-1)
+    try:
+        with patch.object(down_batch_store.interests_ring.get_shard('i:1').primary, 'mget') as mget:
+            values, errors = down_batch_store.get_many(['i:1', 'i:2'])
+    finally:
+        scoring.finish_deadline(token)
+    assert mget.call_count == 0
+    assert all(isinstance(error, redis.exceptions.TimeoutError) for error in errors.values())
+    assert down_batch_store.stats()['retries'] == 0
+
+
+def test_request_deadline_limits_async_attempt():
+    async def hang(*args, **kwargs):
+        await asyncio.sleep(10)
+
+    async def run():
+        client = fakeredis.FakeAsyncRedis()
+        with patch('scoring.AsyncScoreStore.create_store', return_value=client):
+            store = AsyncScoreStore(retry_deadline=5, batch_size=10)
+        token = scoring.start_deadline(0.2)
+        started = time.monotonic()
+        try:
+            with patch.object(client, 'mget', hang):
+                values, errors = await store.get_many(['i:%s' % num for num in range(30)])
+        finally:
+            scoring.finish_deadline(token)
+        return time.monotonic() - started, errors
+
+    elapsed, errors = asyncio.run(run())
+    assert elapsed < 0.5
+    assert len(errors) == 30 and all(isinstance(error, redis.exceptions.TimeoutError) for error in errors.values())
+
+
+def test_circuit_breaker_fails_fast(breaker_store):
+    with pytest.raises(redis.exceptions.ConnectionError):
+        breaker_store.get('key')
+    with pytest.raises(CircuitOpenError):
+        breaker_store.get('key')
+    assert breaker_store.cache_get('key') is None
+    breaker_store.cache_set('key', 1, 10)
+    stats = breaker_store.stats()
+    breaker = stats['shards']['localhost:6379']['circuit_breaker']
+    assert breaker['state'] == CircuitBreaker.OPEN
+    assert breaker['trips'] == 1
+    assert breaker['rejected'] == 3
+    assert stats['retries'] == 3
+
+
+def test_circuit_breaker_half_open_probe_closes(breaker_store):
+    for _ in range(2):
+        with pytest.raises(redis.exceptions.ConnectionError):
+            breaker_store.get('key')
+    assert breaker_store.circuit_breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.3)
+    breaker_store.server.connected = True
+    assert breaker_store.get('key') is None
+    assert breaker_store.circuit_breaker.state == CircuitBreaker.CLOSED
+
+
+def test_circuit_breaker_half_open_probe_reopens(breaker_store):
+    for _ in range(2):
+        with pytest.raises(redis.exceptions.ConnectionError):
+            breaker_store.get('key')
+
+    time.sleep(0.3)
+    with pytest.raises(redis.exceptions.ConnectionError):
+        breaker_store.get('key')
+    stats = breaker_store.circuit_breaker.stats()
+    assert stats['state'] == CircuitBreaker.OPEN
+    assert stats['trips'] == 2
+
+
+def test_circuit_breaker_cancelled_probe_is_released():
+    def refuse():
+        raise redis.ConnectionError()
+
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=0)
+    with pytest.raises(redis.ConnectionError):
+        breaker.call(refuse)
+
+    async def probe():
+        await asyncio.sleep(10)
+
+    async def run():
+        task = asyncio.create_task(breaker.call_async(probe))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert breaker.stats()['state'] == CircuitBreaker.HALF_OPEN
+    assert breaker.call(lambda: 'answer') == 'answer'
+    assert breaker.stats() == {'state': CircuitBreaker.CLOSED, 'failures': 0, 'trips': 1, 'rejected': 0}
+
+
+def test_pool_exhaustion_is_not_retried_nor_counted():
+    pool = redis.BlockingConnectionPool(connection_class=fakeredis.FakeRedisConnection, server=fakeredis.FakeServer(),
+                                        max_connections=1, timeout=0.05)
+    with patch('scoring.ScoreStore.create_store', return_value=redis.Redis(connection_pool=pool)):
+        pooled_store = ScoreStore(breaker_failure_threshold=1)
+    connection = pool.get_connection()
+    with pytest.raises(redis.ConnectionError, match='No connection available'):
+        pooled_store.get('key')
+    pool.release(connection)
+    assert pooled_store.stats()['retries'] == 0
+    assert pooled_store.circuit_breaker.stats()['state'] == CircuitBreaker.CLOSED
+    assert pooled_store.get('key') is None
+
+
+@pytest.mark.parametrize('store_class, pool_class', [
+    (ScoreStore, redis.BlockingConnectionPool),
+    (AsyncScoreStore, redis.asyncio.BlockingConnectionPool),
+])
+def test_store_pools_configured(store_class, pool_class):
+    with patch.object(store_class, 'create_store', CREATE_STORE[store_class]):
+        pooled_store = store_class(cache_max_connections=3, interests_max_connections=5, pool_timeout=0.5,
+                                   socket_keepalive=True, health_check_interval=10)
+    cache_pool = pooled_store.cache_store.connection_pool
+    interests_pool = pooled_store.redis_store.connection_pool
+    assert cache_pool is not interests_pool
+    assert isinstance(cache_pool, pool_class) and isinstance(interests_pool, pool_class)
+    assert (cache_pool.max_connections, interests_pool.max_connections) == (3, 5)
+    assert cache_pool.timeout == 0.5
+    assert cache_pool.connection_kwargs['socket_keepalive'] is True
+    assert cache_pool.connection_kwargs['health_check_interval'] == 10
+
+
+def test_cache_and_interests_use_separate_clients():
+    cache_redis = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+    interests_redis = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+    with patch('scoring.ScoreStore.create_store', side_effect=[cache_redis, interests_redis]):
+        split_store = ScoreStore()
+    split_store.cache_set('score', 3.5, 60)
+    interests_redis.set('i:1', '["cars"]')
+    assert cache_redis.get('score') == b'3.5' and interests_redis.get('score') is None
+    assert split_store.cache_get('score') == b'3.5'
+    assert split_store.cache_get_many(['score', 'i:1']) == {'score': b'3.5', 'i:1': None}
+    assert scoring.get_interests(split_store, 1) == ['cars']
+
+
+def test_pool_stats():
+    pool = redis.BlockingConnectionPool(connection_class=fakeredis.FakeRedisConnection, server=fakeredis.FakeServer(),
+                                        max_connections=3, timeout=0.1)
+    redis.Redis(connection_pool=pool).set('key', 1)
+    assert scoring.pool_stats(pool) == {'max_connections': 3, 'created': 1, 'in_use': 0, 'idle': 1}
+
+    connections = [pool.get_connection() for _ in range(3)]
+    assert scoring.pool_stats(pool) == {'max_connections': 3, 'created': 3, 'in_use': 3, 'idle': 0}
+    with pytest.raises(redis.ConnectionError):
+        pool.get_connection()
+    for connection in connections:
+        pool.release(connection)
+
+
+def test_pool_stats_are_keyed_on_connection_state():
+    pool = redis.BlockingConnectionPool(max_connections=5)
+    counts = [(2, {scoring.CONNECTION_STATE: scoring.CONNECTION_USED}),
+              (3, {scoring.CONNECTION_STATE: scoring.CONNECTION_IDLE})]
+    with patch.object(pool, 'get_connection_count', return_value=counts):
+        assert scoring.pool_stats(pool) == {'max_connections': 5, 'created': 5, 'in_use': 2, 'idle': 3}
+
+
+def test_store_stats_include_pools(store):
+    store.cache_set('pool', 1, 60)
+    stats = store.stats()['shards']['localhost:6379']['pools']
+    assert set(stats) == {'cache', 'interests', 'cache_replicas', 'interests_replicas'}
+    assert stats['cache']['in_use'] == 0
+    assert stats['cache_replicas'] == stats['interests_replicas'] == []
+
+
+NODES = [('primary', 6379), ('replica-1', 6379), ('replica-2', 6379)]
+
+
+@pytest.fixture
+def replicated_store():
+    servers, clients = make_nodes(NODES, fakeredis.FakeStrictRedis)
+    with patch_create_store(ScoreStore, clients):
+        yield ScoreStore(host='primary', port=6379, replicas=NODES[1:], replica_recovery_timeout=0.2,
+                         max_retry_attempt_count=1), servers, clients
+
+
+def test_replicated_store_writes_to_primary(replicated_store):
+    replicated_store, _, clients = replicated_store
+    replicated_store.cache_set('score', 3.5, 60)
+    replicated_store.cache_set_many({'a': 1, 'b': 2}, 60)
+    assert clients[NODES[0]].mget(['score', 'a', 'b']) == [b'3.5', b'1', b'2']
+    assert clients[NODES[1]].keys() == clients[NODES[2]].keys() == []
+
+
+def test_replicated_store_reads_from_replicas(replicated_store):
+    replicated_store, _, clients = replicated_store
+    for num, node in enumerate(NODES):
+        clients[node].set('i:1', json.dumps([node[0]]))
+        clients[node].set('score', num)
+    assert {tuple(scoring.get_interests(replicated_store, 1)) for _ in range(4)} == {('replica-1',), ('replica-2',)}
+    assert {replicated_store.cache_get('score') for _ in range(4)} == {b'1', b'2'}
+    assert replicated_store.get_many(['i:1'])[0]['i:1'] in (b'["replica-1"]', b'["replica-2"]')
+
+
+def test_replicated_store_stats_include_replica_pools(replicated_store):
+    replicated_store, _, _ = replicated_store
+    pools = replicated_store.stats()['shards']['primary:6379']['pools']
+    assert len(pools['cache_replicas']) == len(pools['interests_replicas']) == 2
+    assert set(pools['cache_replicas'][0]) == {'max_connections', 'created', 'in_use', 'idle'}
+
+
+def test_replicated_store_fails_over(replicated_store):
+    replicated_store, servers, clients = replicated_store
+    for node in NODES:
+        clients[node].set('i:1', json.dumps([node[0]]))
+
+    servers[NODES[1]].connected = False
+    assert [scoring.get_interests(replicated_store, 1) for _ in range(3)] == [['replica-2']] * 3
+    replicas = replicated_store.stats()['shards']['primary:6379']['replicas']
+    assert replicas == {'replicas': 2, 'down': [0], 'failovers': 1}
+
+    servers[NODES[2]].connected = False
+    assert scoring.get_interests(replicated_store, 1) == ['primary']
+    assert replicated_store.stats()['shards']['primary:6379']['replicas']['down'] == [0, 1]
+
+    servers[NODES[1]].connected = True
+    time.sleep(0.25)
+    assert scoring.get_interests(replicated_store, 1) == ['replica-1']
+
+
+def test_replicated_store_fails_when_primary_is_down(replicated_store):
+    replicated_store, servers, _ = replicated_store
+    for server in servers.values():
+        server.connected = False
+    with pytest.raises(redis.ConnectionError):
+        replicated_store.get('i:1')
+    assert replicated_store.cache_get('score') is None
+
+
+def test_replicated_async_store_fails_over():
+    servers, clients = make_nodes(NODES, fakeredis.FakeAsyncRedis)
+
+    async def run():
+        with patch_create_store(AsyncScoreStore, clients):
+            replicated_store = AsyncScoreStore(host='primary', port=6379, replicas=NODES[1:])
+        for node in NODES:
+            await clients[node].set('i:1', json.dumps([node[0]]))
+        servers[NODES[1]].connected = False
+        servers[NODES[2]].connected = False
+        interests = await scoring.get_interests_async(replicated_store, 1)
+        await replicated_store.cache_set('score', 1, 60)
+        replicas = replicated_store.stats()['shards']['primary:6379']['replicas']
+        return interests, await clients[NODES[0]].get('score'), replicas
+
+    assert asyncio.run(run()) == (['primary'], b'1', {'replicas': 2, 'down': [0, 1], 'failovers': 2})
@@ -0,0 +1,95 @@
+import pytest
+import json
+import threading
+
+import api
+import tracing
+from metrics import Registry
+from tracing import Span, Trace, TraceWriter
+
+
+@pytest.fixture
+def trace():
+    trace = tracing.start('42')
+    yield trace
+    tracing.finish(trace)
+
+
+def test_span_records_in_current_trace(trace):
+    histogram = Registry().histogram('stage_seconds', 'Stage', ('stage',))
+    with Span('parse', histogram, ('parse',)):
+        pass
+    with Span('redis.get'):
+        pass
+    with Span('redis.get'):
+        pass
+    assert [span[0] for span in trace.spans] == ['parse', 'redis.get', 'redis.get']
+    assert histogram.get(('parse',))[0] == 1
+
+
+def test_span_without_trace():
+    with Span('parse'):
+        pass
+    assert tracing.current() is None
+
+
+def test_finish_clears_current_trace():
+    trace = tracing.start('42')
+    assert tracing.current() is trace
+    tracing.finish(trace)
+    assert tracing.current() is None
+    assert trace.duration > 0
+
+
+def test_timings_and_server_timing():
+    trace = Trace('42')
+    trace.add('parse', trace.started, 0.001)
+    trace.add('redis.get', trace.started, 0.002)
+    trace.add('redis.get', trace.started, 0.0005)
+    trace.duration = 0.01
+    assert trace.timings() == {'parse': 1.0, 'redis.get': 2.5, 'total': 10.0}
+    assert trace.server_timing() == 'parse;dur=1.0, redis.get;dur=2.5, total;dur=10.0'
+
+
+def test_trace_events():
+    trace = Trace('42')
+    trace.add('parse', trace.started + 0.001, 0.002)
+    trace.duration = 0.01
+    request, parse = trace.events(1)
+    assert request == {"name": "request", "ph": "X", "pid": 1, "tid": threading.get_ident(),
+                       "args": {"request_id": "42"}, "ts": request["ts"], "dur": 10000.0}
+    assert parse["name"] == "parse" and parse["dur"] == 2000.0
+    assert parse["ts"] - request["ts"] == pytest.approx(1000, abs=1)
+
+
+def test_trace_writer(tmp_path):
+    path = tmp_path / 'trace.json'
+    writer = TraceWriter(str(path), slower_than=0.005)
+    for request_id, duration in (('fast', 0.001), ('slow', 0.01)):
+        trace = Trace(request_id)
+        trace.add('parse', trace.started, 0.0005)
+        trace.duration = duration
+        writer.write(trace)
+    writer.close()
+    TraceWriter(str(path)).close()
+
+    data = path.read_text()
+    assert data.startswith('[\n') and data.count('[') == 1
+    events = json.loads(data.rstrip(',\n') + ']')
+    assert [(event['name'], event['args']['request_id']) for event in events] == [('request', 'slow'),
+                                                                                  ('parse', 'slow')]
+
+
+@pytest.mark.parametrize('header, honored', [
+    ('0af7651916cd43dd8448eb211c80319c', True),
+    ('req-1.2:3_x', True),
+    ('', False),
+    (None, False),
+    ('a' * 129, False),
+    ('bad id', False),
+    ('id\r\nSet-Cookie: x', False),
+])
+def test_make_request_id(header, honored):
+    request_id = api.make_request_id(header)
+    assert (request_id == header) == honored
+    assert api.REQUEST_ID_RE.match(request_id)
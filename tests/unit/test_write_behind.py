@@ -0,0 +1,172 @@
+import pytest
+import os
+import signal
+import threading
+import time
+import fakeredis
+from mock import patch
+
+import api
+import logs
+import scoring
+from scoring import ScoreStore, WriteBehindQueue
+from server import ThreadPoolHTTPServer
+
+
+class RecordingWriter:
+    def __init__(self, fail=False):
+        self.writes = []
+        self.fail = fail
+
+    def __call__(self, values, time_ms):
+        if self.fail:
+            raise ConnectionError('redis is down')
+        self.writes.append((dict(values), time_ms))
+
+
+def run_synchronously(write_behind):
+    write_behind.background.queue.maxsize += 1
+    write_behind.background.queue.put(None)
+    write_behind.run()
+
+
+@pytest.fixture
+def idle_queue():
+    writer = RecordingWriter()
+    with patch.object(logs.BackgroundQueue, 'start'):
+        yield WriteBehindQueue(writer, max_size=3, batch_size=10, flush_interval=0), writer
+
+
+@pytest.fixture
+def write_behind_store():
+    server = fakeredis.FakeServer()
+    with patch('scoring.ScoreStore.create_store', return_value=fakeredis.FakeStrictRedis(server=server)):
+        store = ScoreStore(write_behind_size=100, write_behind_interval=0.01)
+    yield store
+    store.close()
+
+
+def test_writes_are_coalesced_and_grouped_by_ttl(idle_queue):
+    write_behind, writer = idle_queue
+    write_behind.put('a', 1, 1000)
+    write_behind.put('a', 2, 1000)
+    write_behind.put('b', 3, 2000)
+    run_synchronously(write_behind)
+    assert writer.writes == [({'a': 2}, 1000), ({'b': 3}, 2000)]
+    assert write_behind.stats() == {'queued': 3, 'dropped': 0, 'coalesced': 1, 'written': 2, 'failed': 0,
+                                    'pending': 0}
+
+
+@pytest.mark.parametrize('policy, kept', [
+    (WriteBehindQueue.DROP_NEW, {'a': 1, 'b': 2, 'c': 3}),
+    (WriteBehindQueue.DROP_OLDEST, {'b': 2, 'c': 3, 'd': 4}),
+])
+def test_full_queue_drop_policy(idle_queue, policy, kept):
+    write_behind, writer = idle_queue
+    write_behind.background.policy = policy
+    for num, key in enumerate('abcd', 1):
+        write_behind.put(key, num, 1000)
+    assert write_behind.stats()['dropped'] == 1
+    run_synchronously(write_behind)
+    assert writer.writes == [(kept, 1000)]
+
+
+def test_drop_oldest_counts_every_lost_write(idle_queue):
+    write_behind, writer = idle_queue
+    write_behind.background.policy = WriteBehindQueue.DROP_OLDEST
+    for num, key in enumerate('abc', 1):
+        write_behind.put(key, num, 1000)
+    get_nowait = write_behind.background.queue.get_nowait
+
+    def racing_get_nowait():
+        # another writer takes the slot freed for 'e' first
+        item = get_nowait()
+        write_behind.background.queue.get_nowait = get_nowait
+        write_behind.put('d', 4, 1000)
+        return item
+
+    write_behind.background.queue.get_nowait = racing_get_nowait
+    write_behind.put('e', 5, 1000)
+    stats = write_behind.stats()
+    assert stats['dropped'] == 2 and stats['queued'] == 5
+    run_synchronously(write_behind)
+    assert writer.writes == [({'c': 3, 'd': 4, 'e': 5}, 1000)]
+
+
+def test_failed_writes_are_counted(idle_queue):
+    write_behind, _ = idle_queue
+    write_behind.write = RecordingWriter(fail=True)
+    write_behind.put('a', 1, 1000)
+    run_synchronously(write_behind)
+    assert write_behind.stats()['failed'] == 1
+
+
+def test_close_flushes_queued_writes():
+    writer = RecordingWriter()
+    write_behind = WriteBehindQueue(writer, batch_size=7, flush_interval=10)
+    for num in range(20):
+        write_behind.put('key:%s' % num, num, 1000)
+    write_behind.close()
+    assert not write_behind.background.thread
+    assert {key: value for values, _ in writer.writes for key, value in values.items()} == \
+        {'key:%s' % num: num for num in range(20)}
+    assert all(len(values) <= 7 for values, _ in writer.writes)
+
+
+def test_forked_child_does_not_flush_parent_writes():
+    writer = RecordingWriter()
+    write_behind = WriteBehindQueue(writer, flush_interval=10)
+    write_behind.put('parent', 1, 1000)
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            write_behind.put('child', 2, 1000)
+            write_behind.close()
+            code = 0 if writer.writes == [({'child': 2}, 1000)] else 2
+        finally:
+            os._exit(code)
+    write_behind.close()
+    assert os.waitpid(pid, 0)[1] == 0
+    assert writer.writes == [({'parent': 1}, 1000)]
+
+
+def test_score_response_does_not_wait_for_cache_write(write_behind_store):
+    release = threading.Event()
+    write_cache = write_behind_store.write_cache
+
+    def slow_write(values, time_ms):
+        release.wait(5)
+        write_cache(values, time_ms)
+
+    with patch.object(write_behind_store.write_behind, 'write', slow_write):
+        started = time.monotonic()
+        score = scoring.get_score(write_behind_store, "79175002040", "stupnikov@otus.ru")
+        scores = scoring.get_scores(write_behind_store, [{"phone": "79175002041", "email": None},
+                                                         {"phone": "79175002042", "email": None}])
+        assert time.monotonic() - started < 0.5
+        release.set()
+        write_behind_store.close()
+
+    assert score == 3.0 and scores == [1.5, 1.5]
+    key = scoring.get_score_key("79175002040")
+    assert write_behind_store.redis_store.get(key) == b'3.0'
+    assert 0 < write_behind_store.redis_store.pttl(key) <= 60 * 60 * 1000
+    assert write_behind_store.stats()['write_behind']['written'] == 3
+
+
+def test_sigterm_flushes_queued_writes():
+    mocked_redis = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+    with patch('scoring.ScoreStore.create_store', return_value=mocked_redis):
+        store = ScoreStore(write_behind_size=100, write_behind_interval=10)
+    server = ThreadPoolHTTPServer(('localhost', 0), api.MainHTTPHandler, workers=1)
+    handler = signal.getsignal(signal.SIGTERM)
+    with patch.object(api.MainHTTPHandler, 'store', store), patch('logging.shutdown'):
+        store.cache_set('score', 1, 60)
+        assert store.cache_store.get('score') is None
+        threading.Timer(0.1, os.kill, (os.getpid(), signal.SIGTERM)).start()
+        try:
+            api.serve_threaded(server)
+        finally:
+            signal.signal(signal.SIGTERM, handler)
+    assert store.cache_store.get('score') == b'1'
@@ -0,0 +1,139 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+
+import codec
+import logs
+
+CURRENT = contextvars.ContextVar('trace', default=None)
+
+
+class Trace:
+    # spans of one request, kept in a context variable so the store records its calls without passing it around
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.wall_started = time.time()
+        self.tid = threading.get_ident()
+        self.duration = None
+        self.spans = []
+
+    def add(self, name, started, duration):
+        self.spans.append((name, started, duration, threading.get_ident()))
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+        return self.duration
+
+    def timings(self):
+        # milliseconds spent in each kind of span, repeated spans like redis calls are summed
+        timings = {}
+        for name, _, duration, _ in self.spans:
+            timings[name] = timings.get(name, 0) + duration
+        timings['total'] = self.duration if self.duration is not None else time.perf_counter() - self.started
+        return {name: round(duration * 1000, 3) for name, duration in timings.items()}
+
+    def server_timing(self):
+        return ', '.join('%s;dur=%s' % item for item in self.timings().items())
+
+    def events(self, pid):
+        # complete events of the chrome trace event format, timestamps are in microseconds
+        def event(name, started, duration, tid):
+            return {"name": name, "ph": "X", "pid": pid, "tid": tid, "args": {"request_id": self.request_id},
+                    "ts": round((self.wall_started + started - self.started) * 1e6, 3),
+                    "dur": round(duration * 1e6, 3)}
+
+        yield event('request', self.started, self.duration or 0, self.tid)
+        for name, started, duration, tid in self.spans:
+            yield event(name, started, duration, tid)
+
+
+class Span:
+    # times a block for the current trace, and for a histogram when one is given
+    __slots__ = ('name', 'histogram', 'labels', 'started')
+
+    def __init__(self, name, histogram=None, labels=()):
+        self.name = name
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.started
+        if self.histogram is not None:
+            self.histogram.observe(duration, self.labels)
+        trace = CURRENT.get()
+        if trace is not None:
+            trace.add(self.name, self.started, duration)
+
+
+class EventFormatter(logging.Formatter):
+    # the file is a json array that is never closed, which trace viewers accept
+    def format(self, record):
+        return ''.join('%s,\n' % codec.dumps(event).decode('UTF-8') for event in record.msg.events(os.getpid()))
+
+
+class TraceWriter:
+    # finished traces go through an async log handler, so writing them never blocks a request
+    def __init__(self, filename, slower_than=0, queue_size=10000, policy=logs.AsyncLogHandler.DROP_NEW):
+        self.slower_than = slower_than
+        with open(filename, 'a') as f:
+            if f.tell() == 0:
+                f.write('[\n')
+        target = logging.FileHandler(filename)
+        target.terminator = ''
+        target.setFormatter(EventFormatter())
+        self.handler = logs.AsyncLogHandler(target, queue_size, policy)
+
+    def write(self, trace):
+        if trace.duration >= self.slower_than:
+            self.handler.handle(logging.makeLogRecord({"msg": trace, "levelno": logging.INFO}))
+
+    def close(self):
+        self.handler.close()
+
+
+WRITER = None
+
+
+def start(request_id):
+    trace = Trace(request_id)
+    CURRENT.set(trace)
+    return trace
+
+
+def current():
+    return CURRENT.get()
+
+
+def finish(trace):
+    trace.finish()
+    if CURRENT.get() is trace:
+        CURRENT.set(None)
+    if WRITER is not None:
+        WRITER.write(trace)
+    return trace
+
+
+def setup(filename, slower_than=0, queue_size=10000, policy=logs.AsyncLogHandler.DROP_NEW):
+    global WRITER
+    if WRITER is not None:
+        WRITER.close()
+    WRITER = TraceWriter(filename, slower_than, queue_size, policy) if filename else None
+    return WRITER
+
+
+def add_options(op):
+    op.add_option("--trace-file", action="store", default=None,
+                  help="write spans of requests to this file in the chrome trace event format")
+    op.add_option("--trace-slower-than", action="store", type=float, default=0,
+                  help="write only requests that took at least this many milliseconds")
+
+
+def setup_from_options(opts):
+    return setup(opts.trace_file, opts.trace_slower_than / 1000.0, opts.log_queue or 10000, opts.log_overflow)